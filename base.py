@@ -49,7 +49,8 @@ def nested_analysis(X, df, condition, function=None, query=None,
         # Subsubselect for each unique condition
         y_sel = [np.where(y == value)[0] for value in values]
         # Mean condition:
-        X_mean = np.zeros(np.hstack((len(y_sel), X.shape[1:])))
+        X_mean = np.zeros(np.hstack((len(y_sel), X.shape[1:])),
+                          dtype=X.dtype)
         y_mean = np.zeros(len(y_sel))
         for ii, sel_ in enumerate(y_sel):
             X_mean[ii, ...] = np.mean(X[sel_, ...], axis=0)
@@ -95,7 +96,8 @@ def _default_analysis(X, y):
     # Binary contrast
     unique_y = np.unique(y)
     if len(unique_y) == 2:
-        y = np.where(y == unique_y[0], 1, -1)
+        # Keep the precision of X
+        y = np.where(y == unique_y[0], 1, -1).astype(X.dtype)
         # Tile Y to across X dimension without allocating memory
         Y = tile_memory_free(y, X.shape[1:])
         return np.mean(X * Y, axis=0)
@@ -297,43 +299,819 @@ def meg_to_gradmag(chan_types):
     return chan_types
 
 
-def resample_epochs(epochs, sfreq):
-    """faster resampling"""
-    # from librosa import resample
-    # librosa.resample(channel, o_sfreq, sfreq, res_type=res_type)
-    from scipy.signal import resample
+def resample_epochs(epochs, sfreq, method='poly', chunk_size=32):
+    """faster resampling
 
-    # resample
-    epochs._data = resample(
-        epochs._data, epochs._data.shape[2] / epochs.info['sfreq'] * sfreq,
-        axis=2)
+    Parameters
+    ----------
+    epochs : Epochs
+    sfreq : float
+        New sampling frequency.
+    method : 'poly' | 'fft'
+        'poly' applies a polyphase anti-aliasing filter for the rational
+        ratio closest to sfreq / epochs.info['sfreq'] (see
+        resample_array). 'fft' resamples all the data at once in the
+        frequency domain, assuming periodic signals. Defaults to 'poly'.
+    chunk_size : int
+        Number of trials processed at once by the 'poly' method. Defaults
+        to 32.
+
+    Returns
+    -------
+    epochs : Epochs
+    """
+    dtype = epochs._data.dtype
+    if method == 'poly':
+        up, down = rational_ratio(epochs.info['sfreq'], sfreq)
+        epochs._data = resample_array(epochs._data, up, down,
+                                      chunk_size=chunk_size)
+        sfreq = epochs.info['sfreq'] * up / float(down)
+    elif method == 'fft':
+        from scipy.signal import resample
+        epochs._data = resample(
+            epochs._data,
+            int(round(epochs._data.shape[2] / epochs.info['sfreq'] * sfreq)),
+            axis=2).astype(dtype, copy=False)
+    else:
+        raise ValueError('Unknown resampling method %s' % method)
     # update metadata
-    epochs.info['sfreq'] = sfreq
+    _set_sfreq(epochs.info, sfreq)
     epochs.times = (np.arange(epochs._data.shape[2],
-                              dtype=np.float) / sfreq + epochs.times[0])
+                              dtype=float) / sfreq + epochs.times[0])
     return epochs
 
 
-def decim(inst, decim):
-    """faster resampling"""
+def _set_sfreq(info, sfreq):
+    """Update the sampling frequency of low-pass filtered data"""
+    info['sfreq'] = sfreq
+    if info.get('lowpass', None) is None or info['lowpass'] > sfreq / 2.:
+        info['lowpass'] = sfreq / 2.
+
+
+def rational_ratio(sfreq, new_sfreq, max_denominator=1000):
+    """Closest up / down integers to new_sfreq / sfreq"""
+    from fractions import Fraction
+    ratio = Fraction(new_sfreq / float(sfreq)).limit_denominator(
+        max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+def resample_array(X, up, down, chunk_size=32, out=None):
+    """Polyphase resampling along the last axis, by chunks of trials.
+
+    The signal is upsampled by up, low-pass filtered and downsampled by down
+    (see scipy.signal.resample_poly). Output sample k is aligned with input
+    sample k * down / up.
+
+    The peak memory is that of X, of the output (up / down times the size of
+    X) and of the filtering of a chunk of trials. The output is a compact
+    array, so that X is released when the caller drops it.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, ..., n_times)
+        Data.
+    up : int
+        Upsampling factor.
+    down : int
+        Downsampling factor.
+    chunk_size : int
+        Number of trials resampled at once, which bounds the temporary
+        memory. Defaults to 32.
+    out : None | np.array, shape (n_trials, ..., n_times * up / down)
+        Preallocated output. Defaults to a new array of the type of X.
+
+    Returns
+    -------
+    out : np.array, shape (n_trials, ..., ceil(n_times * up / down))
+    """
+    from scipy.signal import resample_poly
+    n_times = int(np.ceil(X.shape[-1] * up / float(down)))
+    if out is None:
+        out = np.empty(X.shape[:-1] + (n_times,), dtype=X.dtype)
+    for start in range(0, len(X), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        if up == down:
+            out[chunk] = X[chunk]
+        else:
+            out[chunk] = resample_poly(X[chunk], up, down, axis=-1)
+    return out
+
+
+def test_resample_array():
+    from nose.tools import assert_equal, assert_true
+    from scipy.signal import resample_poly
+    sfreq, n_times = 1000., 1401
+    times = np.arange(n_times) / sfreq
+    # 10 Hz sine wave, preserved by down sampling
+    X = np.tile(np.sin(2 * np.pi * 10 * times), [5, 3, 1]).astype(np.float32)
+    for new_sfreq in (250., 200., 120.):
+        up, down = rational_ratio(sfreq, new_sfreq)
+        assert_equal(up / float(down), new_sfreq / sfreq)
+        Y = resample_array(X, up, down, chunk_size=2)
+        assert_equal(Y.dtype, np.float32)
+        assert_equal(Y.shape, (5, 3, int(np.ceil(n_times * up / float(down)))))
+        # chunks do not change the result
+        np.testing.assert_allclose(Y, resample_poly(X, up, down, axis=-1),
+                                   atol=1e-5)
+        # the output does not keep the input alive
+        assert_true(Y.base is None)
+        # the anti-alias filter lowers the low-pass of the data
+        info = dict(sfreq=sfreq, lowpass=330.)
+        _set_sfreq(info, new_sfreq)
+        assert_equal(info['lowpass'], min(330., new_sfreq / 2.))
+        # samples remain aligned, away from the edges
+        new_times = np.arange(Y.shape[-1]) * down / float(up) / sfreq
+        inside = slice(10, -10)
+        np.testing.assert_allclose(
+            Y[0, 0, inside], np.sin(2 * np.pi * 10 * new_times[inside]),
+            atol=1e-2)
+
+
+def decim(inst, decim, antialias=True, chunk_size=32):
+    """faster resampling
+
+    Parameters
+    ----------
+    inst : Raw | Epochs
+    decim : int
+        Decimation factor.
+    antialias : bool
+        If True, low-pass filter the data below the new Nyquist frequency
+        before keeping one sample out of decim (see resample_array), and
+        update info['lowpass']. The decimated data is a new compact array:
+        the peak memory is that of the original data, of the decimated data
+        and of the filtering of a chunk. Defaults to True.
+        The raws concatenated in a Raw are decimated separately, from their
+        first sample, so that the filter never runs across their
+        boundaries, and then concatenated, which briefly doubles the
+        decimated data.
+    chunk_size : int
+        Number of trials (channels for Raw) filtered at once. Defaults to 32.
+
+    Returns
+    -------
+    inst : Raw | Epochs
+    """
     from mne.io.base import _BaseRaw
     from mne.epochs import _BaseEpochs
+    if decim == 1:
+        return inst
+
+    def _decim(data):
+        if antialias:
+            return resample_array(data, 1, decim, chunk_size=chunk_size)
+        return data[..., ::decim]
+
     if isinstance(inst, _BaseRaw):
-        inst._data = inst._data[:, ::decim]
-        inst.info['sfreq'] /= decim
-        inst._first_samps /= decim
-        inst.first_samp /= decim
-        inst._last_samps /= decim
-        inst.last_samp /= decim
-        inst._raw_lengths /= decim
-        inst._times = inst._times[::decim]
+        inst._data, inst._raw_lengths = _decim_segments(
+            inst._data, inst._raw_lengths, _decim)
+        inst._first_samps = np.array(inst._first_samps) // decim
+        inst._last_samps = inst._first_samps + inst._raw_lengths - 1
+        inst.first_samp = inst._first_samps[0]
+        inst.last_samp = inst._last_samps[-1]
+        inst._times = (inst._times[0] + np.arange(inst._data.shape[-1]) *
+                       decim / float(inst.info['sfreq']))
     elif isinstance(inst, _BaseEpochs):
-        inst._data = inst._data[:, :, ::decim]
-        inst.info['sfreq'] /= decim
+        inst._data = _decim(inst._data)
         inst.times = inst.times[::decim]
+    if antialias:
+        _set_sfreq(inst.info, inst.info['sfreq'] / decim)
+    else:
+        inst.info['sfreq'] /= decim
     return inst
 
 
+def _decim_segments(data, lengths, func):
+    """Apply func to each segment of the last axis of data, e.g. to each raw
+    of a concatenated Raw, into a new compact array.
+
+    Returns
+    -------
+    out : np.array
+        The concatenated outputs.
+    lengths : np.array of int
+        Their lengths.
+    """
+    bounds = np.r_[0, np.cumsum(lengths)].astype(int)
+    outs = [func(data[..., start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+    lengths = np.array([out.shape[-1] for out in outs], dtype=int)
+    return np.concatenate(outs, axis=-1), lengths
+
+
+def test_decim():
+    from nose.tools import assert_equal
+    from mne import create_info, EpochsArray, concatenate_raws
+    from mne.io import RawArray
+    sfreq, n_times = 1000., 1001
+    info = create_info(['a', 'b'], sfreq, 'eeg')
+    info['lowpass'] = 330.
+    rng = np.random.RandomState(0)
+    data = rng.randn(2, n_times)
+    # Epochs
+    epochs = EpochsArray(data[None].repeat(3, 0), info, tmin=-.2)
+    epochs = decim(epochs, 4)
+    assert_equal(epochs._data.shape, (3, 2, 251))
+    np.testing.assert_allclose(epochs._data[0],
+                               resample_array(data, 1, 4))
+    np.testing.assert_allclose(epochs.times, -.2 + np.arange(251) / 250.)
+    assert_equal((epochs.info['sfreq'], epochs.info['lowpass']),
+                 (250., 125.))
+    # Raw, with each concatenated raw decimated separately
+    raws = [RawArray(data[:, :n], info.copy()) for n in (1001, 502)]
+    raw = concatenate_raws(raws)
+    raw = decim(raw, 4)
+    np.testing.assert_array_equal(raw._raw_lengths, [251, 126])
+    np.testing.assert_allclose(
+        raw._data, np.c_[resample_array(data, 1, 4),
+                         resample_array(data[:, :502], 1, 4)])
+    np.testing.assert_array_equal(raw._first_samps, [0, 0])
+    np.testing.assert_array_equal(raw._last_samps, [250, 125])
+    assert_equal((raw.first_samp, raw.last_samp), (0, 125))
+    np.testing.assert_allclose(raw._times, np.arange(377) / 250.)
+    assert_equal((raw.info['sfreq'], raw.info['lowpass']), (250., 125.))
+    # without anti-aliasing
+    raw = decim(concatenate_raws([RawArray(data[:, :n], info.copy())
+                                  for n in (1001, 502)]), 4, antialias=False)
+    np.testing.assert_array_equal(raw._data,
+                                  np.c_[data[:, ::4], data[:, :502:4]])
+    assert_equal((raw.info['sfreq'], raw.info['lowpass']), (250., 330.))
+
+
+def test_decim_segments():
+    from nose.tools import assert_equal
+    data = np.random.RandomState(0).randn(3, 100)
+    out, lengths = _decim_segments(
+        data, [50, 23, 27], lambda x: resample_array(x, 1, 4))
+    assert_equal(lengths.tolist(), [13, 6, 7])
+    # the filter does not run across the segments
+    np.testing.assert_allclose(out[:, 13:19],
+                               resample_array(data[:, 50:73], 1, 4))
+    out, lengths = _decim_segments(data, [50, 50], lambda x: x[..., ::3])
+    np.testing.assert_array_equal(out, np.c_[data[:, :50:3], data[:, 50::3]])
+    assert_equal(lengths.tolist(), [17, 17])
+
+
+def resample_padding(sfreq, up, down):
+    """Duration, in seconds, of the edges affected by the resample_array
+    filter"""
+    # scipy.signal.resample_poly uses 10 zero-crossings on each side
+    half_len = 10 * max(up, down)
+    return half_len / float(up * sfreq)
+
+
+def preprocess_epochs(epochs, preproc, reorder=True, verbose=False):
+    """Apply the preprocessing steps of a preproc dict.
+
+    Parameters
+    ----------
+    epochs : Epochs
+    preproc : dict
+        Can contain 'resample' (new sampling frequency), 'decim' (decimation
+        factor), 'baseline' (dict(tmin, tmax), None standing for the edges of
+        the data) and 'crop' (dict(tmin, tmax)), applied in this order, then
+        'whiten' (parameters of whiten_epochs) and 'window' (parameters of
+        window_epochs).
+    reorder : bool
+        If True, crop and fuse the steps before applying them (see
+        plan_preprocessing). Defaults to True.
+    verbose : bool
+        If True, print the plan and its estimated cost. Defaults to False.
+
+    Returns
+    -------
+    epochs : Epochs
+    """
+    data = epochs._data
+    n_trials, n_chans, n_times = data.shape
+    plan, cost = plan_preprocessing(
+        preproc, epochs.info['sfreq'], epochs.times[0], n_times,
+        n_signals=n_trials * n_chans, itemsize=data.dtype.itemsize,
+        reorder=reorder)
+    if verbose:
+        print(report_plan(plan, cost))
+    if len(plan):
+        epochs._data = apply_plan(data, plan)
+        # update metadata
+        last = plan[-1]
+        if any(step['name'] == 'resample' for step in plan):
+            _set_sfreq(epochs.info, last['sfreq'])
+        epochs.times = (np.arange(last['n_times'], dtype=float) /
+                        last['sfreq'] + last['tmin'])
+    if 'whiten' in preproc.keys():
+        epochs = whiten_epochs(epochs, **preproc['whiten'])
+    if 'window' in preproc.keys():
+        epochs = window_epochs(epochs, **preproc['window'])
+    return epochs
+
+
+def plan_preprocessing(preproc, sfreq, tmin, n_times, n_signals=1,
+                       itemsize=4, reorder=True):
+    """Order and fuse the steps of a preproc dict into an execution plan.
+
+    The resampling and the decimation are fused into a single polyphase
+    filter (see resample_array). The data is first cropped around the final
+    window, with margins for the edges of the filter, so that the samples
+    cropped away are never filtered. This first crop starts on the sampling
+    grid of the output, which therefore matches the one obtained with the
+    fixed order.
+
+    Parameters
+    ----------
+    preproc : dict
+        Preprocessing steps (see preprocess_epochs).
+    sfreq : float
+        Sampling frequency of the data.
+    tmin : float
+        Time of the first sample, in seconds.
+    n_times : int
+        Number of samples.
+    n_signals : int
+        Number of time series, i.e. n_trials * n_chans. Defaults to 1.
+    itemsize : int
+        Bytes per sample. Defaults to 4 (single precision).
+    reorder : bool
+        If False, the steps are applied in the fixed order resample, decim,
+        crop, without fusion. Defaults to True.
+
+    Returns
+    -------
+    plan : list of dict
+        The steps. Each has a 'name', 'crop' (with 'start' and 'stop'
+        samples) or 'resample' (with 'up' and 'down' factors), the 'sfreq',
+        'tmin' and 'n_times' of its output, and its estimated 'flops' and
+        peak memory 'bytes'.
+    cost : dict
+        Estimated 'flops' and peak memory 'bytes' of the plan.
+    """
+    state = dict(sfreq=float(sfreq), tmin=float(tmin), n_times=int(n_times))
+    plan = list()
+
+    def _add(step, n_out):
+        step.update(n_in=state['n_times'], n_times=n_out)
+        state.update(sfreq=step['sfreq'], tmin=step['tmin'], n_times=n_out)
+        plan.append(step)
+
+    def _resample(up, down):
+        if up == down:
+            return
+        n_out = int(np.ceil(state['n_times'] * up / float(down)))
+        _add(dict(name='resample', up=up, down=down, tmin=state['tmin'],
+                  sfreq=state['sfreq'] * up / float(down)), n_out)
+
+    def _samples(tmin, tmax, pad=0., align=1):
+        # samples of [tmin, tmax], with half a sample tolerance, or of
+        # [tmin - pad, tmax + pad] starting on a multiple of align
+        first = (tmin - state['tmin']) * state['sfreq']
+        last = (tmax - state['tmin']) * state['sfreq']
+        if pad > 0.:
+            start = int(np.floor(first - pad * state['sfreq']))
+            start = max(0, start // align * align)
+            stop = int(np.ceil(last + pad * state['sfreq'])) + 1
+        else:
+            start = max(0, int(np.ceil(first - .5)))
+            stop = int(np.floor(last + .5)) + 1
+        stop = min(stop, state['n_times'])
+        if start >= stop:
+            raise ValueError('No sample between tmin=%s and tmax=%s' % (
+                tmin, tmax))
+        return start, stop
+
+    def _crop(tmin, tmax, pad=0., align=1):
+        start, stop = _samples(tmin, tmax, pad, align)
+        if start == 0 and stop == state['n_times']:
+            return
+        _add(dict(name='crop', start=start, stop=stop, sfreq=state['sfreq'],
+                  tmin=state['tmin'] + start / state['sfreq']), stop - start)
+
+    def _baseline(tmin, tmax):
+        start, stop = _samples(tmin, tmax)
+        _add(dict(name='baseline', start=start, stop=stop,
+                  sfreq=state['sfreq'], tmin=state['tmin']), state['n_times'])
+
+    crop = preproc.get('crop', None)
+    baseline = preproc.get('baseline', None)
+    if baseline is not None:
+        # None stands for the first and last samples of the data
+        tmax = tmin + (n_times - 1) / float(sfreq)
+        baseline = dict(
+            tmin=tmin if baseline.get('tmin') is None else baseline['tmin'],
+            tmax=tmax if baseline.get('tmax') is None else baseline['tmax'])
+    if not reorder:
+        if 'resample' in preproc.keys():
+            _resample(*rational_ratio(sfreq, preproc['resample']))
+        _resample(1, preproc.get('decim', 1))
+        if baseline is not None:
+            _baseline(baseline['tmin'], baseline['tmax'])
+        if crop is not None:
+            _crop(crop['tmin'], crop['tmax'])
+    else:
+        new_sfreq = preproc.get('resample', sfreq) / float(
+            preproc.get('decim', 1))
+        up, down = rational_ratio(sfreq, new_sfreq)
+        if crop is not None and (up != down or baseline is not None):
+            # keep the samples of the baseline too
+            window = [crop] + ([] if baseline is None else [baseline])
+            pad = resample_padding(sfreq, up, down) if up != down else 0.
+            _crop(min([w['tmin'] for w in window]),
+                  max([w['tmax'] for w in window]), pad=pad, align=down)
+        _resample(up, down)
+        if baseline is not None:
+            _baseline(baseline['tmin'], baseline['tmax'])
+        if crop is not None:
+            _crop(crop['tmin'], crop['tmax'])
+
+    # Estimate the cost of each step, as executed by apply_plan
+    for ii, step in enumerate(plan):
+        n_in, n_out = step['n_in'], step['n_times']
+        if step['name'] == 'resample':
+            # each output sample is a dot product with one phase of the
+            # polyphase filter
+            n_taps = 20 * max(step['up'], step['down']) + 1
+            step['flops'] = 2. * n_signals * n_out * n_taps / step['up']
+            # downsampled in place unless the input is a cropped view
+            in_place = n_out <= n_in and (ii == 0 or
+                                          plan[ii - 1]['name'] != 'crop')
+            step['bytes'] = n_signals * itemsize * (
+                n_in + (0 if in_place else n_out))
+        elif step['name'] == 'baseline':
+            # mean and subtraction, in place
+            step['flops'] = float(n_signals * (step['stop'] - step['start'] +
+                                               n_out))
+            step['bytes'] = n_signals * itemsize * n_in
+        else:
+            # cropped as a view, copied when it is the last step
+            step['flops'] = 0.
+            step['bytes'] = n_signals * itemsize * (
+                n_in + (n_out if ii == len(plan) - 1 else 0))
+    cost = dict(flops=sum([step['flops'] for step in plan]),
+                bytes=max([n_signals * itemsize * int(n_times)] +
+                          [step['bytes'] for step in plan]))
+    return plan, cost
+
+
+def apply_plan(data, plan, chunk_size=32):
+    """Apply a preprocessing plan (see plan_preprocessing) to an array.
+
+    Parameters
+    ----------
+    data : np.array, shape (n_trials, n_chans, n_times)
+        The data, which can be overwritten.
+    plan : list of dict
+        The steps.
+    chunk_size : int
+        Number of trials resampled at once. Defaults to 32.
+
+    Returns
+    -------
+    data : np.array, shape (n_trials, n_chans, plan[-1]['n_times'])
+    """
+    for step in plan:
+        if step['name'] == 'crop':
+            data = data[..., step['start']:step['stop']]
+        elif step['name'] == 'resample':
+            data = resample_array(data, step['up'], step['down'],
+                                  chunk_size=chunk_size)
+        elif step['name'] == 'baseline':
+            data -= data[..., step['start']:step['stop']].mean(
+                axis=-1, keepdims=True)
+        else:
+            raise ValueError('Unknown preprocessing step %s' % step['name'])
+    return np.ascontiguousarray(data)
+
+
+def apply_plan_chunked(read, n_trials, plan, out, chunk_size=32):
+    """Apply a preprocessing plan by chunks of trials, e.g. out of core.
+
+    Parameters
+    ----------
+    read : function
+        read(sel) returns the data of the trials sel, e.g. from a
+        memory-mapped file, shape (len(sel), n_chans, n_times).
+    n_trials : int
+        Number of trials.
+    plan : list of dict
+        The steps (see plan_preprocessing).
+    out : np.array, shape (n_trials, n_chans, plan[-1]['n_times'])
+        Preallocated output, e.g. a memory-mapped file (see cache_memmap).
+    chunk_size : int
+        Number of trials in memory at once. Defaults to 32.
+
+    Returns
+    -------
+    out : np.array, shape (n_trials, n_chans, plan[-1]['n_times'])
+    """
+    for start in range(0, n_trials, chunk_size):
+        stop = min(start + chunk_size, n_trials)
+        out[start:stop] = apply_plan(read(np.arange(start, stop)), plan,
+                                     chunk_size=chunk_size)
+    return out
+
+
+def report_plan(plan, cost):
+    """Describe a preprocessing plan and its estimated cost"""
+    lines = list()
+    for step in plan:
+        if step['name'] in ('crop', 'baseline'):
+            params = 'samples %i to %i' % (step['start'], step['stop'])
+        else:
+            params = 'x %i / %i' % (step['up'], step['down'])
+        lines.append('%s %s: %i -> %i samples, %.3g MFLOP, %.3g MB' % (
+            step['name'], params, step['n_in'], step['n_times'],
+            step['flops'] / 1e6, step['bytes'] / 1e6))
+    lines.append('total: %.3g MFLOP, peak %.3g MB' % (
+        cost['flops'] / 1e6, cost['bytes'] / 1e6))
+    return '\n'.join(lines)
+
+
+def sliding_window(X, n_window, stride=1):
+    """Sliding windows along the last axis, as a view without copy.
+
+    Parameters
+    ----------
+    X : np.array, shape (..., n_times)
+        Data.
+    n_window : int
+        Number of samples per window.
+    stride : int
+        Number of samples between the starts of two consecutive windows.
+        Defaults to 1.
+
+    Returns
+    -------
+    windows : np.array, shape (..., n_windows, n_window)
+        Read-only view of X, n_windows = (n_times - n_window) // stride + 1.
+    """
+    n_times = X.shape[-1]
+    if not 0 < n_window <= n_times or stride < 1:
+        raise ValueError('Cannot slide %i-sample windows by %i samples over '
+                         '%i samples' % (n_window, stride, n_times))
+    n_windows = (n_times - n_window) // stride + 1
+    windows = np.lib.stride_tricks.as_strided(
+        X, X.shape[:-1] + (n_windows, n_window),
+        X.strides[:-1] + (X.strides[-1] * stride, X.strides[-1]))
+    # the windows overlap: writing in one would write in its neighbors
+    windows.flags.writeable = False
+    return windows
+
+
+def delay_embedding(X, n_window, stride=1):
+    """Stack consecutive samples as features.
+
+    The embedding is a view of X without copy if X is time-major, i.e. if
+    X.transpose(0, 2, 1) is C-contiguous. Otherwise, X is first copied once
+    in this layout.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_chans, n_times)
+        Data.
+    n_window : int
+        Number of consecutive samples stacked.
+    stride : int
+        Number of samples between two consecutive windows. Defaults to 1.
+
+    Returns
+    -------
+    X : np.array, shape (n_trials, n_window * n_chans, n_windows)
+        Read-only embedding. Feature lag * n_chans + chan is the channel
+        chan, lag samples after the start of the window.
+    """
+    n_trials, n_chans, n_times = X.shape
+    X = np.ascontiguousarray(X.transpose(0, 2, 1))
+    # the windows of a time-major trial are contiguous
+    windows = sliding_window(X.reshape(n_trials, n_times * n_chans),
+                             n_window * n_chans, stride * n_chans)
+    return windows.transpose(0, 2, 1)
+
+
+def fit_whitener(X, baseline, chunk_size=32):
+    """Whitening operator of the noise, estimated on a baseline.
+
+    The channels are first scaled by their standard deviation, so that
+    magnetometers and gradiometers are comparable, and their covariance is
+    then shrunk with the Ledoit-Wolf estimator.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_chans, n_times)
+        Data.
+    baseline : slice | np.array of int
+        Noise samples.
+    chunk_size : int
+        Number of trials accumulated at once. Defaults to 32.
+
+    Returns
+    -------
+    W : np.array, shape (n_chans, n_chans)
+        Whitener C^-1/2 diag(1 / scale), where C is the shrunk covariance
+        of the scaled channels, such that np.dot(W, x) has an identity noise
+        covariance. Unlike C^-1/2, it is not symmetric.
+    """
+    from sklearn.covariance import ledoit_wolf
+    n_trials, n_chans, _ = X.shape
+    noise = np.concatenate(
+        [np.asarray(X[start:start + chunk_size][:, :, baseline], dtype=float)
+         for start in range(0, n_trials, chunk_size)])
+    noise = noise.transpose(0, 2, 1).reshape(-1, n_chans)
+    scale = noise.std(axis=0)
+    scale[scale == 0] = 1.
+    cov, _ = ledoit_wolf(noise / scale)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    W = np.dot(eigvecs / np.sqrt(eigvals), eigvecs.T) / scale
+    return W.astype(X.dtype)
+
+
+def apply_whitener(X, W, chunk_size=32):
+    """Apply a spatial operator to all trials and times, in place.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_chans, n_times)
+        Data, overwritten.
+    W : np.array, shape (n_chans, n_chans)
+        Operator (see fit_whitener).
+    chunk_size : int
+        Number of trials transformed at once, which bounds the temporary
+        memory. Defaults to 32.
+
+    Returns
+    -------
+    X : np.array, shape (n_trials, n_chans, n_times)
+    """
+    for start in range(0, len(X), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        X[chunk] = np.tensordot(W, X[chunk], axes=([1], [1])).transpose(
+            1, 0, 2)
+    return X
+
+
+def whiten_epochs(epochs, tmin=None, tmax=0.):
+    """Whiten the sensors with the noise covariance of the baseline.
+
+    Parameters
+    ----------
+    epochs : Epochs
+    tmin : None | float
+        Start of the baseline, in seconds. Defaults to the first sample.
+    tmax : float
+        End of the baseline, in seconds. Defaults to 0.
+
+    Returns
+    -------
+    epochs : Epochs
+        The whitened epochs, with the whitener in epochs.whitener_.
+    """
+    times = epochs.times
+    tol = .5 / epochs.info['sfreq']
+    tmin = times[0] if tmin is None else tmin
+    baseline = np.where((times >= tmin - tol) & (times <= tmax + tol))[0]
+    if len(baseline) < 2:
+        raise ValueError('No baseline between tmin=%s and tmax=%s' % (
+            tmin, tmax))
+    W = fit_whitener(epochs._data, baseline)
+    epochs._data = apply_whitener(epochs._data, W)
+    epochs.whitener_ = W
+    return epochs
+
+
+def test_whitener():
+    from nose.tools import assert_true
+    rng = np.random.RandomState(0)
+    n_trials, n_chans, n_times = 50, 6, 40
+    # correlated noise, on channels of different scales
+    scales = np.r_[1e-13, 1e-13, [1e-11] * 4]
+    mixing = rng.randn(n_chans, n_chans) * scales[:, None]
+    X = np.einsum('ij,tjs->tis', mixing,
+                  rng.randn(n_trials, n_chans, n_times))
+    X = X.astype(np.float32)
+    W = fit_whitener(X, slice(0, 20))
+    X_ = apply_whitener(X.copy(), W, chunk_size=7)
+    assert_true(X_.dtype == np.float32)
+    np.testing.assert_allclose(
+        X_, np.einsum('ij,tjs->tis', W, X), rtol=1e-4, atol=1e-4)
+    # the whitened noise is decorrelated and of unit variance
+    cov = np.cov(X_.transpose(1, 0, 2).reshape(n_chans, -1))
+    np.testing.assert_allclose(cov, np.eye(n_chans), atol=.2)
+    raw_cov = np.cov(X.transpose(1, 0, 2).reshape(n_chans, -1))
+    raw_corr = raw_cov / np.sqrt(np.outer(np.diag(raw_cov),
+                                          np.diag(raw_cov)))
+    assert_true(np.max(np.abs(raw_corr - np.eye(n_chans))) > .2)
+
+
+def window_epochs(epochs, length, stride=1, method='average'):
+    """Decode sliding windows instead of single samples.
+
+    Parameters
+    ----------
+    epochs : Epochs
+    length : float
+        Duration of the windows, in seconds.
+    stride : int
+        Number of samples between two consecutive windows. Defaults to 1.
+    method : 'average' | 'embed'
+        'average' averages each channel over the window. 'embed' stacks the
+        samples of the window as channels (see delay_embedding), named
+        '%s_%i' % (ch_name, lag). Defaults to 'average'.
+
+    Returns
+    -------
+    epochs : Epochs
+        The times are the centers of the windows.
+    """
+    sfreq = float(epochs.info['sfreq'])
+    n_window = max(1, int(round(length * sfreq)))
+    if method == 'average':
+        windows = sliding_window(epochs._data, n_window, stride)
+        epochs._data = windows.mean(axis=-1)
+    elif method == 'embed':
+        epochs._data = delay_embedding(epochs._data, n_window, stride)
+        info = epochs.info
+        info['chs'] = [dict(ch, ch_name='%s_%i' % (ch['ch_name'], lag))
+                       for lag in range(n_window) for ch in info['chs']]
+        info['ch_names'] = [ch['ch_name'] for ch in info['chs']]
+        info['nchan'] = len(info['chs'])
+    else:
+        raise ValueError('Unknown window method %s' % method)
+    # update metadata
+    n_windows = epochs._data.shape[2]
+    epochs.info['sfreq'] = sfreq / stride
+    epochs.times = (epochs.times[::stride][:n_windows] +
+                    (n_window - 1) / 2. / sfreq)
+    return epochs
+
+
+def test_sliding_window():
+    from nose.tools import assert_equal, assert_true, assert_raises
+    X = np.random.RandomState(0).randn(4, 3, 50).astype(np.float32)
+    for n_window, stride in ((1, 1), (5, 1), (5, 2), (4, 3)):
+        n_windows = (50 - n_window) // stride + 1
+        windows = sliding_window(X, n_window, stride)
+        assert_equal(windows.shape, (4, 3, n_windows, n_window))
+        assert_true(np.may_share_memory(windows, X))
+        for ii in (0, n_windows - 1):
+            start = ii * stride
+            np.testing.assert_array_equal(
+                windows[:, :, ii], X[:, :, start:start + n_window])
+        # time-major data is embedded without copy
+        X_ = np.ascontiguousarray(X.transpose(0, 2, 1)).transpose(0, 2, 1)
+        embedded = delay_embedding(X_, n_window, stride)
+        assert_equal(embedded.shape, (4, n_window * 3, n_windows))
+        assert_true(np.may_share_memory(embedded, X_))
+        for lag in range(n_window):
+            np.testing.assert_array_equal(
+                embedded[:, lag * 3:(lag + 1) * 3],
+                X[:, :, lag:lag + stride * (n_windows - 1) + 1:stride])
+        np.testing.assert_array_equal(embedded,
+                                      delay_embedding(X, n_window, stride))
+    assert_raises(ValueError, sliding_window, X, 51)
+
+
+def test_plan_preprocessing():
+    from nose.tools import assert_equal, assert_true
+    sfreq, tmin, n_times = 1000., -.2, 1401
+    times = np.arange(n_times) / sfreq + tmin
+    X = np.tile(np.sin(2 * np.pi * 10 * times), [4, 3, 1]).astype(np.float32)
+    X += np.random.RandomState(0).randn(*X.shape).astype(np.float32)
+    # resampling and decimation are fused
+    plan, _ = plan_preprocessing(dict(resample=500., decim=2), sfreq, tmin,
+                                 n_times)
+    assert_equal([(step['name'], step['up'], step['down'])
+                  for step in plan], [('resample', 1, 4)])
+    for preproc in (dict(decim=4, crop=dict(tmin=-.1, tmax=.3)),
+                    dict(resample=600., crop=dict(tmin=0., tmax=.5)),
+                    dict(crop=dict(tmin=-.1, tmax=.3)),
+                    dict(decim=4, crop=dict(tmin=0., tmax=.3),
+                         baseline=dict(tmin=-.1, tmax=0.)),
+                    dict(crop=dict(tmin=0., tmax=.3),
+                         baseline=dict(tmin=None, tmax=0.))):
+        plan, cost = plan_preprocessing(preproc, sfreq, tmin, n_times,
+                                        n_signals=12)
+        naive_plan, naive_cost = plan_preprocessing(
+            preproc, sfreq, tmin, n_times, n_signals=12, reorder=False)
+        assert_true(cost['flops'] <= naive_cost['flops'])
+        assert_true(cost['bytes'] <= naive_cost['bytes'])
+        # same samples and same values, as the crop leaves room for the
+        # filter
+        for key in ('sfreq', 'tmin', 'n_times'):
+            np.testing.assert_allclose(plan[-1][key], naive_plan[-1][key],
+                                       atol=1e-9)
+        Y = apply_plan(X.copy(), plan)
+        assert_equal(Y.shape, (4, 3, plan[-1]['n_times']))
+        np.testing.assert_allclose(Y, apply_plan(X.copy(), naive_plan),
+                                   atol=1e-5)
+        assert_true(len(report_plan(plan, cost)))
+    # nothing to do
+    assert_equal(plan_preprocessing(dict(), sfreq, tmin, n_times)[0], [])
+    # by chunks of trials
+    plan, _ = plan_preprocessing(dict(decim=4, crop=dict(tmin=0., tmax=.3),
+                                      baseline=dict(tmin=None, tmax=0.)),
+                                 sfreq, tmin, n_times)
+    out = np.zeros((4, 3, plan[-1]['n_times']), np.float32)
+    apply_plan_chunked(lambda sel: X[sel], 4, plan, out, chunk_size=3)
+    np.testing.assert_allclose(out, apply_plan(X.copy(), plan), atol=1e-6)
+
 # DECODING ####################################################################
 
 
@@ -460,7 +1238,7 @@ def repeated_spearman(X, y, dtype=None):
     return repeated_corr(X, y, dtype=type(y[0]))
 
 
-def repeated_corr(X, y, dtype=float):
+def repeated_corr(X, y, dtype=None):
     """Computes pearson correlations between a vector and a matrix.
 
     Adapted from Jona-Sassenhagen's PR #L1772 on mne-python.
@@ -473,6 +1251,8 @@ def repeated_corr(X, y, dtype=float):
             Data matrix onto which the vector is correlated.
         dtype : type, optional
             Data type used to compute correlation values to optimize memory.
+            Defaults to the precision of X if it is a float array, and to
+            float otherwise.
 
     Returns
     -------
@@ -484,6 +1264,11 @@ def repeated_corr(X, y, dtype=float):
                          'number of rows.')
     if X.ndim == 1:
         X = X[:, None]
+    if dtype is None:
+        dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else float
+    if np.issubdtype(X.dtype, np.floating):
+        # avoid upcasting X in the dot product
+        y = np.asarray(y, dtype=X.dtype)
     y -= np.array(y.mean(0), dtype=dtype)
     X -= np.array(X.mean(0), dtype=dtype)
     y_sd = y.std(0, ddof=1)
@@ -525,3 +1310,490 @@ def test_corr(old_func, new_func, sel_item):
     for dim in range(n_dims):
         rho_slow[dim] = np.array(old_func(X[:, dim], y)).item(sel_item)
     np.testing.assert_array_almost_equal(rho_fast, rho_slow)
+
+
+def test_float32_precision():
+    """The single precision path must stay close to the double one"""
+    from nose.tools import assert_equal
+    n_obs, n_dims = 200, 50
+    y = np.linspace(0, 1, n_obs)
+    rng = np.random.RandomState(0)
+    X = np.tile(y, [n_dims, 1]).T + rng.randn(n_obs, n_dims)
+    # correlation
+    rho32 = repeated_corr(X.astype(np.float32), y.copy())
+    rho64 = repeated_corr(X.copy(), y.copy())
+    assert_equal(rho32.dtype, np.float32)
+    np.testing.assert_allclose(rho32, rho64, atol=1e-5)
+    # binary contrast
+    y2 = np.array(y > .5, dtype=float)
+    diff32 = _default_analysis(X.astype(np.float32), y2)
+    diff64 = _default_analysis(X, y2)
+    assert_equal(diff32.dtype, np.float32)
+    np.testing.assert_allclose(diff32, diff64, atol=1e-5)
+
+# CACHE #######################################################################
+
+
+def file_signature(fname):
+    """Identify a file by its absolute path, modification time and size"""
+    import os
+    stat = os.stat(fname)
+    return (os.path.abspath(fname), stat.st_mtime, stat.st_size)
+
+
+def cache_call(func, fname, cache_fname=None, depends=(), **kwargs):
+    """Call func(fname, **kwargs) and cache its result on disk.
+
+    The result is pickled next to fname together with the signature of fname
+    (path, modification time and size), kwargs and the code of func (see
+    code_signature). It is recomputed as soon as any of them changes.
+
+    Parameters
+    ----------
+    func : function
+        Parses fname. Must be of the form func(fname, **kwargs).
+    fname : str
+        File parsed by func.
+    cache_fname : None | str
+        Cache file. Defaults to fname + '.' + func.__name__ + a hash of
+        kwargs + '.cache', so that each kwargs has its own cache.
+    depends : list of function
+        Other functions whose code the result depends on, e.g. those called
+        by func. Defaults to ().
+
+    Returns
+    -------
+    out : the output of func(fname, **kwargs)
+    """
+    import os
+    import pickle
+    params = sorted(kwargs.items())
+    if cache_fname is None:
+        cache_fname = '%s.%s.%s.cache' % (fname, func.__name__,
+                                          hash_key(params)[:8])
+    key = (file_signature(fname), params, code_signature(func, *depends))
+    if os.path.exists(cache_fname):
+        try:
+            with open(cache_fname, 'rb') as f:
+                cached_key, out = pickle.load(f)
+            if cached_key == key:
+                return out
+        except (EOFError, pickle.UnpicklingError):
+            pass  # corrupted cache: recompute it
+    out = func(fname, **kwargs)
+    # Write to a temporary file first, so that concurrent jobs never read a
+    # partial cache
+    tmp_fname = '%s.%i.tmp' % (cache_fname, os.getpid())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            pickle.dump((key, out), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, cache_fname)
+    except (IOError, OSError):
+        pass  # read-only data directory: simply don't cache
+    return out
+
+
+def test_cache_call():
+    import os
+    import glob
+    import tempfile
+    from nose.tools import assert_equal
+    calls = list()
+
+    def _count_lines(fname, offset=0):
+        calls.append(fname)
+        with open(fname, 'r') as f:
+            return len(f.readlines()) + offset
+
+    fname = tempfile.mktemp()
+    with open(fname, 'w') as f:
+        f.write('a\nb\n')
+    # compute once, then reuse
+    assert_equal(cache_call(_count_lines, fname), 2)
+    assert_equal(cache_call(_count_lines, fname), 2)
+    assert_equal(len(calls), 1)
+    # different parameters are recomputed, and cached separately
+    assert_equal(cache_call(_count_lines, fname, offset=1), 3)
+    assert_equal(len(calls), 2)
+    assert_equal(cache_call(_count_lines, fname), 2)
+    assert_equal(len(calls), 2)
+    # so is a different code
+    assert_equal(cache_call(_count_lines, fname, depends=[file_signature]),
+                 2)
+    assert_equal(len(calls), 3)
+    # modified file is recomputed
+    with open(fname, 'a') as f:
+        f.write('c\n')
+    assert_equal(cache_call(_count_lines, fname), 3)
+    assert_equal(len(calls), 4)
+    for cache_fname in glob.glob(fname + '*'):
+        os.remove(cache_fname)
+
+
+def hash_key(*items):
+    """Content hash of json-serializable items, e.g. parameter dicts"""
+    import json
+    import hashlib
+    content = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def code_signature(*funcs):
+    """Hash of the source code of functions, to invalidate caches when the
+    code producing them changes"""
+    import inspect
+    return hash_key(*[inspect.getsource(func) for func in funcs])
+
+
+def _tmp_suffix():
+    """Suffix of the temporary files of this process, named after the host
+    and the pid so that cache_evict can recognize orphans"""
+    import os
+    import socket
+    return '.%s.%i.tmp' % (socket.gethostname().split('.')[0], os.getpid())
+
+
+def _is_orphan(fname, max_age):
+    """Whether a temporary file of the cache was left by a killed job: its
+    process is gone from this host, or it is older than max_age seconds"""
+    import os
+    import time
+    import errno
+    import socket
+    try:
+        _, host, pid, _ = os.path.basename(fname).rsplit('.', 3)
+        pid = int(pid)
+    except ValueError:
+        host, pid = None, None
+    if host == socket.gethostname().split('.')[0]:
+        try:
+            os.kill(pid, 0)
+        except OSError as error:
+            if error.errno == errno.ESRCH:
+                return True
+    return time.time() - os.path.getmtime(fname) > max_age
+
+
+def cache_save(key, data, meta, cache_dir, max_bytes=None):
+    """Save an array and its metadata in a size-bounded cache directory.
+
+    Parameters
+    ----------
+    key : str
+        Identifier of the entry, e.g. from hash_key().
+    data : np.array
+        The data saved as key.npy.
+    meta : object
+        Small picklable metadata saved as key.pickle.
+    cache_dir : str
+        Cache directory. Created if necessary.
+    max_bytes : None | float
+        Maximum size of the cache. The least recently used entries are
+        removed to fit in it. Defaults to None (unbounded).
+    """
+    import os
+    import pickle
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    fname = os.path.join(cache_dir, key)
+    # Write to temporary files first, so that concurrent jobs never read a
+    # partial entry. The data is renamed last as it marks a valid entry.
+    tmp = _tmp_suffix()
+    with open(fname + '.pickle' + tmp, 'wb') as f:
+        pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+    if (isinstance(data, np.memmap) and data.filename is not None and
+            os.path.samefile(data.filename, fname + '.npy' + tmp)):
+        # preallocated by cache_memmap: already written
+        data.flush()
+    else:
+        with open(fname + '.npy' + tmp, 'wb') as f:
+            np.save(f, data)
+    os.rename(fname + '.pickle' + tmp, fname + '.pickle')
+    os.rename(fname + '.npy' + tmp, fname + '.npy')
+    if max_bytes is not None:
+        cache_evict(cache_dir, max_bytes)
+
+
+def cache_memmap(key, shape, dtype, cache_dir):
+    """Preallocate the data of a cache entry in a memory-mapped file, to fill
+    it out of core before committing it with cache_save.
+
+    Parameters
+    ----------
+    key : str
+        Identifier of the entry.
+    shape : tuple
+        Shape of the data.
+    dtype : type
+        Type of the data.
+    cache_dir : str
+        Cache directory. Created if necessary.
+
+    Returns
+    -------
+    data : np.memmap
+    """
+    import os
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    fname = os.path.join(cache_dir, key + '.npy' + _tmp_suffix())
+    return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                     shape=tuple(shape))
+
+
+def cache_load(key, cache_dir, mmap_mode=None):
+    """Load an entry saved with cache_save.
+
+    Parameters
+    ----------
+    key : str
+        Identifier of the entry.
+    cache_dir : str
+        Cache directory.
+    mmap_mode : None | 'r' | 'r+' | 'c'
+        Memory-map the data instead of reading it (see np.load). Defaults to
+        None.
+
+    Returns
+    -------
+    data : None | np.array
+        None if the entry is not in the cache.
+    meta : None | object
+    """
+    import os
+    import pickle
+    fname = os.path.join(cache_dir, key)
+    if not os.path.exists(fname + '.npy'):
+        return None, None
+    try:
+        # mark the entry as recently used
+        os.utime(fname + '.npy', None)
+        with open(fname + '.pickle', 'rb') as f:
+            meta = pickle.load(f)
+        return np.load(fname + '.npy', mmap_mode=mmap_mode), meta
+    except (IOError, OSError):
+        return None, None  # evicted meanwhile
+
+
+def cache_evict(cache_dir, max_bytes, max_tmp_age=86400.):
+    """Remove the least recently used cache entries until the cache
+    directory holds less than max_bytes. Entries removed meanwhile, e.g. by
+    another thread evicting the same directory, are skipped.
+
+    The temporary files left by killed jobs (e.g. the preallocation of
+    cache_memmap) are removed: those of a process that is gone from this
+    host, and those older than max_tmp_age seconds. The temporary files of
+    running jobs count towards max_bytes."""
+    import os
+    entries = list()
+    total = 0
+    for fname in os.listdir(cache_dir):
+        if fname.endswith('.tmp'):
+            fname = os.path.join(cache_dir, fname)
+            try:
+                if _is_orphan(fname, max_tmp_age):
+                    os.remove(fname)
+                else:
+                    total += os.path.getsize(fname)
+            except OSError:
+                pass
+            continue
+        if not fname.endswith('.npy'):
+            continue
+        fname = os.path.join(cache_dir, fname[:-4])
+        try:
+            size = sum(os.path.getsize(fname + ext)
+                       for ext in ('.npy', '.pickle')
+                       if os.path.exists(fname + ext))
+            entries.append((os.path.getmtime(fname + '.npy'), size, fname))
+        except OSError:
+            continue
+    total += sum(size for _, size, _ in entries)
+    for _, size, fname in sorted(entries):
+        if total <= max_bytes:
+            break
+        for ext in ('.npy', '.pickle'):
+            try:
+                os.remove(fname + ext)
+            except OSError:
+                pass
+        total -= size
+
+
+def test_cache_save_load():
+    import os
+    import time
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal, assert_true
+    cache_dir = tempfile.mkdtemp()
+    # keys depend on content only
+    assert_equal(hash_key(dict(a=1, b=[2, 3])), hash_key(dict(b=[2, 3], a=1)))
+    assert_true(hash_key(dict(a=1)) != hash_key(dict(a=2)))
+    # missing entry
+    assert_equal(cache_load('none', cache_dir), (None, None))
+    # round trip
+    data = np.random.randn(10, 100).astype(np.float32)
+    cache_save('a', data, dict(sfreq=100.), cache_dir)
+    data_, meta = cache_load('a', cache_dir)
+    np.testing.assert_array_equal(data, data_)
+    assert_equal(meta, dict(sfreq=100.))
+    # least recently used entries are evicted first
+    time.sleep(.01)
+    cache_save('b', data, None, cache_dir)
+    time.sleep(.01)
+    cache_load('a', cache_dir)
+    cache_save('c', data, None, cache_dir, max_bytes=2.5 * data.nbytes)
+    assert_true(os.path.exists(os.path.join(cache_dir, 'a.npy')))
+    assert_true(not os.path.exists(os.path.join(cache_dir, 'b.npy')))
+    assert_true(os.path.exists(os.path.join(cache_dir, 'c.npy')))
+    # entries filled out of core
+    data_ = cache_memmap('d', data.shape, data.dtype, cache_dir)
+    data_[:5], data_[5:] = data[:5], data[5:]
+    cache_save('d', data_, None, cache_dir)
+    del data_
+    data_, _ = cache_load('d', cache_dir, mmap_mode='r')
+    assert_true(isinstance(data_, np.memmap))
+    np.testing.assert_array_equal(data, data_)
+    assert_equal(len([f for f in os.listdir(cache_dir) if 'tmp' in f]), 0)
+    del data_
+    # the preallocations of killed jobs are evicted, not those of running
+    # ones
+    import socket
+    import subprocess
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    host = socket.gethostname().split('.')[0]
+    tmp_fnames = dict(
+        (name, os.path.join(cache_dir, 'f.npy.%s.%i.tmp' % (host_, pid)))
+        for name, host_, pid in (('dead', host, dead.pid),
+                                 ('alive', host, os.getpid()),
+                                 ('remote', 'other-host', 1),
+                                 ('old', 'other-host', 2)))
+    for fname in tmp_fnames.values():
+        with open(fname, 'wb') as f:
+            np.save(f, data)
+    os.utime(tmp_fnames['old'], (time.time() - 7200,) * 2)
+    cache_evict(cache_dir, 1e9, max_tmp_age=3600)
+    assert_equal(sorted(name for name, fname in tmp_fnames.items()
+                        if os.path.exists(fname)), ['alive', 'remote'])
+    # and the others count towards the cache size
+    cache_evict(cache_dir, 2.5 * data.nbytes)
+    assert_true(not os.path.exists(os.path.join(cache_dir, 'a.npy')))
+    for fname in tmp_fnames.values():
+        if os.path.exists(fname):
+            os.remove(fname)
+    # concurrent evictions, e.g. of the prefetch and the main threads, skip
+    # the entries removed by the other
+    from threading import Thread
+    for ii in range(20):
+        cache_save('e%i' % ii, data[:1], None, cache_dir)
+    errors = list()
+
+    def _evict():
+        try:
+            cache_evict(cache_dir, 0)
+        except Exception as error:
+            errors.append(error)
+    threads = [Thread(target=_evict) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(errors, list())
+    assert_equal(os.listdir(cache_dir), list())
+    shutil.rmtree(cache_dir)
+
+# PREFETCH ####################################################################
+
+
+def prefetch(func, iterable, n_prefetch=1):
+    """Iterate over func(*args), computing the next items in a background
+    thread while the current one is being used.
+
+    Parameters
+    ----------
+    func : function
+        Typically loads and preprocesses data.
+    iterable : iterable of tuples
+        Arguments of each call to func.
+    n_prefetch : int
+        Maximum number of items computed ahead of the one being used.
+        Defaults to 1.
+
+    Yields
+    ------
+    args : tuple
+        The arguments of the call.
+    out : the output of func(*args)
+    """
+    import threading
+    try:
+        from queue import Queue
+    except ImportError:
+        from Queue import Queue
+    queue = Queue()
+    slots = threading.Semaphore(n_prefetch + 1)
+    stop = threading.Event()
+    end = object()
+
+    def _worker():
+        for args in iterable:
+            # wait until the consumer has freed a slot
+            slots.acquire()
+            if stop.is_set():
+                return
+            try:
+                queue.put((args, func(*args), None))
+            except Exception as error:
+                queue.put((args, None, error))
+                return
+        queue.put(end)
+
+    thread = threading.Thread(target=_worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end:
+                return
+            args, out, error = item
+            if error is not None:
+                raise error
+            yield args, out
+            # the consumer is done with this item
+            del item, out
+            slots.release()
+    finally:
+        # unblock the worker if the consumer stopped early
+        stop.set()
+        slots.release()
+
+
+def test_prefetch():
+    import time
+    from nose.tools import assert_equal, assert_raises
+    loaded = list()
+
+    def _load(ii, jj):
+        time.sleep(.01)
+        loaded.append(ii)
+        if ii == 10:
+            raise RuntimeError('cannot load')
+        return ii * jj
+
+    # order and results are kept
+    items = [(ii, 2) for ii in range(5)]
+    out = [(args, value) for args, value in prefetch(_load, items)]
+    assert_equal(out, [(args, args[0] * 2) for args in items])
+
+    # the number of items loaded ahead is bounded
+    del loaded[:]
+    for args, value in prefetch(_load, items, n_prefetch=2):
+        time.sleep(.05)
+        assert len(loaded) <= args[0] + 3
+
+    # errors are raised in the main thread
+    iterator = prefetch(_load, [(10, 1)])
+    assert_raises(RuntimeError, list, iterator)
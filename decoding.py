@@ -0,0 +1,1918 @@
+import numpy as np
+
+from base import cache_load, cache_save, hash_key
+
+
+# FOLDS #######################################################################
+
+
+def cv_folds(y, cv=5, classifier=False):
+    """Train and test trials of each cross-validation fold.
+
+    Parameters
+    ----------
+    y : np.array, shape (n_trials,)
+        Targets.
+    cv : int | list of (train, test)
+        Number of folds, or the folds themselves. Defaults to 5.
+    classifier : bool
+        If True, each class is split evenly across folds (stratified folds).
+        Defaults to False.
+
+    Returns
+    -------
+    folds : list of (train, test)
+        Sorted trial indices.
+    """
+    if not isinstance(cv, int):
+        return [(np.asarray(train), np.asarray(test)) for train, test in cv]
+    n_trials = len(y)
+    if classifier:
+        chunks = [np.array_split(np.where(y == value)[0], cv)
+                  for value in np.unique(y)]
+        tests = [np.sort(np.hstack([chunk[fold] for chunk in chunks]))
+                 for fold in range(cv)]
+    else:
+        tests = np.array_split(np.arange(n_trials), cv)
+    folds = list()
+    for test in tests:
+        train = np.setdiff1d(np.arange(n_trials), test)
+        folds.append((train, test.astype(int)))
+    return folds
+
+
+class FoldCache(object):
+    """Memoize the fold-level computations shared by several decoders.
+
+    The entries are identified by the data, a name (the computation and its
+    parameters) and the trials they are estimated from, so that decoders
+    fitted on the same training trials reuse them.
+
+    Parameters
+    ----------
+    key : object
+        Json-serializable identifier of the data, e.g.
+        (subject, data_type, preproc).
+    cache_dir : None | str
+        Directory in which the entries are also saved (see base.cache_save).
+        Defaults to None (in memory only).
+    max_bytes : None | float
+        Maximum size of the cache directory. Defaults to None (unbounded).
+    """
+    def __init__(self, key=None, cache_dir=None, max_bytes=None):
+        self.key = key
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = dict()
+
+    def get(self, name, trials, func, *args, **kwargs):
+        """Return func(*args), computed once per name and trials.
+
+        Parameters
+        ----------
+        name : object
+            Json-serializable identifier of the computation.
+        trials : np.array
+            Identifiers of the trials the computation depends on.
+        func : function
+            Returns a tuple (data, meta): an array and small picklable
+            metadata.
+        persist : bool
+            If False, the entry is only kept in memory, e.g. for data that is
+            cheaper to recompute than to save. Defaults to True.
+
+        Returns
+        -------
+        data : np.array
+        meta : object
+        """
+        persist = kwargs.get('persist', True) and self.cache_dir is not None
+        key = hash_key(self.key, name, np.asarray(trials).tolist())
+        if key not in self._entries and persist:
+            data, meta = cache_load(key, self.cache_dir)
+            if data is not None:
+                self._entries[key] = data, meta
+        if key not in self._entries:
+            data, meta = func(*args)
+            if persist:
+                cache_save(key, data, meta, self.cache_dir,
+                           max_bytes=self.max_bytes)
+            self._entries[key] = data, meta
+        return self._entries[key]
+
+    def clear(self):
+        """Release the entries held in memory; the saved ones remain on
+        disk."""
+        self._entries = dict()
+
+
+def test_cv_folds():
+    from nose.tools import assert_equal, assert_true
+    y = np.r_[np.zeros(13), np.ones(7)]
+    for classifier in (False, True):
+        folds = cv_folds(y, 4, classifier=classifier)
+        assert_equal(len(folds), 4)
+        np.testing.assert_array_equal(
+            np.sort(np.hstack([test for _, test in folds])), np.arange(20))
+        for train, test in folds:
+            assert_equal(len(np.intersect1d(train, test)), 0)
+            assert_equal(len(train) + len(test), 20)
+            if classifier:
+                assert_true(np.sum(y[test]) in (1, 2))
+
+
+def test_fold_cache():
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal
+    calls = list()
+
+    def _func(value):
+        calls.append(value)
+        return np.arange(3) * value, dict(value=value)
+
+    cache_dir = tempfile.mkdtemp()
+    cache = FoldCache('data', cache_dir=cache_dir)
+    data, meta = cache.get('a', [1, 2], _func, 2)
+    np.testing.assert_array_equal(data, [0, 2, 4])
+    assert_equal(meta, dict(value=2))
+    # computed once per name and trials
+    cache.get('a', np.array([1, 2]), _func, 2)
+    cache.get('a', [1, 3], _func, 2)
+    cache.get('b', [1, 2], _func, 2)
+    assert_equal(len(calls), 3)
+    # and reused from disk by other caches on the same data
+    FoldCache('data', cache_dir=cache_dir).get('a', [1, 2], _func, 2)
+    assert_equal(len(calls), 3)
+    FoldCache('other', cache_dir=cache_dir).get('a', [1, 2], _func, 2)
+    assert_equal(len(calls), 4)
+    # in-memory entries are lost when cleared
+    cache.get('c', [1, 2], _func, 2, persist=False)
+    cache.clear()
+    cache.get('a', [1, 2], _func, 2)
+    cache.get('c', [1, 2], _func, 2, persist=False)
+    assert_equal(len(calls), 6)
+    shutil.rmtree(cache_dir)
+
+
+# REDUCTION ###################################################################
+
+
+def fit_reduction(X, n_components, whiten=False, chunk_size=32):
+    """Principal components of the sensors, pooled over trials and times.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_chans, n_times)
+        Training data.
+    n_components : int
+        Number of components kept.
+    whiten : bool
+        If True, the components are scaled to unit variance. Defaults to
+        False.
+    chunk_size : int
+        Number of trials accumulated at once. Defaults to 32.
+
+    Returns
+    -------
+    components : np.array, shape (n_chans, n_components)
+        Projection, such that the reduced data is np.dot(x - mean,
+        components).
+    mean : np.array, shape (n_chans,)
+        Mean of the sensors.
+    """
+    n_trials, n_chans, n_times = X.shape
+    # accumulate the covariance by chunks of trials to avoid a copy of X
+    cov = np.zeros((n_chans, n_chans))
+    mean = np.zeros(n_chans)
+    for start in range(0, n_trials, chunk_size):
+        chunk = np.asarray(X[start:start + chunk_size], dtype=float)
+        cov += np.tensordot(chunk, chunk, axes=([0, 2], [0, 2]))
+        mean += chunk.sum(axis=2).sum(axis=0)
+    n_samples = float(n_trials * n_times)
+    mean /= n_samples
+    cov = cov / n_samples - np.outer(mean, mean)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    order = np.argsort(eigvals)[::-1][:n_components]
+    components = eigvecs[:, order]
+    if whiten:
+        components /= np.sqrt(np.maximum(eigvals[order], 1e-30))
+    return components.astype(X.dtype), mean.astype(X.dtype)
+
+
+def apply_reduction(X, components, mean):
+    """Project data on components (see fit_reduction).
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_chans, n_times)
+    components : np.array, shape (n_chans, n_components)
+    mean : np.array, shape (n_chans,)
+
+    Returns
+    -------
+    X : np.array, shape (n_trials, n_components, n_times)
+    """
+    # one matrix product for all trials and times
+    X = np.tensordot(components, X, axes=([0], [1])).transpose(1, 0, 2)
+    X -= np.dot(mean, components)[None, :, None]
+    return np.ascontiguousarray(X)
+
+
+def test_reduction():
+    from nose.tools import assert_equal
+    rng = np.random.RandomState(0)
+    n_trials, n_chans, n_times = 30, 10, 20
+    sources = rng.randn(n_trials, 3, n_times) * np.array([10, 5, 2])[:, None]
+    mixing = rng.randn(n_chans, 3)
+    X = np.einsum('cs,ist->ict', mixing, sources) + 3.
+    X += .01 * rng.randn(n_trials, n_chans, n_times)
+    for whiten in (False, True):
+        components, mean = fit_reduction(X, 3, whiten=whiten, chunk_size=7)
+        assert_equal(components.shape, (n_chans, 3))
+        X_ = apply_reduction(X, components, mean)
+        assert_equal(X_.shape, (n_trials, 3, n_times))
+        # identical to a projection of the centered samples
+        samples = X.transpose(0, 2, 1).reshape(-1, n_chans)
+        np.testing.assert_allclose(
+            X_.transpose(0, 2, 1).reshape(-1, 3),
+            np.dot(samples - samples.mean(0), components), atol=1e-8)
+        cov = np.cov(X_.transpose(1, 0, 2).reshape(3, -1), bias=True)
+        if whiten:
+            np.testing.assert_allclose(cov, np.eye(3), atol=1e-8)
+        else:
+            # the components capture the variance of the sources
+            assert_equal(np.argsort(np.diag(cov))[::-1].tolist(), [0, 1, 2])
+    np.testing.assert_allclose(np.trace(cov), 3)
+
+
+# LINEAR MODELS ###############################################################
+
+
+def linear_spec(clf):
+    """Describe a linear estimator for the batched solvers (see fit_linear).
+
+    Parameters
+    ----------
+    clf : sklearn estimator
+        A Ridge, LogisticRegression, LinearSVR or
+        orientations.utils.SVR_angle, possibly after a StandardScaler in a
+        Pipeline.
+
+    Returns
+    -------
+    spec : None | dict
+        None if clf is not supported. Otherwise, the 'loss' ('ridge',
+        'logistic' or 'svr') and its parameters 'alpha', 'C', 'epsilon' and
+        'class_weight' (and 'tol' for the SVR), whether the
+        features are standardized ('scaler'), and how the decision values
+        are predicted ('output': 'value', 'label', 'proba', 'angle' or
+        'components').
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression, Ridge
+    from sklearn.svm import LinearSVR
+    from orientations.utils import clf_2class_proba, SVR_angle
+    scaler = False
+    if isinstance(clf, Pipeline):
+        steps = [step for _, step in clf.steps]
+        if isinstance(steps[0], StandardScaler):
+            if not (steps[0].with_mean and steps[0].with_std):
+                return None
+            scaler, steps = True, steps[1:]
+        if len(steps) != 1:
+            return None
+        clf = steps[0]
+    spec = dict(scaler=scaler, alpha=1., C=1., epsilon=0., class_weight=None)
+    if isinstance(clf, SVR_angle):
+        spec.update(loss=clf.solver, scaler=scaler or clf.scaler, C=clf.C,
+                    epsilon=clf.epsilon, alpha=clf.alpha, tol=clf.tol,
+                    output='components' if clf.components else 'angle')
+    elif (isinstance(clf, LinearSVR) and clf.fit_intercept and
+            clf.intercept_scaling == 1 and
+            clf.loss in ('l1', 'epsilon_insensitive')):
+        spec.update(loss='svr', output='value', C=clf.C,
+                    epsilon=clf.epsilon, tol=clf.tol)
+    elif (isinstance(clf, LogisticRegression) and clf.fit_intercept and
+            clf.penalty in ('l2', 'deprecated') and
+            not getattr(clf, 'l1_ratio', None)):
+        output = 'proba' if isinstance(clf, clf_2class_proba) else 'label'
+        spec.update(loss='logistic', output=output, C=clf.C,
+                    class_weight=clf.class_weight)
+    elif isinstance(clf, Ridge) and clf.fit_intercept:
+        spec.update(loss='ridge', output='value', alpha=clf.alpha)
+    else:
+        return None
+    return spec
+
+
+def fit_linear(X, y, loss='ridge', alpha=1., C=1., epsilon=0.,
+               sample_weight=None, tol=1e-4, max_iter=10000, chunk_size=64,
+               warm_start=False):
+    """Fit a linear model at each time sample, as one batched problem.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_features, n_times)
+        Training data.
+    y : np.array, shape (n_trials,) | (n_trials, n_targets)
+        Targets, in {-1, 1} for the logistic loss, which takes a single
+        target. The targets share the factorization of the ridge and the
+        Gram matrices of the SVR.
+    loss : 'ridge' | 'logistic' | 'svr'
+        'ridge' is a ridge regression of penalty alpha, solved in closed
+        form. 'logistic' is a logistic regression of inverse penalty C,
+        solved by Newton iterations. 'svr' is the epsilon-insensitive
+        support vector regression of sklearn's LinearSVR, solved by
+        accelerated proximal gradient on its dual. Defaults to 'ridge'.
+    alpha : float
+        Penalty of the ridge regression. Defaults to 1.
+    C : float
+        Inverse penalty of the logistic regression and of the SVR. Defaults
+        to 1.
+    epsilon : float
+        Insensitivity of the SVR. Defaults to 0.
+    sample_weight : None | np.array, shape (n_trials,)
+        Weights of the trials in the logistic loss. Defaults to None.
+    tol : float
+        Tolerance on the relative Newton step of the logistic regression,
+        and on the relative decrease of the gradient mapping of the SVR.
+        Defaults to 1e-4.
+    max_iter : int
+        Maximum number of iterations. Defaults to 10000.
+    chunk_size : int
+        Number of time samples solved at once, which bounds the memory.
+        Defaults to 64.
+    warm_start : bool
+        If True, the iterative solvers of each chunk of time samples start
+        from the solution of the time sample preceding the chunk, instead of
+        from zero. With chunk_size=1, the time samples are swept in order,
+        each starting from its predecessor. Defaults to False.
+
+    Returns
+    -------
+    coef : np.array, shape (n_times, n_features[, n_targets])
+    intercept : np.array, shape (n_times[, n_targets])
+    n_iter : np.array, shape (n_times,)
+        Number of iterations of each time sample, 0 in closed form.
+    """
+    n_trials, n_features, n_times = X.shape
+    y = np.asarray(y, dtype=float)
+    Y = y.reshape(n_trials, -1)
+    if loss == 'logistic' and Y.shape[1] != 1:
+        raise ValueError('The logistic loss takes a single target.')
+    coef = np.zeros((n_times, n_features, Y.shape[1]))
+    intercept = np.zeros((n_times, Y.shape[1]))
+    n_iter = np.zeros(n_times, int)
+    init = None
+    for start in range(0, n_times, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # time-major copy in double precision
+        X_ = np.asarray(X[:, :, chunk], dtype=float).transpose(2, 0, 1)
+        if loss == 'ridge':
+            out = _fit_ridge(X_, Y, alpha)
+        elif loss == 'logistic':
+            weight = np.ones(n_trials) if sample_weight is None else \
+                np.asarray(sample_weight, dtype=float)
+            out = _fit_logistic(X_, Y[:, 0], C, weight, tol, max_iter, init)
+            out = (out[0][:, :, None], out[1][:, None]) + out[2:]
+        elif loss == 'svr':
+            # the intercept of liblinear is a constant feature
+            gram = np.matmul(X_, X_.transpose(0, 2, 1)) + 1.
+            out = _fit_svr(gram, Y, C, epsilon, tol, max_iter, init)
+            out = (np.matmul(X_.transpose(0, 2, 1), out[0]),) + out[1:]
+        else:
+            raise ValueError('Unknown loss %s' % loss)
+        coef[chunk], intercept[chunk], n_iter[chunk], state = out
+        if warm_start and state is not None:
+            init = state[-1]
+    if y.ndim == 1:
+        coef, intercept = coef[:, :, 0], intercept[:, 0]
+    return coef, intercept, n_iter
+
+
+def _fit_ridge(X, Y, alpha):
+    """Ridge regressions of X, shape (n_times, n_trials, n_features), on Y,
+    shape (n_trials, n_targets), with an unpenalized intercept"""
+    n_times, n_trials, n_features = X.shape
+    X_mean, Y_mean = X.mean(axis=1), Y.mean(axis=0)
+    X = X - X_mean[:, None, :]
+    y = np.tile(Y - Y_mean, (n_times, 1, 1))
+    if n_trials < n_features:
+        # solve in the dual: coef = X' (XX' + alpha I)^-1 y
+        gram = np.matmul(X, X.transpose(0, 2, 1))
+        dual = _fit_kernel_ridge(gram, Y, alpha)[0]
+        coef = np.matmul(X.transpose(0, 2, 1), dual)
+    else:
+        cov = np.matmul(X.transpose(0, 2, 1), X) + alpha * np.eye(n_features)
+        coef = np.linalg.solve(cov, np.matmul(X.transpose(0, 2, 1), y))
+    intercept = Y_mean - np.sum(X_mean[:, :, None] * coef, axis=1)
+    return coef, intercept, np.zeros(n_times, int), None
+
+
+def _fit_logistic(X, y, C, weight, tol, max_iter, init=None):
+    """Newton iterations of logistic regressions of X, shape (n_times,
+    n_trials, n_features), with an unpenalized intercept, from the weights
+    init, shape (n_features + 1,)"""
+    from scipy.special import expit
+    n_times, n_trials, n_features = X.shape
+    X = np.concatenate((X, np.ones((n_times, n_trials, 1))), axis=2)
+    penalty = np.r_[np.ones(n_features) / C, 0.]
+    theta = np.zeros((n_times, n_features + 1))
+    if init is not None:
+        theta += init
+    n_iter = np.zeros(n_times, int)
+    active = np.arange(n_times)
+    for ii in range(max_iter):
+        X_, theta_ = X[active], theta[active]
+        margin = y * np.matmul(X_, theta_[:, :, None])[:, :, 0]
+        proba = expit(margin)
+        grad = penalty * theta_ - np.matmul(
+            X_.transpose(0, 2, 1), (weight * y * (1. - proba))[:, :, None]
+        )[:, :, 0]
+        hessian = np.matmul(X_.transpose(0, 2, 1) *
+                            (weight * proba * (1. - proba))[:, None, :], X_)
+        hessian += np.diag(penalty)
+        step = np.linalg.solve(hessian, grad[:, :, None])[:, :, 0]
+        # backtrack until the loss decreases enough, e.g. from a warm start
+        loss = _logistic_loss(X_, y, weight, penalty, theta_)
+        decrease = 1e-4 * np.sum(grad * step, axis=1)
+        length = np.ones(len(active))
+        for _ in range(30):
+            worse = _logistic_loss(X_, y, weight, penalty, theta_ - length[
+                :, None] * step) > loss - length * decrease
+            if not np.any(worse):
+                break
+            length[worse] /= 2.
+        step *= length[:, None]
+        theta[active] = theta_ - step
+        n_iter[active] = ii + 1
+        done = (np.max(np.abs(step), axis=1) <=
+                tol * np.maximum(1., np.max(np.abs(theta_), axis=1)))
+        active = active[~done]
+        if not len(active):
+            break
+    return theta[:, :-1], theta[:, -1], n_iter, theta
+
+
+def _logistic_loss(X, y, weight, penalty, theta):
+    """Penalized logistic loss of each time sample"""
+    margin = y * np.matmul(X, theta[:, :, None])[:, :, 0]
+    return (np.sum(weight * np.logaddexp(0., -margin), axis=1) +
+            .5 * np.sum(penalty * theta ** 2, axis=1))
+
+
+def _fit_svr(gram, Y, C, epsilon, tol, max_iter, init=None):
+    """Accelerated proximal gradient (FISTA) on the duals of L1-loss SVRs of
+    Gram matrices, shape (n_times, n_trials, n_trials), that include the
+    constant feature of the intercept, penalized as in liblinear, on Y, shape
+    (n_trials, n_targets), from the dual variables init, shape (n_trials,
+    n_targets)"""
+    n_times, n_trials, _ = gram.shape
+    lipschitz = np.linalg.eigvalsh(gram)[:, -1:, None]
+    beta = np.zeros((n_times, n_trials, Y.shape[1]))
+    # the tolerance is relative to the gradient mapping at zero, whatever
+    # the initialization
+    mapping_init = _svr_prox(Y / lipschitz, C, epsilon / lipschitz)
+    mapping_init = np.sum(np.abs(mapping_init), axis=1) * lipschitz[:, 0]
+    if init is not None:
+        beta += init
+    momentum, step = beta, np.ones((n_times, 1, 1))
+    n_iter = np.zeros(n_times, int)
+    converged = np.zeros(n_times, bool)
+    for ii in range(max_iter):
+        grad = np.matmul(gram, momentum) - Y
+        new = _svr_prox(momentum - grad / lipschitz, C, epsilon / lipschitz)
+        # relative decrease of the gradient mapping, as in liblinear
+        mapping = np.sum(np.abs(new - momentum), axis=1) * lipschitz[:, 0]
+        # adaptive restart of the momentum when it goes uphill
+        restart = np.sum((momentum - new) * (new - beta), axis=(1, 2)) > 0
+        step[restart] = 1.
+        step_ = (1. + np.sqrt(1. + 4. * step ** 2)) / 2.
+        momentum = new + (step - 1.) / step_ * (new - beta)
+        beta, step = new, step_
+        n_iter[~converged] = ii + 1
+        converged |= np.all(mapping <= tol * mapping_init, axis=1)
+        if np.all(converged):
+            break
+    return beta, np.sum(beta, axis=1), n_iter, beta
+
+
+def _svr_prox(beta, C, epsilon):
+    """Proximal operator of the SVR dual penalty: soft-thresholding by
+    epsilon and box constraint [-C, C]"""
+    beta = np.sign(beta) * np.maximum(np.abs(beta) - epsilon, 0.)
+    return np.clip(beta, -C, C)
+
+
+def gram_matrices(X, chunk_size=16):
+    """Gram matrices of the trials at each time sample.
+
+    Parameters
+    ----------
+    X : np.array, shape (n_trials, n_features, n_times)
+        Data.
+    chunk_size : int
+        Number of time samples computed at once, which bounds the memory of
+        the time-major copies. Defaults to 16.
+
+    Returns
+    -------
+    gram : np.array, shape (n_times, n_trials, n_trials)
+        The dot products of the trials, in double precision.
+    """
+    n_trials, _, n_times = X.shape
+    gram = np.empty((n_times, n_trials, n_trials))
+    for start in range(0, n_times, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        X_ = np.asarray(X[:, :, chunk], dtype=float).transpose(2, 0, 1)
+        gram[chunk] = np.matmul(X_, X_.transpose(0, 2, 1))
+    return gram
+
+
+def fit_kernel(gram, y, loss='ridge', alpha=1., C=1., epsilon=0., tol=1e-4,
+               max_iter=10000):
+    """Fit a linear model at each time sample in the dual, from the Gram
+    matrices of the training trials (see gram_matrices).
+
+    With fewer trials than features, the Gram matrices are cheaper to solve
+    than the features, and they are shared by all the targets of the same
+    trials. The weights of fit_linear on the same data X are
+    coef[t] = X[:, :, t].T.dot(dual[t]).
+
+    Parameters
+    ----------
+    gram : np.array, shape (n_times, n_trials, n_trials)
+        Gram matrices of the training trials.
+    y : np.array, shape (n_trials,) | (n_trials, n_targets)
+        Targets.
+    loss : 'ridge' | 'svr'
+        See fit_linear. Defaults to 'ridge'.
+    alpha : float
+        Penalty of the ridge regression. Defaults to 1.
+    C : float
+        Inverse penalty of the SVR. Defaults to 1.
+    epsilon : float
+        Insensitivity of the SVR. Defaults to 0.
+    tol : float
+        Tolerance of the SVR (see fit_linear). Defaults to 1e-4.
+    max_iter : int
+        Maximum number of iterations of the SVR. Defaults to 10000.
+
+    Returns
+    -------
+    dual : np.array, shape (n_times, n_trials[, n_targets])
+        Dual coefficients of the trials.
+    intercept : np.array, shape (n_times[, n_targets])
+    n_iter : np.array, shape (n_times,)
+        Number of iterations of each time sample, 0 in closed form.
+    """
+    y = np.asarray(y, dtype=float)
+    Y = y.reshape(len(y), -1)
+    if loss == 'ridge':
+        out = _fit_kernel_ridge(gram, Y, alpha)
+    elif loss == 'svr':
+        # the intercept of liblinear is a constant feature
+        out = _fit_svr(gram + 1., Y, C, epsilon, tol, max_iter)
+    else:
+        raise ValueError('Unknown loss %s' % loss)
+    dual, intercept, n_iter, _ = out
+    if y.ndim == 1:
+        dual, intercept = dual[:, :, 0], intercept[:, 0]
+    return dual, intercept, n_iter
+
+
+def _fit_kernel_ridge(gram, Y, alpha):
+    """Ridge regressions of Gram matrices, shape (n_times, n_trials,
+    n_trials), on Y, shape (n_trials, n_targets), with an unpenalized
+    intercept"""
+    n_times, n_trials, _ = gram.shape
+    # center the features on the mean trial
+    mean = gram.mean(axis=2, keepdims=True)
+    centered = (gram - mean - mean.transpose(0, 2, 1) +
+                mean.mean(axis=1, keepdims=True))
+    centered += alpha * np.eye(n_trials)
+    Y_mean = Y.mean(axis=0)
+    dual = np.linalg.solve(centered, np.tile(Y - Y_mean, (n_times, 1, 1)))
+    # the dual coefficients sum to zero, so that the weights of the
+    # uncentered features are the same
+    intercept = Y_mean - np.matmul(mean.transpose(0, 2, 1), dual)[:, 0]
+    return dual, intercept, np.zeros(n_times, int), None
+
+
+def linear_weights(estimator):
+    """Weights of a fitted linear estimator, with its StandardScaler steps
+    folded in.
+
+    Parameters
+    ----------
+    estimator : sklearn estimator
+        A fitted linear model of sklearn.linear_model or sklearn.svm,
+        orientations.utils.SVR_angle or clf_2class_proba, possibly after
+        StandardScaler steps in a Pipeline.
+
+    Returns
+    -------
+    weights : None | dict
+        None if estimator is not linear. Otherwise, 'coef', shape (n_dims,
+        n_outputs), 'intercept', shape (n_outputs,), 'classes' and 'output',
+        how the decision values are predicted: 'value', 'label' (the sign of
+        a binary classifier), 'argmax' (multiclass), 'proba', 'angle' or
+        'components' (the cos and sin of SVR_angle).
+    """
+    from sklearn.base import is_classifier
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from orientations.utils import clf_2class_proba, SVR_angle
+    if isinstance(estimator, Pipeline):
+        steps = [step for _, step in estimator.steps]
+        weights = linear_weights(steps[-1])
+        if weights is None or not all(isinstance(step, StandardScaler)
+                                      for step in steps[:-1]):
+            return None
+        for scaler in steps[-2::-1]:
+            _fold_scaler(weights, scaler)
+        return weights
+    if isinstance(estimator, SVR_angle):
+        weights = dict(coef=estimator.coef_.T, intercept=estimator.intercept_,
+                       classes=None, output='components'
+                       if estimator.components else 'angle')
+        if estimator.scaler_ is not None:
+            _fold_scaler(weights, estimator.scaler_)
+        return weights
+    module = type(estimator).__module__.split('.')[:2]
+    if not (hasattr(estimator, 'coef_') and hasattr(estimator, 'intercept_')
+            and (module in (['sklearn', 'linear_model'], ['sklearn', 'svm'])
+                 or isinstance(estimator, clf_2class_proba))):
+        return None
+    coef = np.atleast_2d(np.asarray(estimator.coef_, dtype=float)).T
+    intercept = np.zeros(coef.shape[1]) + estimator.intercept_
+    output, classes = 'value', None
+    if is_classifier(estimator):
+        classes = estimator.classes_
+        if coef.shape[1] == 1 and len(classes) == 2:
+            output = 'label'
+        elif coef.shape[1] == len(classes):
+            output = 'argmax'
+        else:
+            return None  # e.g. one-vs-one
+    if isinstance(estimator, clf_2class_proba):
+        if output != 'label':
+            return None
+        output = 'proba'
+    elif type(estimator).predict.__module__.split('.')[0] != 'sklearn':
+        return None  # predict is overridden
+    return dict(coef=coef, intercept=intercept, output=output,
+                classes=classes)
+
+
+def _fold_scaler(weights, scaler):
+    """Weights applied to the data before a fitted StandardScaler"""
+    coef, intercept = weights['coef'], weights['intercept']
+    if scaler.with_std:
+        coef = coef / scaler.scale_[:, None]
+    if scaler.with_mean:
+        intercept = intercept - np.dot(scaler.mean_, coef)
+    weights.update(coef=coef, intercept=intercept)
+
+
+def test_fit_linear():
+    from nose.tools import assert_equal, assert_true
+    from sklearn.linear_model import Ridge, LogisticRegression
+    from sklearn.svm import LinearSVR
+    rng = np.random.RandomState(0)
+    n_trials, n_features, n_times = 30, 5, 4
+    X = rng.randn(n_trials, n_features, n_times)
+    y = X[:, 0, :].sum(1) + .5 * rng.randn(n_trials)
+    labels = np.where(y > 0, 1., -1.)
+    weight = np.where(labels > 0, 2., 1.)
+    for n_features_ in (5, 40):
+        # ridge, in the primal and in the dual
+        X_ = np.concatenate([X] * (n_features_ // n_features), axis=1)
+        coef, intercept, n_iter = fit_linear(X_, y, 'ridge', alpha=2.,
+                                             chunk_size=3)
+        assert_equal(coef.shape, (n_times, n_features_))
+        for t in range(n_times):
+            ridge = Ridge(alpha=2.).fit(X_[:, :, t], y)
+            np.testing.assert_allclose(coef[t], ridge.coef_, atol=1e-8)
+            np.testing.assert_allclose(intercept[t], ridge.intercept_,
+                                       atol=1e-8)
+    coef, intercept, n_iter = fit_linear(X, labels, 'logistic', C=.5,
+                                         sample_weight=weight, tol=1e-8)
+    assert_true(np.all(n_iter < 20))
+    for t in range(n_times):
+        clf = LogisticRegression(C=.5, tol=1e-10, max_iter=1000).fit(
+            X[:, :, t], labels, sample_weight=weight)
+        np.testing.assert_allclose(coef[t], clf.coef_[0], atol=1e-5)
+        np.testing.assert_allclose(intercept[t], clf.intercept_[0],
+                                   atol=1e-5)
+    # warm starts sweep the times to the same solutions
+    X_ = X[:, :, :1] + .1 * rng.randn(n_trials, n_features, 6)
+    for loss, target in (('logistic', labels), ('svr', y)):
+        cold = fit_linear(X_, target, loss, tol=1e-8, chunk_size=1)
+        warm = fit_linear(X_, target, loss, tol=1e-8, chunk_size=1,
+                          warm_start=True)
+        np.testing.assert_allclose(warm[0], cold[0], atol=1e-4)
+        assert_true(warm[2][1:].sum() < cold[2][1:].sum())
+    coef, intercept, n_iter = fit_linear(X, y, 'svr', C=.1, epsilon=.1,
+                                         tol=1e-6)
+    for t in range(n_times):
+        svr = LinearSVR(C=.1, epsilon=.1, tol=1e-8, max_iter=100000,
+                        dual=True).fit(X[:, :, t], y)
+        np.testing.assert_allclose(coef[t], svr.coef_, atol=1e-3)
+        np.testing.assert_allclose(intercept[t], svr.intercept_, atol=1e-3)
+    # the same weights in the dual, from the Gram matrices
+    gram = gram_matrices(X, chunk_size=3)
+    np.testing.assert_allclose(gram[1], np.dot(X[:, :, 1], X[:, :, 1].T))
+    for loss in ('ridge', 'svr'):
+        primal = fit_linear(X, np.c_[y, -y], loss, alpha=2., tol=1e-8)
+        dual, intercept, _ = fit_kernel(gram, np.c_[y, -y], loss, alpha=2.,
+                                        tol=1e-8)
+        np.testing.assert_allclose(
+            np.matmul(X.transpose(2, 1, 0), dual), primal[0], atol=1e-6)
+        np.testing.assert_allclose(intercept, primal[1], atol=1e-6)
+
+
+def test_linear_weights():
+    from nose.tools import assert_equal, assert_true
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression, Ridge
+    from sklearn.svm import LinearSVR, SVC
+    from orientations.utils import SVR_angle, clf_2class_proba
+    rng = np.random.RandomState(0)
+    X = rng.randn(50, 4) * [1, 10, 1, 1] + 3
+    y = X[:, 0] + rng.randn(50)
+    labels = (y > 3).astype(int)
+    scaled = [('scaler', StandardScaler())]
+    for clf, target, output in (
+            (Ridge(), y, 'value'),
+            (Pipeline(scaled + [('svr', LinearSVR())]), y, 'value'),
+            (Pipeline(scaled + [('clf', LogisticRegression())]), labels,
+             'label'),
+            (LogisticRegression(), np.digitize(y, [2, 4]), 'argmax'),
+            (clf_2class_proba(), labels, 'proba'),
+            (SVR_angle(), y, 'angle')):
+        clf.fit(X, target)
+        weights = linear_weights(clf)
+        assert_equal(weights['output'], output)
+        pred = _link(np.dot(X, weights['coef']) + weights['intercept'],
+                     output, weights['classes'])
+        np.testing.assert_allclose(pred[:, 0], clf.predict(X), rtol=1e-6,
+                                   atol=1e-8)
+    assert_true(linear_weights(SVC().fit(X, labels)) is None)
+    # decision values at all train and test times, the diagonal and bands
+    coef, intercept = rng.randn(3, 4, 2), rng.randn(3, 2)
+    X = rng.randn(5, 4, 3)
+    full = np.einsum('ipt,kpo->ktio', X, coef) + intercept[:, None, None]
+    slices = [np.arange(3)] * 3
+    np.testing.assert_allclose(
+        _predict_linear(X, coef, intercept, slices, chunk_size=2), full)
+    slices = [np.array([0, 1]), np.array([0, 1, 2]), np.array([1, 2])]
+    pred = _predict_linear(X, coef, intercept, slices)
+    for t_train, t_tests in enumerate(slices):
+        np.testing.assert_allclose(pred[t_train, :len(t_tests)],
+                                   full[t_train, t_tests])
+
+
+def test_svr_angle():
+    from nose.tools import assert_equal
+    from sklearn.linear_model import Ridge
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import LinearSVR
+    from orientations.utils import SVR_angle
+    rng = np.random.RandomState(0)
+    angles = rng.rand(60) * 2 * np.pi
+    X = np.c_[np.cos(angles), np.sin(angles), rng.randn(60, 3)]
+    X = (X + .3 * rng.randn(*X.shape)) * [1, 2, 3, 4, 5]
+    X_ = StandardScaler().fit_transform(X)
+    # a single multi-output fit, with the components of separate fits
+    clf = SVR_angle(solver='ridge', alpha=2.).fit(X, angles)
+    for coef, target in zip(clf.coef_, (np.cos(angles), np.sin(angles))):
+        np.testing.assert_allclose(coef, Ridge(alpha=2.).fit(X_, target).coef_)
+    clf = SVR_angle(tol=1e-6).fit(X, angles)
+    svr = LinearSVR(tol=1e-8, max_iter=100000).fit(X_, np.sin(angles))
+    np.testing.assert_allclose(clf.coef_[1], svr.coef_, atol=1e-3)
+    components = clf.predict_components(X)
+    assert_equal(components.shape, (60, 2))
+    np.testing.assert_allclose(
+        clf.predict(X), np.arctan2(components[:, 1], components[:, 0]))
+    clf.set_params(components=True)
+    np.testing.assert_array_equal(clf.predict(X), components)
+
+
+# GENERALIZATION ACROSS TIME ##################################################
+
+
+class GeneralizationAcrossTime(object):
+    """Generalization across time (GAT) with fold-level precomputations.
+
+    Replaces mne.decoding.GeneralizationAcrossTime: it takes the same
+    parameters and exposes the same fitted attributes and plots. In
+    addition, the sensors can be reduced once per fold, on the training
+    trials pooled across all times (see fit_reduction), so that the
+    estimator of each train time is fitted in a space of n_components
+    dimensions.
+
+    Parameters
+    ----------
+    clf : None | sklearn estimator
+        Estimator fitted at each train time. Defaults to a StandardScaler
+        followed by a LogisticRegression.
+    cv : int | list of (train, test)
+        Number of folds, stratified for classifiers, or the folds
+        themselves. Defaults to 5.
+    train_times : None | dict
+        Can contain 'start', 'stop' and 'step', in seconds. Defaults to all
+        times.
+    test_times : None | 'diagonal' | dict
+        Times at which each estimator is tested. A dict can contain 'start',
+        'stop' and 'step', in seconds, for a strided grid of test times,
+        and 'band', to only test the times within band seconds of each
+        train time. Tests on other test times than the same grid for all
+        train times give SparseScores. Defaults to all times.
+    predict_mode : 'cross-validation' | 'mean-prediction'
+        Predict each trial with the estimators of the fold where it is
+        tested, or with the mean of all estimators. Defaults to
+        'cross-validation'.
+    scorer : None | function
+        Scoring function, scorer(y_true, y_pred). Defaults to the accuracy
+        for classifiers and to the mean squared error otherwise.
+    reduce : None | int | dict
+        Number of components of the fold-level reduction, or
+        dict(n_components, whiten). Defaults to None (no reduction).
+    fold_cache : None | FoldCache
+        Shares the fold-level reductions across decoders and runs. Defaults
+        to None.
+    n_jobs : int
+        Number of train times fitted in parallel. Defaults to 1.
+    batch : bool
+        If True and clf is linear (see linear_spec), fit all train times of
+        a fold as one batched problem (see fit_linear) instead of one
+        estimator per train time. Defaults to False.
+    warm_start : bool
+        If True, the train times of each fold are fitted in order, each
+        starting from the solution of the previous one: with the iterative
+        batched solvers, and with the sklearn estimators that have a
+        warm_start parameter (e.g. LogisticRegression with lbfgs). Defaults
+        to False.
+    kernel : bool
+        If True, the batched ridge and SVR decoders are fitted in the dual
+        (see fit_kernel), from the Gram matrices of the training trials at
+        each train time, which the fold cache shares across decoders. The
+        warm start does not apply to them. Defaults to False.
+
+    Attributes
+    ----------
+    estimators_ : None | list of list of estimators, shape (n_train_times,
+                                                            n_folds)
+        None when the train times are fitted in batch.
+    linear_ : None | dict
+        The linear_spec of clf when fitted in batch.
+    coef_ : np.array, shape (n_train_times, n_folds, n_dims, n_outputs)
+    intercept_ : np.array, shape (n_train_times, n_folds, n_outputs)
+        The weights of linear estimators (see linear_weights), with which
+        all train and test times are predicted by matrix products.
+    output_ : None | str
+        How the decision values are predicted (see linear_weights). None if
+        the estimators are not all linear, and predict each time.
+    n_iter_ : np.array, shape (n_train_times, n_folds)
+        The numbers of iterations of each fit, 0 if unknown or in closed
+        form.
+    reductions_ : list of (components, mean), shape (n_folds,)
+    cv_ : list of (train, test)
+    y_train_ : np.array, shape (n_trials,)
+    train_times : dict
+        With 'slices', the sample of each train time, and 'times_'.
+    test_times_ : dict
+        With 'slices' and 'times_', for each train time.
+    y_pred_ : np.array, shape (n_train_times, n_test_times, n_trials,
+                               n_dims)
+    scores_ : np.array, shape (n_train_times, n_test_times) | SparseScores
+    """
+    def __init__(self, clf=None, cv=5, train_times=None, test_times=None,
+                 predict_mode='cross-validation', scorer=None, reduce=None,
+                 fold_cache=None, n_jobs=1, batch=False, warm_start=False,
+                 kernel=False):
+        if clf is None:
+            from sklearn.preprocessing import StandardScaler
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.pipeline import Pipeline
+            clf = Pipeline([('scaler', StandardScaler()),
+                            ('clf', LogisticRegression())])
+        self.clf = clf
+        self.cv = cv
+        self.train_times = dict() if train_times is None else train_times
+        self.test_times = test_times
+        self.predict_mode = predict_mode
+        self.scorer = scorer
+        self.reduce = reduce
+        self.fold_cache = fold_cache
+        self.n_jobs = n_jobs
+        self.batch = batch
+        self.warm_start = warm_start
+        self.kernel = kernel
+
+    def fit(self, epochs, y=None):
+        """Fit an estimator per train time and fold.
+
+        Parameters
+        ----------
+        epochs : Epochs
+        y : None | np.array, shape (n_trials,)
+            Targets. Defaults to epochs.events[:, 2].
+
+        Returns
+        -------
+        self : GeneralizationAcrossTime
+        """
+        X, trial_ids = epochs._data, epochs.events[:, 0]
+        y = epochs.events[:, 2] if y is None else np.asarray(y)
+        self._setup(X, epochs.times, trial_ids, y)
+        if self.linear_ is not None:
+            _fit_batch([self], X, trial_ids, [y])
+        else:
+            self._fit_estimators(X, trial_ids, y)
+        return self
+
+    def _setup(self, X, times, trial_ids, y, cv=None):
+        """Folds, train times, reductions and linear_spec of a fit, on the
+        folds cv if given"""
+        from sklearn.base import is_classifier
+        self.y_train_ = y
+        self.cv_ = cv_folds(y, self.cv if cv is None else cv,
+                            classifier=is_classifier(self.clf))
+        self.train_times = _time_slices(times, self.train_times)
+        self.reductions_ = [self._fit_reduction(X, trial_ids, train)
+                            for train, _ in self.cv_]
+        self.linear_ = linear_spec(self.clf) if self.batch else None
+        if (self.linear_ is not None and self.linear_['loss'] == 'logistic'
+                and len(np.unique(y)) != 2):
+            self.linear_ = None  # multiclass: fall back to sklearn
+
+    def _fit_estimators(self, X, trial_ids, y):
+        slices = self.train_times['slices']
+        # the leading StandardScaler of clf is fitted once per fold, for all
+        # train times at once
+        name, scaler, clf = _split_scaler(self.clf)
+        self.estimators_ = [list() for _ in slices]
+        for fold, (train, _) in enumerate(self.cv_):
+            X_train = self._fold_data(X, trial_ids, fold, train)
+            X_train = X_train[:, :, slices]
+            if scaler is not None:
+                X_train, scalers = _fit_fold_scaler(
+                    X_train, scaler, self._moments(X_train, trial_ids[train]))
+            if self.warm_start:
+                estimators = _fit_sweep(clf, X_train, y[train])
+            else:
+                estimators = self._parallel(
+                    _fit_time, [(clf, X_train[:, :, t], y[train])
+                                for t in range(len(slices))])
+            for t_train, estimator in enumerate(estimators):
+                if scaler is not None:
+                    estimator = _prepend(name, scalers[t_train], estimator)
+                self.estimators_[t_train].append(estimator)
+        self.n_iter_ = np.array([[np.max(getattr(_final_step(estimator),
+                                                 'n_iter_', 0))
+                                  for estimator in estimators]
+                                 for estimators in self.estimators_])
+        self._stack_weights()
+
+    def predict(self, epochs):
+        """Predict each trial at each test time with each train time.
+
+        Parameters
+        ----------
+        epochs : Epochs
+            The epochs fitted in 'cross-validation' predict mode.
+
+        Returns
+        -------
+        y_pred : np.array, shape (n_train_times, n_test_times, n_trials,
+                                  n_dims)
+        """
+        X = epochs._data
+        cv_mode = self.predict_mode == 'cross-validation'
+        if cv_mode and len(X) != len(self.y_train_):
+            raise ValueError('Cross-validation predictions require the '
+                             'fitted epochs.')
+        self.test_times_ = _test_slices(epochs.times, self.train_times,
+                                        self.test_times)
+        y_pred = None
+        for fold, (_, test) in enumerate(self.cv_):
+            trials = test if cv_mode else np.arange(len(X))
+            X_test = self._fold_data(X, epochs.events[:, 0], fold, trials,
+                                     shared=False)
+            if self.output_ is not None:
+                preds = _predict_linear(
+                    X_test, self.coef_[:, fold], self.intercept_[:, fold],
+                    self.test_times_['slices'])
+                preds = _link(preds, self.output_, self.classes_)
+            for t_train, t_tests in enumerate(self.test_times_['slices']):
+                if self.output_ is not None:
+                    pred = preds[t_train, :len(t_tests)].transpose(1, 0, 2)
+                else:
+                    estimator = self.estimators_[t_train][fold]
+                    pred = _predict_times(estimator, X_test, t_tests)
+                if y_pred is None:
+                    n_tests = max(len(t) for t in self.test_times_['slices'])
+                    y_pred = np.zeros((len(self.test_times_['slices']),
+                                       n_tests, len(X), pred.shape[-1]),
+                                      dtype=X.dtype)
+                if cv_mode:
+                    y_pred[t_train][:len(t_tests), trials] = \
+                        pred.transpose(1, 0, 2)
+                else:
+                    y_pred[t_train, :len(t_tests)] += \
+                        pred.transpose(1, 0, 2) / len(self.cv_)
+        self.y_pred_ = y_pred
+        return y_pred
+
+    def score(self, epochs=None, y=None, scorer=None):
+        """Score the predictions at each train and test time.
+
+        Parameters
+        ----------
+        epochs : None | Epochs
+            If not None, the epochs are first predicted.
+        y : None | np.array, shape (n_trials,)
+            True targets. Defaults to the fitted ones.
+        scorer : None | function
+            Defaults to the scorer of the GAT.
+
+        Returns
+        -------
+        scores : np.array, shape (n_train_times, n_test_times)
+        """
+        from sklearn.base import is_classifier
+        from sklearn.metrics import accuracy_score, mean_squared_error
+        if epochs is not None:
+            self.predict(epochs)
+        y = self.y_train_ if y is None else np.asarray(y)
+        scorer = self.scorer if scorer is None else scorer
+        if scorer is None:
+            scorer = accuracy_score if is_classifier(self.clf) \
+                else mean_squared_error
+        self.scorer_ = scorer
+        self.y_true_ = y
+        slices = self.test_times_['slices']
+        scores = [np.array([scorer(y, y_pred)
+                            for y_pred in y_preds[:len(t_tests)]])
+                  for y_preds, t_tests in zip(self.y_pred_, slices)]
+        if all(np.array_equal(t, slices[0]) for t in slices):
+            self.scores_ = np.array(scores)
+        else:
+            self.scores_ = SparseScores(scores, self.train_times['slices'],
+                                        slices, self.test_times_['n_times'])
+        return self.scores_
+
+    def __getstate__(self):
+        # the fold cache is shared with other decoders: don't pickle it
+        state = self.__dict__.copy()
+        state['fold_cache'] = None
+        return state
+
+    def plot(self, **kwargs):
+        """Plot the scores of all train and test times (see
+        mne.viz.decoding.plot_gat_matrix), blank where not tested"""
+        from copy import copy
+        from mne.viz.decoding import plot_gat_matrix
+        gat = self
+        if isinstance(self.scores_, SparseScores):
+            gat = copy(self)
+            gat.scores_ = np.asarray(self.scores_)
+            times = self.test_times_['all_times_']
+            gat.test_times_ = dict(self.test_times_,
+                                   times_=[times] * len(gat.scores_))
+        return plot_gat_matrix(gat, **kwargs)
+
+    def plot_diagonal(self, **kwargs):
+        """Plot the scores at identical train and test times (see
+        mne.viz.decoding.plot_gat_times)"""
+        from mne.viz.decoding import plot_gat_times
+        return plot_gat_times(self, train_time='diagonal', **kwargs)
+
+    def plot_times(self, train_time, **kwargs):
+        """Plot the scores of given train times across test times (see
+        mne.viz.decoding.plot_gat_times)"""
+        from mne.viz.decoding import plot_gat_times
+        return plot_gat_times(self, train_time=train_time, **kwargs)
+
+    def _stack_weights(self):
+        """Stack the weights of the fitted estimators if all are linear"""
+        self.output_ = None
+        weights = [linear_weights(estimator) for estimators in
+                   self.estimators_ for estimator in estimators]
+        if not len(weights) or any(w is None for w in weights):
+            return
+        first = weights[0]
+        for w in weights[1:]:
+            # e.g. a class missing from a fold
+            if (w['output'] != first['output'] or
+                    w['coef'].shape != first['coef'].shape or
+                    not np.array_equal(w['classes'], first['classes'])):
+                return
+        shape = (len(self.estimators_), len(self.cv_))
+        self.coef_ = np.reshape([w['coef'] for w in weights],
+                                shape + first['coef'].shape)
+        self.intercept_ = np.reshape([w['intercept'] for w in weights],
+                                     shape + first['intercept'].shape)
+        self.output_, self.classes_ = first['output'], first['classes']
+
+    def _fit_reduction(self, X, trial_ids, train):
+        if self.reduce is None:
+            return None
+        cache = FoldCache() if self.fold_cache is None else self.fold_cache
+        components, mean = cache.get(
+            ('reduction', self._reduce_params()), trial_ids[train],
+            lambda: fit_reduction(X[train], **dict(self._reduce_params())))
+        return components, mean
+
+    def _reduce_params(self):
+        if self.reduce is None:
+            return None
+        params = self.reduce if isinstance(self.reduce, dict) else \
+            dict(n_components=self.reduce)
+        return sorted(params.items())
+
+    def _fold_data(self, X, trial_ids, fold, trials, shared=True):
+        """Data of trials in the reduced space of a fold. The reduced data of
+        all trials are shared in memory by the decoders of the fold cache,
+        unless shared is False: the entry is only identified by the trial
+        ids, so that it is only valid for the fitted data, and not e.g. for
+        the other epochs predicted."""
+        reduction = self.reductions_[fold]
+        if reduction is None:
+            return X[trials]
+        if self.fold_cache is None or not shared:
+            return apply_reduction(X[trials], *reduction)
+        train = self.cv_[fold][0]
+        reduced, _ = self.fold_cache.get(
+            ('reduced', self._reduce_params(), trial_ids.tolist()),
+            trial_ids[train], lambda: (apply_reduction(X, *reduction), None),
+            persist=False)
+        return reduced[trials]
+
+    def _gram(self, X, trial_ids, fold, X_train, moments):
+        """Gram matrices of the training trials of a fold, as fitted"""
+        cache = FoldCache() if self.fold_cache is None else self.fold_cache
+        train = self.cv_[fold][0]
+        slices = self.train_times['slices']
+        if self.reductions_[fold] is None and moments is None:
+            # the Gram matrices of all trials contain those of every fold.
+            # Too large for the disk cache, they are kept in single precision.
+            gram, _ = cache.get(('gram', slices), trial_ids, lambda: (
+                gram_matrices(X[:, :, slices]).astype(np.float32), None),
+                persist=False)
+            return gram[:, train[:, None], train].astype(float)
+        gram, _ = cache.get(
+            ('gram', self._reduce_params(), slices, moments is not None),
+            trial_ids[train], lambda: (gram_matrices(
+                _standardize(X_train, moments)[0]), None), persist=False)
+        return gram
+
+    def _moments(self, X_train, train_ids):
+        """Means and variances of the training data per dimension and train
+        time, shared by the decoders of the fold cache"""
+        cache = FoldCache() if self.fold_cache is None else self.fold_cache
+        moments, _ = cache.get(
+            ('moments', self._reduce_params(), self.train_times['slices']),
+            train_ids, lambda: (np.array([
+                X_train.mean(axis=0, dtype=np.float64),
+                X_train.var(axis=0, dtype=np.float64)]), None),
+            persist=False)
+        return moments
+
+    def _parallel(self, func, args):
+        if self.n_jobs == 1:
+            return [func(*arg) for arg in args]
+        from mne.parallel import parallel_func
+        parallel, pfunc, _ = parallel_func(func, self.n_jobs)
+        return parallel(pfunc(*arg) for arg in args)
+
+
+def fit_targets(gats, epochs, Y):
+    """Fit the decoders of several targets of the same epochs in one pass.
+
+    The decoders of the same trials share their folds, stratified on their
+    first classification target, and thus their fold-level precomputations.
+    Among them, the batched ridge and SVR decoders that only differ by their
+    targets (see linear_spec) are fitted as a single problem with a target
+    per column: for the ridge, one solve with several right-hand sides. The
+    fold caches are cleared after each group of trials, which releases their
+    Gram matrices, reduced data and scaler moments.
+
+    Parameters
+    ----------
+    gats : list of GeneralizationAcrossTime, shape (n_targets,)
+        The decoder of each target, whose cv is a number of folds.
+    epochs : Epochs
+    Y : np.array, shape (n_trials, n_targets)
+        Targets, NaN for the trials that a decoder excludes, e.g. with a
+        query.
+
+    Returns
+    -------
+    sels : list of np.array, shape (n_targets,)
+        The trials of each decoder, fitted on epochs[sel] and Y[sel]. The
+        decoders without trials are not fitted.
+    """
+    from collections import OrderedDict
+    from sklearn.base import is_classifier
+    Y = np.asarray(Y, dtype=float)
+    X, trial_ids = epochs._data, epochs.events[:, 0]
+    sels = [np.where(~np.isnan(y))[0] for y in Y.T]
+    groups = OrderedDict()
+    for gat, y, sel in zip(gats, Y.T, sels):
+        if len(sel):
+            groups.setdefault((tuple(sel), gat.cv), list()).append(
+                (gat, y[sel]))
+    for (sel, cv), group in groups.items():
+        sel = np.array(sel)
+        first, y = ([(gat, y) for gat, y in group if is_classifier(gat.clf)]
+                    + group)[0]
+        folds = cv_folds(y, cv, classifier=is_classifier(first.clf))
+        X_, trial_ids_ = X[sel], trial_ids[sel]
+        batches = OrderedDict()
+        for gat, y in group:
+            gat._setup(X_, epochs.times, trial_ids_, y, folds)
+            if gat.linear_ is None:
+                gat._fit_estimators(X_, trial_ids_, y)
+                continue
+            key = [gat.train_times['slices'], gat._reduce_params(),
+                   gat.warm_start, gat.kernel, id(gat.fold_cache)]
+            if gat.linear_['loss'] == 'logistic':
+                key.append(id(gat))  # a single target per problem
+            else:
+                key += sorted(item for item in gat.linear_.items()
+                              if item[0] not in ('output', 'class_weight'))
+            batches.setdefault(hash_key(*key), list()).append((gat, y))
+        for batch in batches.values():
+            _fit_batch([gat for gat, _ in batch], X_, trial_ids_,
+                       [y for _, y in batch])
+        caches = dict((id(gat.fold_cache), gat.fold_cache)
+                      for gat, _ in group if gat.fold_cache is not None)
+        for cache in caches.values():
+            cache.clear()
+    return sels
+
+
+def without_scaler(clf):
+    """Copy of an estimator without its StandardScaler steps, for data that
+    is already whitened (see base.whiten_epochs).
+
+    Parameters
+    ----------
+    clf : sklearn estimator
+        A Pipeline, or an estimator with a 'scaler' parameter such as
+        orientations.utils.SVR_angle.
+
+    Returns
+    -------
+    clf : sklearn estimator
+    """
+    from sklearn.base import clone
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    if isinstance(clf, Pipeline):
+        steps = [(name, without_scaler(step)) for name, step in clf.steps
+                 if not isinstance(step, StandardScaler)]
+        return steps[0][1] if len(steps) == 1 else Pipeline(steps)
+    clf = clone(clf)
+    if 'scaler' in clf.get_params():
+        clf.set_params(scaler=False)
+    return clf
+
+
+def _time_slices(times, train_times):
+    """Samples and times of the train times"""
+    from copy import deepcopy
+    train_times = deepcopy(train_times)
+    sfreq = 1. / (times[1] - times[0]) if len(times) > 1 else 1.
+    start = train_times.get('start', times[0])
+    stop = train_times.get('stop', times[-1])
+    step = max(1, int(round(train_times.get('step', 1. / sfreq) * sfreq)))
+    samples = np.where((times >= start - .5 / sfreq) &
+                       (times <= stop + .5 / sfreq))[0][::step]
+    train_times.update(start=start, stop=stop, step=step / sfreq,
+                       length=1. / sfreq, slices=samples.tolist(),
+                       times_=times[samples])
+    return train_times
+
+
+def _test_slices(times, train_times, test_times):
+    """Samples and times at which each train time is tested"""
+    if test_times is None:
+        slices = [np.arange(len(times)) for _ in train_times['slices']]
+    elif isinstance(test_times, dict):
+        # a strided grid, restricted to a band around each train time
+        grid = _time_slices(times, test_times)['slices']
+        band = test_times.get('band', np.inf)
+        sfreq = 1. / (times[1] - times[0]) if len(times) > 1 else 1.
+        slices = [np.array([t for t in grid if abs(times[t] - times[t_train])
+                            <= band + 1e-3 / sfreq], int)
+                  for t_train in train_times['slices']]
+        if not all(len(t) for t in slices):
+            raise ValueError('No test time in the band of some train times.')
+    elif test_times == 'diagonal':
+        slices = [np.array([t]) for t in train_times['slices']]
+    else:
+        raise ValueError('Unknown test_times %s' % test_times)
+    return dict(slices=slices, times_=[times[s] for s in slices],
+                n_times=len(times), all_times_=times)
+
+
+class SparseScores(list):
+    """Scores of a GAT tested at different times for each train time.
+
+    A list of the scores of each train time at its test times, as the ragged
+    scores of mne's GAT. np.asarray gives the dense scores, shape
+    (n_train_times, n_times), NaN where not tested.
+
+    Parameters
+    ----------
+    scores : list of np.array, shape (n_train_times,)
+        The scores of each train time.
+    train_slices : list of int
+        The sample of each train time.
+    test_slices : list of np.array
+        The samples at which each train time is tested.
+    n_times : int
+        Number of test time samples.
+    """
+    def __init__(self, scores, train_slices, test_slices, n_times):
+        list.__init__(self, [np.asarray(score) for score in scores])
+        self.train_slices = list(train_slices)
+        self.test_slices = [np.asarray(t) for t in test_slices]
+        self.n_times = n_times
+
+    def __array__(self, dtype=None, copy=None):
+        dense = np.nan * np.zeros((len(self), self.n_times))
+        for row, scores, t_tests in zip(dense, self, self.test_slices):
+            row[t_tests] = scores
+        return dense if dtype is None else dense.astype(dtype)
+
+    def diagonal(self):
+        """Scores at identical train and test times, NaN where not tested.
+
+        Returns
+        -------
+        scores : np.array, shape (n_train_times,)
+        """
+        return np.asarray(self)[np.arange(len(self)), self.train_slices]
+
+
+def _split_scaler(clf):
+    """The leading StandardScaler of an estimator, and the estimator
+    without it"""
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from orientations.utils import SVR_angle
+    if isinstance(clf, Pipeline) and \
+            isinstance(clf.steps[0][1], StandardScaler):
+        name, scaler = clf.steps[0]
+        steps = clf.steps[1:]
+        return name, scaler, steps[0][1] if len(steps) == 1 else \
+            Pipeline(steps)
+    if isinstance(clf, SVR_angle) and clf.scaler:
+        return 'scaler', StandardScaler(), without_scaler(clf)
+    return None, None, clf
+
+
+def _fit_fold_scaler(X, scaler, moments=None):
+    """Standardize X, shape (n_trials, n_dims, n_times), with the statistics
+    of each dimension and time, computed in one pass unless given as moments,
+    shape (2, n_dims, n_times): the means and variances
+
+    Returns
+    -------
+    X : np.array, shape (n_trials, n_dims, n_times)
+    scalers : list of StandardScaler, shape (n_times,)
+        Fitted as on each time sample.
+    """
+    from sklearn.base import clone
+    if moments is None:
+        moments = X.mean(axis=0, dtype=np.float64), \
+            X.var(axis=0, dtype=np.float64)
+    mean, var = moments
+    scale = np.sqrt(var)
+    scale[scale == 0.] = 1.
+    X = X - mean.astype(X.dtype) if scaler.with_mean else X.copy()
+    if scaler.with_std:
+        X /= scale.astype(X.dtype)
+    scalers = list()
+    for t in range(X.shape[2]):
+        scaler_ = clone(scaler)
+        scaler_.mean_, scaler_.var_ = mean[:, t], var[:, t]
+        scaler_.scale_ = scale[:, t] if scaler.with_std else None
+        scaler_.n_samples_seen_ = len(X)
+        scaler_.n_features_in_ = X.shape[1]
+        scalers.append(scaler_)
+    return X, scalers
+
+
+def _prepend(name, scaler, estimator):
+    """Pipeline of a fitted scaler and a fitted estimator"""
+    from sklearn.pipeline import Pipeline
+    from orientations.utils import SVR_angle
+    if isinstance(estimator, SVR_angle):
+        estimator.scaler, estimator.scaler_ = True, scaler
+        return estimator
+    steps = estimator.steps if isinstance(estimator, Pipeline) else \
+        [('clf', estimator)]
+    return Pipeline([(name, scaler)] + steps)
+
+
+def _final_step(estimator):
+    from sklearn.pipeline import Pipeline
+    if isinstance(estimator, Pipeline):
+        return _final_step(estimator.steps[-1][1])
+    return estimator
+
+
+def _fit_sweep(clf, X, y):
+    """Fit clf at each time sample of X, shape (n_trials, n_dims, n_times),
+    in order, each estimator with a warm_start parameter starting from the
+    solution of the previous one"""
+    from sklearn.base import clone
+    estimators = list()
+    for t in range(X.shape[2]):
+        estimator = clone(clf)
+        final = _final_step(estimator)
+        if len(estimators) and 'warm_start' in final.get_params():
+            previous = _final_step(estimators[-1])
+            final.set_params(warm_start=True)
+            for attr in ('coef_', 'intercept_'):
+                if hasattr(previous, attr):
+                    setattr(final, attr, np.copy(getattr(previous, attr)))
+        estimator.fit(X[:, :, t], y)
+        estimators.append(estimator)
+    return estimators
+
+
+def _fit_time(clf, X, y):
+    from sklearn.base import clone
+    estimator = clone(clf)
+    estimator.fit(X, y)
+    return estimator
+
+
+def _predict_times(estimator, X, t_tests):
+    """Predict several test times with a single call"""
+    n_trials, n_dims, _ = X.shape
+    X = X[:, :, t_tests].transpose(0, 2, 1).reshape(-1, n_dims)
+    pred = np.asarray(estimator.predict(X))
+    return pred.reshape(n_trials, len(t_tests), -1)
+
+
+def _linear_targets(y, spec):
+    """Targets of the batched solvers, shape (n_trials, n_outputs), and the
+    trial weights of the logistic loss"""
+    weight = None
+    if spec['output'] in ('angle', 'components'):
+        # cos and sin share a single solve
+        Y = np.c_[np.cos(y), np.sin(y)]
+    elif spec['loss'] == 'logistic':
+        classes = np.unique(y)
+        Y = np.where(y == classes[1], 1., -1.)[:, None]
+        weight = _class_weight(y, classes, spec['class_weight'])
+    else:
+        Y = y[:, None]
+    return Y, weight
+
+
+def _fit_batch(gats, X, trial_ids, ys):
+    """Batched fit of the linear decoders of one or several targets, which
+    share their folds, train times, reductions and solver, with a target per
+    column of a single problem"""
+    gat, spec = gats[0], gats[0].linear_
+    slices = gat.train_times['slices']
+    fits = list()
+    for fold, (train, _) in enumerate(gat.cv_):
+        X_train = gat._fold_data(X, trial_ids, fold, train)[:, :, slices]
+        moments = gat._moments(X_train, trial_ids[train]) \
+            if spec['scaler'] else None
+        gram = None
+        if gat.kernel and spec['loss'] in ('ridge', 'svr'):
+            gram = gat._gram(X, trial_ids, fold, X_train, moments)
+        targets = [_linear_targets(y[train], gat_.linear_)
+                   for gat_, y in zip(gats, ys)]
+        Y = np.concatenate([Y_ for Y_, _ in targets], axis=1)
+        fits.append(_fit_linear_fold(X_train, Y, targets[0][1], spec,
+                                     gat.warm_start, moments, gram))
+    coef, intercept, n_iter = [np.stack(values, axis=1)
+                               for values in zip(*fits)]
+    # the outputs of each target
+    stops = np.cumsum([Y_.shape[1] for Y_, _ in targets])
+    for gat_, y, start, stop in zip(gats, ys, np.r_[0, stops[:-1]], stops):
+        gat_.classes_ = np.unique(y)
+        gat_.output_ = gat_.linear_['output']
+        gat_.estimators_ = None
+        gat_.coef_ = coef[:, :, :, start:stop]
+        gat_.intercept_ = intercept[:, :, start:stop]
+        gat_.n_iter_ = n_iter
+
+
+def _fit_linear_fold(X, Y, weight, spec, warm_start=False, moments=None,
+                     gram=None):
+    """Batched fit of all train times of a fold, shape (n_trials, n_dims,
+    n_train_times), on the targets Y (see _linear_targets), with the
+    standardization (see _fit_fold_scaler) folded into the weights. A warm
+    start sweeps the train times in order. Given the Gram matrices of the
+    standardized X, the fit is in the dual."""
+    if spec['scaler']:
+        X, mean, scale = _standardize(X, moments)
+    options = dict(tol=spec['tol']) if 'tol' in spec else dict()
+    if gram is not None:
+        dual, intercept, n_iter = fit_kernel(
+            gram, Y, spec['loss'], alpha=spec['alpha'], C=spec['C'],
+            epsilon=spec['epsilon'], **options)
+        coef = np.matmul(X.transpose(2, 1, 0), dual)
+    else:
+        if warm_start:
+            options.update(warm_start=True, chunk_size=1)
+        coef, intercept, n_iter = fit_linear(
+            X, Y, spec['loss'], alpha=spec['alpha'], C=spec['C'],
+            epsilon=spec['epsilon'], sample_weight=weight, **options)
+    if spec['scaler']:
+        coef /= scale.T[:, :, None]
+        intercept -= np.sum(mean.T[:, :, None] * coef, axis=1)
+    return coef, intercept, n_iter
+
+
+def _standardize(X, moments=None):
+    """Standardize X, shape (n_trials, n_dims, n_times), as StandardScaler
+    per dimension and time, with the means and variances of moments if
+    given"""
+    if moments is None:
+        moments = X.mean(axis=0), X.var(axis=0)
+    mean, scale = moments[0], np.sqrt(moments[1])
+    scale[scale == 0.] = 1.
+    return (X - mean) / scale, mean, scale
+
+
+def _class_weight(y, classes, class_weight):
+    """Trial weights of sklearn's class_weight.
+
+    'balanced' weights the classes by n_trials / (n_classes * counts). The
+    deprecated 'auto' of the configs weights them by 1 / counts, normalized
+    to a mean of 1 across classes, as sklearn < 0.19 did: the two only
+    differ by a scale, i.e. by the effective C.
+    """
+    if class_weight is None:
+        return np.ones(len(y))
+    if class_weight in ('auto', 'balanced'):
+        counts = np.array([np.sum(y == c) for c in classes], dtype=float)
+        if class_weight == 'auto':
+            weights = (1. / counts) / np.mean(1. / counts)
+        else:
+            weights = len(y) / (len(classes) * counts)
+        class_weight = dict(zip(classes, weights))
+    return np.array([class_weight.get(value, 1.) for value in y])
+
+
+def test_class_weight():
+    from nose.tools import assert_equal
+    y = np.array([0, 0, 0, 1])
+    assert_equal(_class_weight(y, [0, 1], None).tolist(), [1.] * 4)
+    # each class has the same total weight
+    np.testing.assert_allclose(_class_weight(y, [0, 1], 'balanced'),
+                               [2. / 3] * 3 + [2.])
+    np.testing.assert_allclose(_class_weight(y, [0, 1], 'auto'),
+                               [.5] * 3 + [1.5])
+    assert_equal(_class_weight(y, [0, 1], {1: 3.}).tolist(), [1.] * 3 + [3.])
+
+
+def _predict_linear(X, coef, intercept, test_slices, chunk_size=16):
+    """Decision values of linear weights, shape (n_train_times, n_dims,
+    n_outputs), at their test times: (n_train_times, n_test_times, n_trials,
+    n_outputs)"""
+    n_trains, n_dims, n_outputs = coef.shape
+    n_tests = max(len(t) for t in test_slices)
+    coef = coef.astype(X.dtype)
+    pred = np.zeros((n_trains, n_tests, len(X), n_outputs), dtype=X.dtype)
+    if all(np.array_equal(t, test_slices[0]) for t in test_slices):
+        # the same test times for all train times: one matrix product per
+        # block of test times
+        coef = coef.transpose(1, 0, 2).reshape(n_dims, -1)
+        for start in range(0, n_tests, chunk_size):
+            t_tests = test_slices[0][start:start + chunk_size]
+            X_ = X[:, :, t_tests].transpose(0, 2, 1).reshape(-1, n_dims)
+            pred_ = np.dot(X_, coef).reshape(len(X), len(t_tests), n_trains,
+                                             n_outputs)
+            pred[:, start:start + len(t_tests)] = pred_.transpose(2, 1, 0, 3)
+    else:
+        # e.g. the diagonal: one batched product per test time index
+        for ii in range(n_tests):
+            trains = [t for t, t_tests in enumerate(test_slices)
+                      if len(t_tests) > ii]
+            samples = [test_slices[t][ii] for t in trains]
+            pred[trains, ii] = np.einsum('ipk,kpo->kio', X[:, :, samples],
+                                         coef[trains])
+    pred += intercept[:, None, None, :].astype(X.dtype)
+    return pred
+
+
+def _link(pred, output, classes=None):
+    """Predictions from decision values"""
+    from scipy.special import expit
+    if output == 'angle':
+        return np.arctan2(pred[..., 1:], pred[..., :1])
+    elif output == 'proba':
+        return expit(pred)
+    elif output == 'label':
+        return classes[(pred > 0).astype(int)]
+    elif output == 'argmax':
+        return classes[np.argmax(pred, axis=-1)][..., None]
+    return pred
+
+
+class _Epochs(object):
+    """Minimal epochs of the tests, with distinct trial ids"""
+    def __init__(self, data, times):
+        self._data, self.times = data, times
+        self.events = np.c_[np.arange(len(data)) * 10,
+                            np.zeros((len(data), 2), int)]
+
+
+def test_generalization_across_time():
+    from nose.tools import assert_equal, assert_true
+    from sklearn.linear_model import LogisticRegression, Ridge
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    rng = np.random.RandomState(0)
+    n_trials, n_chans, n_times = 40, 8, 6
+    y = np.arange(n_trials) % 2
+    X = rng.randn(n_trials, n_chans, n_times).astype(np.float32)
+    # informative from the third sample on
+    X[:, 0, 2:] += 4 * y[:, None]
+    epochs = _Epochs(X, np.arange(n_times) / 100.)
+    gat = GeneralizationAcrossTime(clf=LogisticRegression(), cv=4)
+    gat.fit(epochs, y=y)
+    assert_equal(len(gat.estimators_), n_times)
+    assert_equal(len(gat.estimators_[0]), 4)
+    y_pred = gat.predict(epochs)
+    assert_equal(y_pred.shape, (n_times, n_times, n_trials, 1))
+    assert_equal(gat.output_, 'label')
+    scores = gat.score(epochs, y=y)
+    assert_equal(scores.shape, (n_times, n_times))
+    assert_true(np.all(scores[2:, 2:] > .8))
+    assert_true(np.all(scores[:2, :2] < .8))
+    # identical to the per time-sample predictions
+    train, test = gat.cv_[1]
+    np.testing.assert_array_equal(
+        y_pred[3, 4, test, 0], gat.estimators_[3][1].predict(X[test, :, 4]))
+    # one fold-level StandardScaler matches a scaler per time sample
+    from sklearn.pipeline import Pipeline
+    from orientations.utils import SVR_angle
+    X_ = X * np.arange(1, n_chans + 1)[:, None] + 5
+    scaled = _Epochs(X_, epochs.times)
+    gat = GeneralizationAcrossTime(clf=Pipeline([
+        ('scaler', StandardScaler()), ('clf', LogisticRegression())]), cv=4)
+    gat.fit(scaled, y=y)
+    train, _ = gat.cv_[0]
+    reference = Pipeline([('scaler', StandardScaler()),
+                          ('clf', LogisticRegression())])
+    reference.fit(X_[train, :, 3], y[train])
+    estimator = gat.estimators_[3][0]
+    np.testing.assert_allclose(estimator.steps[0][1].scale_,
+                               reference.steps[0][1].scale_, rtol=1e-5)
+    np.testing.assert_allclose(estimator.steps[1][1].coef_,
+                               reference.steps[1][1].coef_, rtol=1e-3)
+    gat = GeneralizationAcrossTime(clf=SVR_angle(), cv=4)
+    gat.fit(scaled, y=y * np.pi / 2)
+    assert_true(gat.estimators_[0][0].scaler_ is not None)
+    y_pred = gat.predict(scaled)
+    train, test = gat.cv_[1]
+    np.testing.assert_allclose(
+        y_pred[3, 4, test, 0], gat.estimators_[3][1].predict(X_[test, :, 4]),
+        rtol=1e-4, atol=1e-5)
+    # train times, diagonal and mean predictions
+    gat = GeneralizationAcrossTime(clf=Ridge(), cv=4, test_times='diagonal',
+                                   train_times=dict(start=.01, step=.02),
+                                   predict_mode='mean-prediction')
+    gat.fit(epochs, y=y)
+    assert_equal(gat.train_times['slices'], [1, 3, 5])
+    assert_equal(gat.predict(epochs).shape, (3, 1, n_trials, 1))
+    scores = gat.score(epochs, y=y)
+    assert_true(isinstance(scores, SparseScores))
+    assert_equal(np.asarray(scores).shape, (3, n_times))
+    np.testing.assert_array_equal(scores.diagonal(), np.concatenate(scores))
+    np.testing.assert_allclose(
+        gat.y_pred_[1, 0, :, 0],
+        np.mean([est.predict(X[:, :, 3]) for est in gat.estimators_[1]], 0),
+        rtol=1e-5)
+    # a band around each train time, and a strided grid
+    full = GeneralizationAcrossTime(clf=LogisticRegression(), cv=4)
+    full.fit(epochs, y=y)
+    full.score(epochs, y=y)
+    for batch in (False, True):
+        gat = GeneralizationAcrossTime(
+            clf=LogisticRegression(), cv=4, batch=batch,
+            test_times=dict(band=.01))
+        gat.fit(epochs, y=y)
+        assert_equal(gat.predict(epochs).shape, (n_times, 3, n_trials, 1))
+        assert_equal([t.tolist() for t in gat.test_times_['slices']],
+                     [[0, 1], [0, 1, 2], [1, 2, 3], [2, 3, 4], [3, 4, 5],
+                      [4, 5]])
+        scores = np.asarray(gat.score(epochs, y=y))
+        tested = ~np.isnan(scores)
+        assert_equal(tested.sum(), 16)
+        if not batch:
+            np.testing.assert_allclose(scores[tested], full.scores_[tested])
+    gat = GeneralizationAcrossTime(clf=LogisticRegression(), cv=4,
+                                   test_times=dict(step=.02))
+    gat.fit(epochs, y=y)
+    assert_equal(gat.score(epochs, y=y).shape, (n_times, 3))
+    # a fold-level reduction is shared across train times and decoders
+    cache = FoldCache()
+    gat = GeneralizationAcrossTime(clf=LogisticRegression(), cv=4, reduce=3,
+                                   fold_cache=cache)
+    gat.fit(epochs, y=y)
+    assert_equal(gat.estimators_[0][0].coef_.shape, (1, 3))
+    # per fold: the reduction and the reduced data
+    assert_equal(len(cache._entries), 8)
+    assert_true(np.all(gat.score(epochs, y=y)[2:, 2:] > .8))
+    # and the scaler moments
+    for batch in (False, True):
+        GeneralizationAcrossTime(
+            clf=make_pipeline(StandardScaler(), Ridge()), cv=gat.cv_,
+            reduce=3, fold_cache=cache, batch=batch).fit(epochs, y=y)
+        assert_equal(len(cache._entries), 12)
+    # but not with other data of the same trial ids
+    other = _Epochs(X[:, ::-1], epochs.times)
+    gat.predict_mode = 'mean-prediction'
+    np.testing.assert_array_equal(
+        gat.predict(other),
+        GeneralizationAcrossTime(clf=LogisticRegression(), cv=gat.cv_,
+                                 reduce=3, predict_mode='mean-prediction')
+        .fit(epochs, y=y).predict(other))
+    # single precision epochs give the double precision scores
+    epochs64 = _Epochs(X.astype(np.float64), epochs.times)
+    for batch in (False, True):
+        gats = [GeneralizationAcrossTime(
+            clf=make_pipeline(StandardScaler(), Ridge()), cv=4, batch=batch)
+            for _ in range(2)]
+        y_pred32 = gats[0].fit(epochs, y=y).predict(epochs)
+        y_pred64 = gats[1].fit(epochs64, y=y).predict(epochs64)
+        np.testing.assert_allclose(y_pred32, y_pred64, rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(gats[0].score(epochs, y=y),
+                                   gats[1].score(epochs64, y=y), atol=1e-4)
+
+
+def test_batched_generalization_across_time():
+    from nose.tools import assert_equal, assert_true
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression, Ridge
+    from sklearn.svm import LinearSVR
+    from sklearn.metrics import roc_auc_score
+    from orientations.utils import SVR_angle, clf_2class_proba
+
+    def _angle_error(y_true, y_pred):
+        return np.mean(np.abs(np.angle(np.exp(1j * (y_true - y_pred[:, 0])))))
+
+    rng = np.random.RandomState(0)
+    n_trials, n_chans, n_times = 40, 6, 5
+    y = np.arange(n_trials) % 2
+    angles = rng.rand(n_trials) * 2 * np.pi
+    X = rng.randn(n_trials, n_chans, n_times)
+    X[:, 0, 2:] += 2 * y[:, None] + 3 * np.cos(angles)[:, None]
+    X[:, 1, 2:] += 3 * np.sin(angles)[:, None]
+    X[:, 2] *= 10
+    epochs = _Epochs(X, np.arange(n_times) / 100.)
+    scaled = [('scaler', StandardScaler())]
+    for clf, target, scorer in (
+            (Ridge(alpha=10.), y + angles, None),
+            (Pipeline(scaled + [('ridge', Ridge())]), angles, None),
+            (Pipeline(scaled + [('clf', LogisticRegression(C=.1))]), y, None),
+            (clf_2class_proba(class_weight='balanced'), y, roc_auc_score),
+            (LinearSVR(C=.1, tol=1e-6, max_iter=10000), angles, None),
+            (SVR_angle(), angles, _angle_error)):
+        gat = GeneralizationAcrossTime(clf=clf, cv=4, scorer=scorer)
+        gat.fit(epochs, y=target)
+        gat.score(epochs, y=target)
+        batch = GeneralizationAcrossTime(clf=clf, cv=4, scorer=scorer,
+                                         batch=True)
+        batch.fit(epochs, y=target)
+        assert_true(batch.linear_ is not None)
+        assert_equal(batch.coef_.shape[:2], (n_times, 4))
+        batch.score(epochs, y=target)
+        assert_equal(batch.y_pred_.shape, gat.y_pred_.shape)
+        assert_equal(batch.test_times_['times_'][0].tolist(),
+                     gat.test_times_['times_'][0].tolist())
+        # solvers match sklearn, up to their tolerances
+        np.testing.assert_allclose(batch.scores_, gat.scores_, rtol=.05,
+                                   atol=.05)
+    # the same fits in the dual, from Gram matrices shared across targets
+    cache = FoldCache()
+    for clf, target in ((Ridge(alpha=10.), y + angles),
+                        (Ridge(alpha=10.), angles),
+                        (Pipeline(scaled + [('ridge', Ridge())]), angles),
+                        (SVR_angle(tol=1e-6), angles)):
+        primal = GeneralizationAcrossTime(clf=clf, cv=4, batch=True)
+        primal.fit(epochs, y=target)
+        dual = GeneralizationAcrossTime(clf=clf, cv=primal.cv_, batch=True,
+                                        kernel=True, fold_cache=cache)
+        dual.fit(epochs, y=target)
+        np.testing.assert_allclose(dual.coef_, primal.coef_, atol=1e-5)
+        np.testing.assert_allclose(dual.intercept_, primal.intercept_,
+                                   atol=1e-5)
+    # a Gram matrix of all trials, and per fold the scaler moments and the
+    # Gram matrix of the standardized data
+    assert_equal(len(cache._entries), 9)
+    # the components of the angles, for sandbox.recombine_svr_prediction
+    for batch in (False, True):
+        gat = GeneralizationAcrossTime(clf=SVR_angle(components=True), cv=4,
+                                       batch=batch)
+        assert_equal(gat.fit(epochs, y=angles).predict(epochs).shape,
+                     (n_times, n_times, n_trials, 2))
+    # warm-started sweeps across slowly varying train times
+    smooth = _Epochs(X[:, :, :1] + .1 * rng.randn(n_trials, n_chans, n_times),
+                     epochs.times)
+    clf = LogisticRegression(solver='lbfgs', tol=1e-6)
+    cold = GeneralizationAcrossTime(clf=clf, cv=4).fit(smooth, y=y)
+    warm = GeneralizationAcrossTime(clf=clf, cv=4, warm_start=True)
+    warm.fit(smooth, y=y)
+    assert_equal(warm.n_iter_.shape, (n_times, 4))
+    assert_true(warm.n_iter_[1:].sum() < cold.n_iter_[1:].sum())
+    np.testing.assert_allclose(warm.coef_, cold.coef_, atol=1e-3)
+    warm = GeneralizationAcrossTime(clf=clf, cv=4, batch=True,
+                                    warm_start=True).fit(smooth, y=y)
+    np.testing.assert_allclose(warm.coef_, cold.coef_, atol=1e-3)
+    # multiclass falls back to per time-sample estimators
+    gat = GeneralizationAcrossTime(clf=LogisticRegression(), cv=4,
+                                   batch=True)
+    gat.fit(epochs, y=np.arange(n_trials) % 3)
+    assert_true(gat.linear_ is None)
+    assert_equal(len(gat.estimators_), n_times)
+
+
+def test_fit_targets():
+    from nose.tools import assert_equal, assert_true
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression, Ridge
+    from sklearn.svm import LinearSVR
+    from orientations.utils import SVR_angle
+
+    rng = np.random.RandomState(0)
+    n_trials, n_chans, n_times = 40, 6, 4
+    labels = np.arange(n_trials) % 2
+    angles = rng.rand(n_trials) * 2 * np.pi
+    X = rng.randn(n_trials, n_chans, n_times)
+    X[:, 0] += 2 * labels[:, None] + 3 * np.cos(angles)[:, None]
+    X[:, 1] += 3 * np.sin(angles)[:, None]
+    epochs = _Epochs(X, np.arange(n_times) / 100.)
+    present = np.where(labels == 1, angles, np.nan)
+    scaled = [('scaler', StandardScaler())]
+    clfs = [Ridge(alpha=10.), Ridge(alpha=10.), Ridge(alpha=1.),
+            Pipeline(scaled + [('svr', LinearSVR(tol=1e-6))]),
+            SVR_angle(tol=1e-6), LogisticRegression(), SVR_angle(tol=1e-6)]
+    Y = np.c_[angles, labels + angles, angles, angles, angles, labels,
+              present]
+    gats = [GeneralizationAcrossTime(clf=clf, cv=4, batch=True, kernel=True)
+            for clf in clfs]
+    sels = fit_targets(gats, epochs, Y)
+    assert_equal([len(sel) for sel in sels], [n_trials] * 6 + [20])
+    # the fold cache is released after each group of trials
+    cache = FoldCache()
+    fit_targets([GeneralizationAcrossTime(clf=Ridge(), cv=4, batch=True,
+                                          kernel=True, fold_cache=cache)],
+                epochs, Y[:, :1])
+    assert_equal(len(cache._entries), 0)
+    # the trials of each target share their folds, stratified on the labels
+    for gat in gats[:-1]:
+        assert_equal(gat.cv_[0][1].tolist(), gats[5].cv_[0][1].tolist())
+    # the targets that only differ by their values are fitted together
+    assert_true(gats[0].coef_.base is gats[1].coef_.base)
+    assert_true(gats[3].coef_.base is gats[4].coef_.base)
+    assert_true(gats[0].coef_.base is not gats[2].coef_.base)
+    assert_equal(gats[4].coef_.shape, (n_times, 4, n_chans, 2))
+    # as they would be separately, up to the tolerance of the SVR
+    for gat, clf, y, sel in zip(gats, clfs, Y.T, sels):
+        single = GeneralizationAcrossTime(clf=clf, cv=gat.cv_, batch=True)
+        single.fit(_Epochs(X[sel], epochs.times), y=y[sel])
+        np.testing.assert_allclose(gat.coef_, single.coef_, atol=1e-3)
+        np.testing.assert_allclose(gat.intercept_, single.intercept_,
+                                   atol=1e-3)
+        assert_equal(gat.predict(_Epochs(X[sel], epochs.times)).shape[2],
+                     len(sel))
+
+
+def test_without_scaler():
+    from nose.tools import assert_equal, assert_true
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import LinearSVR
+    from sklearn.feature_selection import SelectKBest
+    clf = without_scaler(Pipeline([('scaler', StandardScaler()),
+                                   ('svr', LinearSVR(C=2))]))
+    assert_true(isinstance(clf, LinearSVR))
+    assert_equal(clf.C, 2)
+    clf = without_scaler(Pipeline([('scaler', StandardScaler()),
+                                   ('select', SelectKBest(k=2)),
+                                   ('svr', LinearSVR())]))
+    assert_equal([name for name, _ in clf.steps], ['select', 'svr'])
@@ -1,3 +1,6 @@
+import os
+import os.path as op
+import json
 import numpy as np
 import scipy.io as sio
 import pandas as pd
@@ -5,6 +8,12 @@ import pandas as pd
 from sklearn.svm import LinearSVR, SVC
 from sklearn.linear_model import LogisticRegression
 
+from base import (cache_call, cache_load, cache_save, cache_memmap,
+                  code_signature, file_signature, hash_key,
+                  preprocess_epochs, plan_preprocessing, apply_plan,
+                  apply_plan_chunked, report_plan, resample_array,
+                  window_epochs, whiten_epochs, fit_whitener, apply_whitener)
+
 
 def fix_wrong_channel_names(inst):
     from mne.epochs import EpochsArray
@@ -22,103 +31,1035 @@ def fix_wrong_channel_names(inst):
 
 
 def load_epochs_events(subject, paths=None, data_type='erf',
-                       lock='target'):
-    # Get MEG data
-    meg_fname = paths('epoch', subject=subject, data_type=data_type, lock=lock)
-    epochs = load_FieldTrip_data(meg_fname)
-    epochs = fix_wrong_channel_names(epochs)
+                       lock='target', mmap=True, picks=None, tmin=-.200,
+                       tmax=1.200, decim=1, cache=True, dtype=np.float32):
+    """Load the epochs of a subject and the corresponding behavioral events.
+
+    The channel, time and decimation selections are applied while reading,
+    so that the discarded samples are never loaded from disk.
+
+    Parameters
+    ----------
+    subject : str
+        Subject identifier.
+    paths : function
+        Path template function (see scripts/config.py).
+    data_type : str
+        'erf' or 'freq%i'. Defaults to 'erf'.
+    lock : str
+        Defaults to 'target'.
+    mmap : bool
+        Memory-map the FieldTrip binary. Defaults to True.
+    picks : None | array of int
+        Channels to load. Defaults to the 306 MEG channels.
+    tmin : float
+        Start of the time window, in seconds. Defaults to -.200.
+    tmax : float
+        End of the time window, in seconds. Defaults to 1.200.
+    decim : int
+        Only read one sample out of decim, without low-pass filtering.
+        Defaults to 1.
+    cache : bool
+        Reuse the parsed behavior and FieldTrip header from the cache files
+        stored next to them. Defaults to True.
+    dtype : type
+        Precision of the loaded data. Defaults to np.float32, the precision
+        of the files.
+
+    Returns
+    -------
+    epochs : EpochsArray
+    events : pandas.DataFrame
+    """
+    picks = np.arange(306) if picks is None else picks
+    # Get MEG data: use the native store when it has been converted (see
+    # scripts/convert_epochs.py), as its channels and window are already fixed
+    store = paths('store', subject=subject, data_type=data_type, lock=lock)
+    if op.exists(op.join(store, 'info.json')):
+        epochs = load_epochs_store(store, picks=picks, tmin=tmin, tmax=tmax,
+                                   decim=decim, dtype=dtype)
+    else:
+        meg_fname = paths('epoch', subject=subject, data_type=data_type,
+                          lock=lock)
+        epochs = load_FieldTrip_data(meg_fname, mmap=mmap, picks=picks,
+                                     tmin=tmin, tmax=tmax, decim=decim,
+                                     cache=cache, dtype=dtype)
     # Get behavioral data
     bhv_fname = paths('behavior', subject=subject)
-    events = get_events(bhv_fname)
-    epochs.crop(-.200, 1.200)
+    events = get_events(bhv_fname, cache=cache)
+    return epochs, events
+
+
+def load_preprocessed(subject, paths, preproc, data_type='erf',
+                      lock='target', dtype=np.float32, cache_dir=None,
+                      max_bytes=None, max_memory=None, verbose=False):
+    """Load the epochs and events of a subject and preprocess the epochs.
+
+    The preprocessed epochs are cached under a hash of the source files, of
+    the parameters and of the code producing them, so that reruns and other
+    scripts start from ready-to-decode arrays.
+
+    Parameters
+    ----------
+    subject : str
+        Subject identifier.
+    paths : function
+        Path template function (see scripts/config.py).
+    preproc : dict
+        Preprocessing steps (see base.preprocess_epochs).
+    data_type : str
+        'erf' or 'freq%i'. Defaults to 'erf'.
+    lock : str
+        Defaults to 'target'.
+    dtype : type
+        Precision of the data. Defaults to np.float32.
+    cache_dir : None | str
+        Cache directory. Defaults to None (no cache).
+    max_bytes : None | float
+        Maximum size of the cache, beyond which the least recently used
+        entries are removed. Defaults to None (unbounded).
+    max_memory : None | float
+        If not None, the trials are streamed from the memory-mapped source
+        by chunks preprocessed within max_memory bytes, and written into a
+        memory-mapped file: the cache entry, or if there is no cache a
+        temporary file, deleted as soon as it is mapped. Defaults to None
+        (all trials in memory).
+    verbose : bool
+        If True, print the preprocessing plan and its estimated cost.
+        Defaults to False.
+
+    Returns
+    -------
+    epochs : EpochsArray
+    events : pandas.DataFrame
+    """
+    # The temporal windows are views of the preprocessed data: they are
+    # computed after the cache.
+    window = preproc.get('window', None)
+    preproc = dict((key, value) for key, value in preproc.items()
+                   if key != 'window')
+
+    key = preprocessed_key(subject, paths, preproc, data_type, lock, dtype)
+    _, sfreq, times, n_trials = _epochs_source(subject, paths, data_type,
+                                               lock)
+    if cache_dir is not None:
+        mmap_mode = None if max_memory is None else 'r'
+        data, meta = cache_load(key, cache_dir, mmap_mode=mmap_mode)
+        if data is not None:
+            events = get_events(paths('behavior', subject=subject),
+                                cache=True)
+            epochs = _create_epochs(data, **meta)
+            if window is not None:
+                epochs = window_epochs(epochs, **window)
+            return epochs, events
+
+    times = times[_time_slice(times, sfreq, -.200, 1.200)]
+    plan, cost, load_params = _plan_reading(preproc, sfreq, times, n_trials,
+                                            dtype)
+    if max_memory is None:
+        epochs, events = load_epochs_events(
+            subject, paths, data_type=data_type, lock=lock, dtype=dtype,
+            **load_params)
+        epochs = preprocess_epochs(epochs, preproc, verbose=verbose)
+    else:
+        load_params = dict(dict(tmin=times[0], tmax=times[-1]),
+                           **load_params)
+        chunk_size = max(1, int(max_memory * n_trials // cost['bytes']))
+        if verbose:
+            print(report_plan(plan, cost))
+            print('%i trials at once' % chunk_size)
+        data, meta = _preprocess_out_of_core(
+            subject, paths, data_type, lock, plan, n_trials, dtype,
+            chunk_size, key if cache_dir is not None else None, cache_dir,
+            **load_params)
+        epochs = _create_epochs(data, **meta)
+        # the whitening is also applied by chunks of trials
+        if 'whiten' in preproc.keys():
+            epochs = whiten_epochs(epochs, **preproc['whiten'])
+        events = get_events(paths('behavior', subject=subject), cache=True)
+
+    if cache_dir is not None:
+        cache_save(key, epochs._data, _epochs_meta(epochs), cache_dir,
+                   max_bytes=max_bytes)
+    if window is not None:
+        epochs = window_epochs(epochs, **window)
     return epochs, events
 
 
+def preprocessed_key(subject, paths, preproc, data_type='erf',
+                     lock='target', dtype=np.float32):
+    """Identify the preprocessed epochs of load_preprocessed: a hash of the
+    source files, of the parameters and of the code producing them.
+
+    Parameters
+    ----------
+    subject : str
+        Subject identifier.
+    paths : function
+        Path template function (see scripts/config.py).
+    preproc : dict
+        Preprocessing steps (see base.preprocess_epochs). The temporal
+        windows, computed after the cache, are ignored.
+    data_type : str
+        'erf' or 'freq%i'. Defaults to 'erf'.
+    lock : str
+        Defaults to 'target'.
+    dtype : type
+        Precision of the data. Defaults to np.float32.
+
+    Returns
+    -------
+    key : str
+    """
+    preproc = dict((key, value) for key, value in preproc.items()
+                   if key != 'window')
+    fnames = _epochs_source(subject, paths, data_type, lock)[0]
+    source = [file_signature(fname) for fname in fnames]
+    return hash_key(source, data_type, lock, preproc, np.dtype(dtype).name,
+                    code_signature(load_preprocessed, preprocessed_key,
+                                   load_epochs_events, _read_FieldTrip_data,
+                                   _read_epochs_store, preprocess_epochs,
+                                   plan_preprocessing, apply_plan,
+                                   resample_array, whiten_epochs,
+                                   fit_whitener, apply_whitener,
+                                   apply_plan_chunked))
+
+
+def _plan_reading(preproc, sfreq, times, n_trials, dtype):
+    """Plan the preprocessing of the epochs read within times. Only the
+    samples that survive the preprocessing are read: the first crop of the
+    plan is done at read time, with the returned load parameters."""
+    plan, cost = plan_preprocessing(
+        preproc, sfreq, times[0], len(times), n_signals=n_trials * 306,
+        itemsize=np.dtype(dtype).itemsize)
+    load_params = dict()
+    if len(plan) and plan[0]['name'] == 'crop':
+        load_params = dict(tmin=plan[0]['tmin'], tmax=plan[0]['tmin'] +
+                           (plan[0]['n_times'] - 1) / sfreq)
+        plan = plan[1:]
+    return plan, cost, load_params
+
+
+def _preprocess_out_of_core(subject, paths, data_type, lock, plan, n_trials,
+                            dtype, chunk_size, key=None, cache_dir=None,
+                            picks=None, tmin=None, tmax=None):
+    """Stream chunks of trials from the memory-mapped source, preprocess
+    them and write them into a memory-mapped file, returned with the
+    metadata of the epochs"""
+    import tempfile
+    picks = np.arange(306) if picks is None else picks
+    store = paths('store', subject=subject, data_type=data_type, lock=lock)
+    if op.exists(op.join(store, 'info.json')):
+        def _read(sel):
+            return _read_epochs_store(store, sel=sel, picks=picks, tmin=tmin,
+                                      tmax=tmax, dtype=dtype)
+    else:
+        meg_fname = paths('epoch', subject=subject, data_type=data_type,
+                          lock=lock)
+
+        def _read(sel):
+            return _read_FieldTrip_data(meg_fname, mmap=True, sel=sel,
+                                        picks=picks, tmin=tmin, tmax=tmax,
+                                        cache=True, dtype=dtype)
+
+    metas = list()
+
+    def _read_data(sel):
+        data, meta = _read(sel)
+        metas.append(meta)
+        return data
+
+    # Preallocate the output on disk
+    first, meta = _read([0])
+    n_times = plan[-1]['n_times'] if len(plan) else first.shape[2]
+    shape = (n_trials, len(picks), n_times)
+    if key is not None:
+        out = cache_memmap(key, shape, dtype, cache_dir)
+    else:
+        fd, fname = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        out = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                        shape=shape)
+        # The mapping keeps the data of the unlinked file until it is
+        # released, so that no file is left behind.
+        os.remove(fname)
+    apply_plan_chunked(_read_data, n_trials, plan, out, chunk_size=chunk_size)
+
+    if len(plan):
+        meta.update(sfreq=plan[-1]['sfreq'], tmin=plan[-1]['tmin'])
+    meta['events'] = np.concatenate([meta_['events'] for meta_ in metas])
+    return out, meta
+
+
+def test_preprocess_out_of_core():
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal, assert_true
+
+    class _Epochs(object):
+        def __init__(self, data, sfreq, tmin):
+            self._data, self.info = data, dict(sfreq=sfreq)
+            self.times = tmin + np.arange(data.shape[2]) / sfreq
+
+    tmp_dir = tempfile.mkdtemp()
+    cache_dir = op.join(tmp_dir, 'cache')
+
+    def paths(typ, subject, data_type, lock):
+        return op.join(tmp_dir, '%s_%s_%s' % (subject, data_type, lock))
+
+    rng = np.random.RandomState(0)
+    sfreq, n_trials, n_chans = 1000., 7, 4
+    times = np.arange(-.3, 1.3, 1. / sfreq)
+    data = rng.randn(n_trials, n_chans, len(times)).astype(np.float32)
+    data += np.sin(2 * np.pi * 10 * times).astype(np.float32)
+    meta = dict(sfreq=sfreq, tmin=times[0],
+                ch_names=['MEG%04i' % ii for ii in range(n_chans)],
+                ch_types=['grad'] * n_chans,
+                events=np.c_[np.arange(n_trials), np.zeros(n_trials),
+                             np.arange(n_trials)])
+    _write_epochs_store(data, meta, paths('store', 's', 'erf', 'target'))
+    # the window read by load_preprocessed
+    sel = _time_slice(times, sfreq, -.200, 1.200)
+    for preproc in (dict(decim=4, crop=dict(tmin=0., tmax=.3),
+                         baseline=dict(tmin=-.1, tmax=0.)),
+                    dict(resample=128., crop=dict(tmin=-.1, tmax=.8))):
+        plan, _, load_params = _plan_reading(preproc, sfreq, times[sel],
+                                             n_trials, np.float32)
+        # in core, from the data read by default
+        epochs = _Epochs(data[:, :, sel].copy(), sfreq, times[sel][0])
+        epochs = preprocess_epochs(epochs, preproc)
+        for key in (None, 'key'):
+            out, meta_ = _preprocess_out_of_core(
+                's', paths, 'erf', 'target', plan, n_trials, np.float32,
+                chunk_size=3, key=key, cache_dir=cache_dir,
+                picks=np.arange(n_chans), **load_params)
+            np.testing.assert_allclose(out, epochs._data, atol=1e-5)
+            np.testing.assert_allclose(meta_['sfreq'], epochs.info['sfreq'])
+            np.testing.assert_allclose(meta_['tmin'], epochs.times[0])
+            np.testing.assert_array_equal(meta_['events'], meta['events'])
+            assert_true(isinstance(out, np.memmap))
+        # the preallocated cache entry is committed without any copy left
+        cache_save('key', out, meta_, cache_dir)
+        del out
+        np.testing.assert_allclose(cache_load('key', cache_dir)[0],
+                                   epochs._data, atol=1e-5)
+        assert_equal(sorted(os.listdir(cache_dir)),
+                     ['key.npy', 'key.pickle'])
+    shutil.rmtree(tmp_dir)
+
+
+def _epochs_source(subject, paths, data_type, lock):
+    """Source files, sampling frequency, times and number of trials of the
+    epochs of a subject"""
+    store = paths('store', subject=subject, data_type=data_type, lock=lock)
+    if op.exists(op.join(store, 'info.json')):
+        fnames = [op.join(store, 'info.json')]
+        with open(fnames[0], 'r') as f:
+            info = json.load(f)
+        sfreq = info['sfreq']
+        times = np.arange(info['n_times']) / sfreq + info['tmin']
+        n_trials = len(info['events'])
+    else:
+        meg_fname = paths('epoch', subject=subject, data_type=data_type,
+                          lock=lock)
+        fnames = [meg_fname, meg_fname[:-4] + '.dat']
+        header = cache_call(_read_FieldTrip_header, meg_fname)
+        sfreq, times = header['sfreq'], header['times']
+        n_trials = header['Xdim'][0]
+    return fnames, sfreq, times, n_trials
+
+
+def load_epochs_bands(subject, paths=None, data_types=('erf',),
+                      lock='target', picks=None, tmin=-.200, tmax=1.200,
+                      decim=1, dtype=np.float32, out_fname=None):
+    """Load several data types (e.g. frequency bands) of a subject into a
+    single array.
+
+    The behavioral events are built once, and the data of each band is
+    written in place into the shared array.
+
+    Parameters
+    ----------
+    subject : str
+        Subject identifier.
+    paths : function
+        Path template function (see scripts/config.py).
+    data_types : list of str
+        Data types to stack, e.g. ['freq%i' % f for f in [7, 10, 12]].
+    lock : str
+        Defaults to 'target'.
+    picks : None | array of int
+        Channels to load. Defaults to the 306 MEG channels.
+    tmin : float
+        Start of the time window, in seconds. Defaults to -.200.
+    tmax : float
+        End of the time window, in seconds. Defaults to 1.200.
+    decim : int
+        Only read one sample out of decim, without low-pass filtering.
+        Defaults to 1.
+    dtype : type
+        Precision of the data. Defaults to np.float32.
+    out_fname : None | str
+        If given, the stacked array is a memory-mapped .npy file. Defaults
+        to None.
+
+    Returns
+    -------
+    data : np.array, shape (n_trials, n_bands, n_chans, n_times)
+        The stacked data.
+    epochs : EpochsArray
+        The metadata shared by all bands. Its data is a view on the first
+        band.
+    events : pandas.DataFrame
+    """
+    data, meta = _read_epochs_bands(subject, paths, data_types, lock, picks,
+                                    tmin, tmax, decim, dtype, out_fname)
+    epochs = _create_epochs(data[:, 0], **meta)
+    events = get_events(paths('behavior', subject=subject), cache=True)
+    return data, epochs, events
+
+
+def _read_epochs_bands(subject, paths, data_types=('erf',), lock='target',
+                       picks=None, tmin=-.200, tmax=1.200, decim=1,
+                       dtype=np.float32, out_fname=None):
+    """Stack the data types as an array (see load_epochs_bands)"""
+    picks = np.arange(306) if picks is None else picks
+    params = dict(picks=picks, tmin=tmin, tmax=tmax, decim=decim,
+                  dtype=dtype)
+
+    def _read(data_type, out=None):
+        store = paths('store', subject=subject, data_type=data_type,
+                      lock=lock)
+        if op.exists(op.join(store, 'info.json')):
+            return _read_epochs_store(store, out=out, **params)
+        meg_fname = paths('epoch', subject=subject, data_type=data_type,
+                          lock=lock)
+        return _read_FieldTrip_data(meg_fname, mmap=True, cache=True,
+                                    out=out, **params)
+
+    # The first band gives the shape of the stacked array
+    first, meta = _read(data_types[0])
+    shape = (first.shape[0], len(data_types)) + first.shape[1:]
+    if out_fname is None:
+        data = np.empty(shape, dtype=dtype)
+    else:
+        data = np.lib.format.open_memmap(out_fname, mode='w+', dtype=dtype,
+                                         shape=shape)
+    data[:, 0] = first
+    del first
+    for band, data_type in enumerate(data_types[1:], 1):
+        _, meta_ = _read(data_type, out=data[:, band])
+        # the bands must share their trials, channels and times
+        for key in ('sfreq', 'tmin', 'ch_names'):
+            if meta_[key] != meta[key]:
+                raise ValueError('%s differs between %s and %s' % (
+                    key, data_types[0], data_type))
+        if not np.array_equal(meta_['events'], meta['events']):
+            raise ValueError('events differ between %s and %s' % (
+                data_types[0], data_type))
+    return data, meta
+
+
+def test_read_epochs_bands():
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal, assert_raises, assert_true
+    tmp_dir = tempfile.mkdtemp()
+
+    def paths(typ, subject, data_type, lock):
+        fname = op.join(tmp_dir, '%s_%s_%s' % (subject, data_type, lock))
+        return fname + ('.mat' if typ == 'epoch' else '')
+
+    rng = np.random.RandomState(0)
+    data = rng.randn(3, 5, 310, 30).astype(np.float32)
+    meta = dict(sfreq=100., tmin=-.1,
+                ch_names=['MEG%04i' % ii for ii in range(310)],
+                ch_types=['grad', 'grad', 'mag'] * 102 + ['misc'] * 4,
+                events=np.c_[np.cumsum(np.ones(5)) * 500, np.zeros(5),
+                             np.arange(5)])
+    # a band in FieldTrip format, the others converted into stores
+    _write_FieldTrip_data(paths('epoch', 's', 'freq7', 'target'),
+                          data[0], 100., -.1)
+    for band, data_type in enumerate(['freq10', 'freq12'], 1):
+        _write_epochs_store(data[band], meta,
+                            paths('store', 's', data_type, 'target'))
+    params = dict(picks=[1, 3], tmin=0., tmax=.1, decim=2)
+    expected = data[:, :, [1, 3]][..., 10:21:2].transpose(1, 0, 2, 3)
+    for out_fname in (None, op.join(tmp_dir, 'bands.npy')):
+        stacked, meta_ = _read_epochs_bands(
+            's', paths, ['freq7', 'freq10', 'freq12'],
+            out_fname=out_fname, **params)
+        assert_equal(stacked.dtype, np.float32)
+        np.testing.assert_array_equal(stacked, expected)
+        assert_equal(meta_['ch_names'], ['MEG0001', 'MEG0003'])
+        assert_equal(meta_['sfreq'], 50.)
+    assert_true(isinstance(stacked, np.memmap))
+    del stacked
+    # the bands must share their trials
+    meta['events'][0, 2] = 10
+    _write_epochs_store(data[1], meta, paths('store', 's', 'freq10',
+                                             'target'))
+    assert_raises(ValueError, _read_epochs_bands, 's', paths,
+                  ['freq7', 'freq10'], **params)
+    shutil.rmtree(tmp_dir)
+
+
 def angle2circle(angles):
     """from degree to radians multipled by rm2"""
     return np.deg2rad(2 * (np.array(angles) + 7.5))
 
 
-def load_FieldTrip_data(meg_fname):
-    from mne.io.meas_info import create_info
-    from mne.epochs import EpochsArray
-    """XXX Here explain what this does"""
-    # import information from fieldtrip data to get data shape
+def _read_FieldTrip_header(meg_fname):
+    """Read the FieldTrip .mat header describing the .dat binary"""
     ft_data = sio.loadmat(meg_fname[:-4] + '.mat', squeeze_me=True,
                           struct_as_record=True)['data']
-    # import binary MEG data
-    bin_data = np.fromfile(meg_fname[:-4] + '.dat', dtype=np.float32)
-    Xdim = ft_data['Xdim'].item()
-    bin_data = np.reshape(bin_data, Xdim[[2, 1, 0]]).transpose([2, 1, 0])
+    header = dict(Xdim=np.array(ft_data['Xdim'].item(), dtype=int),
+                  sfreq=float(ft_data['fsample'].item()),
+                  times=np.array(ft_data['time'].item()[0], dtype=float),
+                  ch_names=[str(label) for label in ft_data['label'].item()],
+                  trialinfo=np.array(ft_data['trialinfo'].item()))
+    return header
+
+
+def _time_slice(times, sfreq, tmin=None, tmax=None):
+    """Contiguous samples within [tmin, tmax], with half a sample tolerance"""
+    tol = .5 / sfreq
+    start = 0 if tmin is None else np.searchsorted(times, tmin - tol)
+    stop = len(times) if tmax is None else np.searchsorted(times, tmax + tol)
+    if start >= stop:
+        raise ValueError('No sample between tmin=%s and tmax=%s' % (
+            tmin, tmax))
+    return slice(start, stop)
+
+
+def load_FieldTrip_data(meg_fname, mmap=False, sel=None, picks=None,
+                        tmin=None, tmax=None, decim=1, cache=False,
+                        dtype=np.float32, out=None):
+    """Load FieldTrip epochs exported as a .mat header and a .dat binary.
+
+    Parameters
+    ----------
+    meg_fname : str
+        Path to the FieldTrip header (.mat). The binary data is read from the
+        .dat file of the same name.
+    mmap : bool
+        If True, memory-map the .dat file and only read the selected trials,
+        channels and time samples. Defaults to False.
+    sel : None | array of int
+        Trials to load. Defaults to all trials.
+    picks : None | array of int
+        Channels to load. Defaults to all channels.
+    tmin : None | float
+        Start of the time window to load, in seconds. Defaults to the first
+        sample.
+    tmax : None | float
+        End of the time window to load, in seconds. Defaults to the last
+        sample.
+    decim : int
+        Only load one sample out of decim, starting at tmin. No low-pass
+        filter is applied. Defaults to 1.
+    cache : bool
+        Cache the parsed header next to it (see base.cache_call). Defaults to
+        False.
+    dtype : type
+        Precision of the loaded data. Defaults to np.float32, the precision
+        of the files.
+    out : None | np.array, shape (n_trials, n_chans, n_times)
+        Array in which the selected data is written, e.g. a slice of a larger
+        memory-mapped array. Defaults to None.
+
+    Returns
+    -------
+    epochs : EpochsArray
+    """
+    data, meta = _read_FieldTrip_data(meg_fname, mmap, sel, picks, tmin,
+                                      tmax, decim, cache, dtype, out)
+    return _create_epochs(data, **meta)
+
+
+def _read_FieldTrip_data(meg_fname, mmap=False, sel=None, picks=None,
+                         tmin=None, tmax=None, decim=1, cache=False,
+                         dtype=np.float32, out=None):
+    """Read the FieldTrip data as an array (see load_FieldTrip_data)"""
+    # import information from fieldtrip data to get data shape
+    if cache:
+        header = cache_call(_read_FieldTrip_header, meg_fname)
+    else:
+        header = _read_FieldTrip_header(meg_fname)
+    n_trial, n_chans, n_time = header['Xdim']
+    # import binary MEG data. FieldTrip writes it in column-major order:
+    # trials vary fastest and time slowest, so that a time window is a
+    # contiguous block of the file.
+    dat_fname = meg_fname[:-4] + '.dat'
+    if mmap:
+        bin_data = np.memmap(dat_fname, dtype=np.float32, mode='r',
+                             shape=(n_trial, n_chans, n_time), order='F')
+    else:
+        bin_data = np.fromfile(dat_fname, dtype=np.float32)
+        bin_data = np.reshape(bin_data, (n_trial, n_chans, n_time),
+                              order='F')
+
+    # Only materialize the selected trials, channels and samples
+    sfreq = header['sfreq']
+    time_sel = _time_slice(header['times'], sfreq, tmin, tmax)
+    sel = np.arange(n_trial) if sel is None else np.asarray(sel)
+    picks = np.arange(n_chans) if picks is None else np.asarray(picks)
+    time_idx = np.arange(time_sel.start, time_sel.stop, decim)
+    if out is None:
+        out = np.empty((len(sel), len(picks), len(time_idx)), dtype=dtype)
+    # copy by blocks of samples to bound the temporary arrays
+    for block in np.array_split(np.arange(len(time_idx)),
+                                np.ceil(len(time_idx) / 100.)):
+        out[:, :, block] = bin_data[np.ix_(sel, picks, time_idx[block])]
 
     # Create an MNE Epoch
-    n_trial, n_chans, n_time = bin_data.shape
-    sfreq = ft_data['fsample'].item()
-    time = ft_data['time'].item()[0]
-    tmin = min(time)
-    chan_names = [str(label) for label in ft_data['label'].item()]
+    tmin = header['times'][time_sel.start]
+    chan_names = [header['ch_names'][ii] for ii in picks]
     chan_types = np.squeeze(np.concatenate(
         (np.tile(['grad', 'grad', 'mag'], (1, 102)),
-         np.tile('misc', (1, n_chans - 306))), axis=1))
-    info = create_info(chan_names, sfreq, chan_types)
+         np.tile('misc', (1, n_chans - 306))), axis=1))[picks]
     events = np.c_[np.cumsum(np.ones(n_trial)) * 5 * sfreq,
                    np.zeros(n_trial),
-                   ft_data['trialinfo'].item()]
-    epochs = EpochsArray(bin_data, info, events=events, tmin=tmin)
+                   header['trialinfo']][sel]
+    meta = dict(sfreq=sfreq / decim, tmin=tmin, ch_names=chan_names,
+                ch_types=chan_types.tolist(), events=events)
+    return out, meta
 
+
+def _write_FieldTrip_data(meg_fname, data, sfreq, tmin):
+    """Write data as a FieldTrip .mat header and .dat binary, for the tests"""
+    n_trial, n_chans, n_time = data.shape
+    # a cell array with the times of each trial
+    time = np.empty(n_trial, dtype=object)
+    for ii in range(n_trial):
+        time[ii] = tmin + np.arange(n_time) / float(sfreq)
+    header = dict(Xdim=np.array(data.shape, dtype=float), fsample=sfreq,
+                  time=time,
+                  label=np.array(['MEG%04i' % ii for ii in range(n_chans)],
+                                 dtype=object),
+                  trialinfo=np.arange(n_trial, dtype=float))
+    sio.savemat(meg_fname, dict(data=header))
+    np.asarray(data, dtype=np.float32).ravel(order='F').tofile(
+        meg_fname[:-4] + '.dat')
+
+
+def test_read_FieldTrip_data():
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal, assert_raises
+    tmp_dir = tempfile.mkdtemp()
+    meg_fname = op.join(tmp_dir, 'epochs.mat')
+    rng = np.random.RandomState(0)
+    # the 306 MEG channels and a few misc ones
+    data = rng.randn(5, 310, 30).astype(np.float32)
+    _write_FieldTrip_data(meg_fname, data, 100., -.1)
+    for mmap in (False, True):
+        # whole data, in the trial x channel x time layout
+        data_, meta = _read_FieldTrip_data(meg_fname, mmap=mmap)
+        np.testing.assert_array_equal(data_, data)
+        assert_equal(meta['ch_names'],
+                     ['MEG%04i' % ii for ii in range(310)])
+        assert_equal(meta['ch_types'][303:308],
+                     ['grad', 'grad', 'mag', 'misc', 'misc'])
+        assert_equal(meta['sfreq'], 100.)
+        np.testing.assert_allclose(meta['tmin'], -.1)
+        np.testing.assert_array_equal(meta['events'][:, 2], np.arange(5))
+        # trials, channels, time window and decimation
+        sel, picks = [3, 0], [307, 2, 1]
+        data_, meta = _read_FieldTrip_data(
+            meg_fname, mmap=mmap, sel=sel, picks=picks, tmin=0., tmax=.15,
+            decim=2, dtype=np.float64)
+        assert_equal(data_.dtype, np.float64)
+        np.testing.assert_array_equal(
+            data_, data[np.ix_(sel, picks, np.arange(10, 26, 2))])
+        assert_equal(meta['sfreq'], 50.)
+        np.testing.assert_allclose(meta['tmin'], 0.)
+        assert_equal(meta['ch_names'], ['MEG0307', 'MEG0002', 'MEG0001'])
+        assert_equal(meta['ch_types'], ['misc', 'mag', 'grad'])
+        np.testing.assert_array_equal(meta['events'][:, 2], sel)
+        # in place
+        out = np.zeros((5, 3, 30, 2), np.float32)
+        _read_FieldTrip_data(meg_fname, mmap=mmap, picks=picks,
+                             out=out[:, :, :, 1])
+        np.testing.assert_array_equal(out[:, :, :, 1], data[:, picks])
+        np.testing.assert_array_equal(out[:, :, :, 0], 0)
+    assert_raises(ValueError, _read_FieldTrip_data, meg_fname, tmin=1.)
+    shutil.rmtree(tmp_dir)
+
+
+def _create_epochs(data, sfreq, tmin, ch_names, ch_types, events):
+    from mne.io.meas_info import create_info
+    from mne.epochs import EpochsArray
+    info = create_info(ch_names, sfreq, ch_types)
+    # EpochsArray casts its data to float64: give it a zero-stride
+    # placeholder, and only then attach the data in its own precision.
+    placeholder = np.lib.stride_tricks.as_strided(
+        np.zeros(1), data.shape, (0,) * data.ndim)
+    epochs = EpochsArray(placeholder, info, events=np.asarray(events),
+                         tmin=tmin)
+    epochs._data = data
     return epochs
 
 
-def get_events(bhv_fname):
+def _epochs_meta(epochs):
+    """Metadata needed to recreate the epochs with _create_epochs"""
+    from mne.io.pick import channel_type
+    info = epochs.info
+    return dict(sfreq=float(info['sfreq']), tmin=float(epochs.times[0]),
+                ch_names=list(info['ch_names']),
+                ch_types=[channel_type(info, ii)
+                          for ii in range(info['nchan'])],
+                events=epochs.events.tolist())
+
+
+def save_epochs_store(epochs, dirname, chunk_size=100):
+    """Write epochs into a native store chunked along time.
+
+    The store is a directory of .npy chunks of shape
+    (n_trials, n_chans, chunk_size) and of an info.json sidecar holding the
+    metadata. An existing store is first invalidated by removing its
+    sidecar and chunks, and the new sidecar is renamed into place last, so
+    that an interrupted conversion is never picked up by load_epochs_store.
+
+    Parameters
+    ----------
+    epochs : Epochs
+        The epochs to save.
+    dirname : str
+        Directory of the store. Created if necessary.
+    chunk_size : int
+        Number of time samples per chunk. Defaults to 100.
+    """
+    _write_epochs_store(epochs._data, _epochs_meta(epochs), dirname,
+                        chunk_size)
+
+
+def _write_epochs_store(data, meta, dirname, chunk_size=100):
+    """Write an array and its metadata (see save_epochs_store)"""
+    import glob
+    if not op.exists(dirname):
+        os.makedirs(dirname)
+    # Invalidate the previous store before touching its chunks
+    info_fname = op.join(dirname, 'info.json')
+    if op.exists(info_fname):
+        os.remove(info_fname)
+    for fname in glob.glob(op.join(dirname, 'chunk_*.npy')):
+        os.remove(fname)
+    n_times = data.shape[2]
+    chunks = [[start, min(start + chunk_size, n_times)]
+              for start in range(0, n_times, chunk_size)]
+    for ii, (start, stop) in enumerate(chunks):
+        np.save(op.join(dirname, 'chunk_%03i.npy' % ii),
+                np.ascontiguousarray(data[:, :, start:stop],
+                                     dtype=np.float32))
+    meta = dict(meta, events=np.asarray(meta['events']).tolist(),
+                ch_types=list(meta['ch_types']), n_times=n_times,
+                chunks=chunks, dtype='float32')
+    with open(info_fname + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.rename(info_fname + '.tmp', info_fname)
+
+
+def load_epochs_store(dirname, sel=None, picks=None, tmin=None, tmax=None,
+                      decim=1, dtype=np.float32, out=None):
+    """Load epochs from a native store written by save_epochs_store.
+
+    Only the chunks overlapping the time window are read, and they are
+    memory-mapped so that only the selected trials and channels are copied.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store.
+    sel : None | array of int
+        Trials to load. Defaults to all trials.
+    picks : None | array of int
+        Channels to load. Defaults to all channels.
+    tmin : None | float
+        Start of the time window to load, in seconds. Defaults to the first
+        sample.
+    tmax : None | float
+        End of the time window to load, in seconds. Defaults to the last
+        sample.
+    decim : int
+        Only load one sample out of decim, starting at tmin. No low-pass
+        filter is applied. Defaults to 1.
+    dtype : type
+        Precision of the loaded data. Defaults to np.float32, the precision
+        of the files.
+    out : None | np.array, shape (n_trials, n_chans, n_times)
+        Array in which the selected data is written, e.g. a slice of a larger
+        memory-mapped array. Defaults to None.
+
+    Returns
+    -------
+    epochs : EpochsArray
+    """
+    data, meta = _read_epochs_store(dirname, sel, picks, tmin, tmax, decim,
+                                    dtype, out)
+    return _create_epochs(data, **meta)
+
+
+def _read_epochs_store(dirname, sel=None, picks=None, tmin=None, tmax=None,
+                       decim=1, dtype=np.float32, out=None):
+    """Read the native store as an array (see load_epochs_store)"""
+    with open(op.join(dirname, 'info.json'), 'r') as f:
+        meta = json.load(f)
+    sfreq = meta['sfreq']
+    times = meta['tmin'] + np.arange(meta['n_times']) / sfreq
+    time_sel = _time_slice(times, sfreq, tmin, tmax)
+    events = np.array(meta['events'])
+    sel = np.arange(len(events)) if sel is None else np.asarray(sel)
+    picks = (np.arange(len(meta['ch_names'])) if picks is None
+             else np.asarray(picks))
+
+    time_idx = np.arange(time_sel.start, time_sel.stop, decim)
+
+    if out is None:
+        out = np.empty((len(sel), len(picks), len(time_idx)), dtype=dtype)
+    for ii, (start, stop) in enumerate(meta['chunks']):
+        # Skip the chunks that contain none of the selected samples
+        in_chunk = np.where((time_idx >= start) & (time_idx < stop))[0]
+        if not len(in_chunk):
+            continue
+        chunk = np.load(op.join(dirname, 'chunk_%03i.npy' % ii),
+                        mmap_mode='r')
+        out[:, :, in_chunk] = chunk[np.ix_(sel, picks,
+                                           time_idx[in_chunk] - start)]
+
+    meta = dict(sfreq=sfreq / decim, tmin=times[time_sel.start],
+                ch_names=[meta['ch_names'][ii] for ii in picks],
+                ch_types=[meta['ch_types'][ii] for ii in picks],
+                events=events[sel])
+    return out, meta
+
+
+def test_epochs_store():
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal, assert_raises
+    tmp_dir = tempfile.mkdtemp()
+    rng = np.random.RandomState(0)
+    data = rng.randn(5, 4, 25).astype(np.float32)
+    meta = dict(sfreq=100., tmin=-.1, ch_names=['a', 'b', 'c', 'd'],
+                ch_types=['grad', 'grad', 'mag', 'misc'],
+                events=np.c_[np.arange(5), np.zeros(5), np.arange(5)])
+    _write_epochs_store(data, meta, tmp_dir, chunk_size=10)
+    assert_equal(sorted(os.listdir(tmp_dir)),
+                 ['chunk_000.npy', 'chunk_001.npy', 'chunk_002.npy',
+                  'info.json'])
+    # round trip
+    data_, meta_ = _read_epochs_store(tmp_dir)
+    np.testing.assert_array_equal(data_, data)
+    for key in ('sfreq', 'tmin', 'ch_names', 'ch_types'):
+        assert_equal(meta_[key], meta[key])
+    np.testing.assert_array_equal(meta_['events'], meta['events'])
+    # a window across chunks, decimated
+    sel, picks = [4, 1], [3, 0]
+    data_, meta_ = _read_epochs_store(tmp_dir, sel=sel, picks=picks,
+                                      tmin=-.02, tmax=.12, decim=3)
+    np.testing.assert_array_equal(
+        data_, data[np.ix_(sel, picks, np.arange(8, 23, 3))])
+    assert_equal(meta_['ch_types'], ['misc', 'grad'])
+    np.testing.assert_allclose(meta_['tmin'], -.02)
+    assert_equal(meta_['sfreq'], 100. / 3)
+    # the chunks out of the window are not read
+    os.remove(op.join(tmp_dir, 'chunk_002.npy'))
+    data_, _ = _read_epochs_store(tmp_dir, tmax=.09)
+    np.testing.assert_array_equal(data_, data[:, :, :20])
+    # a reconversion replaces the whole store
+    _write_epochs_store(data[:, :, :15] + 1, meta, tmp_dir, chunk_size=10)
+    assert_equal(sorted(os.listdir(tmp_dir)),
+                 ['chunk_000.npy', 'chunk_001.npy', 'info.json'])
+    np.testing.assert_array_equal(_read_epochs_store(tmp_dir)[0],
+                                  data[:, :, :15] + 1)
+    # and an interrupted one leaves no store behind
+
+    class _Interrupted(object):
+        shape = data.shape
+
+        def __getitem__(self, index):
+            if index[2].start > 0:
+                raise RuntimeError('interrupted')
+            return data[index]
+
+    assert_raises(RuntimeError, _write_epochs_store, _Interrupted(), meta,
+                  tmp_dir, 10)
+    assert_equal(os.listdir(tmp_dir), ['chunk_000.npy'])
+    shutil.rmtree(tmp_dir)
+
+
+def get_events(bhv_fname, lags=(1,), cache=False):
+    if cache:
+        # Reuse the parsed events as long as the behavioral file is unchanged
+        return cache_call(get_events, bhv_fname, lags=lags,
+                          depends=[trials2events, _trials_field,
+                                   angle2circle])
     # Load behavioral file
     trials = sio.loadmat(bhv_fname, squeeze_me=True,
                          struct_as_record=True)["trials"]
+    return trials2events(trials, lags=lags)
 
-    def trial2event(trial):
-        event = dict()
-        # Change meaningless values with NaNs
-        event['target_present'] = trial['present'] == 1
-        event['discrim_pressed'] = trial['response_responsed'] == 1
-        event['detect_pressed'] = trial['response_vis_responsed'] == 1
-        nan_default = lambda check, value: value if check else np.nan
-        target_present = lambda v: nan_default(event['target_present'], v)
-        # discrim_pressed = lambda v: nan_default(event['discrim_pressed'], v)
-        discrim_buttons = lambda v: nan_default(
-            v in ['left_green', 'left_yellow'], 1. * (v == 'left_green'))
-        detect_pressed = lambda v: nan_default(event['detect_pressed'], v)
-        # Target
-        event['target_contrast'] = [0, .5, .75, 1][trial['contrast'] - 1]
-        event['target_spatialFreq'] = target_present(trial['lambda'] == 1)
-        event['target_angle'] = target_present(trial['orientation'] * 30 - 15)
-        event['target_circAngle'] = angle2circle(event['target_angle'])
-        # Probe
-        event['probe_angle'] = (trial['orientation'] * 30 - 15 +
-                                trial['tilt'] * 30) % 180
-        event['probe_circAngle'] = angle2circle(event['probe_angle'])
-        event['probe_tilt'] = target_present(trial['tilt'])
-        # Response 1: forced choice discrimination
-        event['discrim_button'] = discrim_buttons(trial['response_keyPressed'])
-
-        event['discrim_correct'] = target_present(trial['correct'] == 1)
-        # Response 2: detection/visibility
-        event['detect_button'] = \
-            detect_pressed(trial['response_visibilityCode'] - 1)
-        event['detect_seen'] = event['detect_button'] > 0
-        return event
-
-    events = list()
-    for t, trial in enumerate(trials):
-        # define previous trial
-        event = trial2event(trial)
-        if t > 1:
-            previous_event = trial2event(trials[t-1])
-            for key in previous_event:
-                event['previous_' + key] = previous_event[key]
-        events.append(event)
-    events = pd.DataFrame(events)
+
+def _trials_field(trials, name, dtype=float):
+    """Column of the trials struct array, with NaN for empty values"""
+    values = trials[name]
+    try:
+        return values.astype(dtype)
+    except (TypeError, ValueError):
+        # Missing responses are stored by MATLAB as empty arrays
+        return np.array([np.nan if np.size(v) == 0 else v for v in values],
+                        dtype=dtype)
+
+
+def trials2events(trials, lags=(1,), groups=None):
+    """Build the behavioral events column-wise from the trials struct array.
+
+    Parameters
+    ----------
+    trials : np.array, shape (n_trials,)
+        Structured array of trials, as loaded from the behavioral file.
+    lags : list of int
+        For each lag, add the events of the lag-th previous trial, prefixed
+        with 'previous_' for lag 1 and with 'previous%i_' otherwise.
+        Defaults to (1,).
+    groups : None | np.array, shape (n_trials,)
+        Group of each trial (e.g. subject) when several tables are pooled.
+        Lagged events are never taken from another group. Defaults to None.
+
+    Returns
+    -------
+    events : pandas.DataFrame, shape (n_trials, n_columns)
+    """
+    nan = np.nan
+    # Change meaningless values with NaNs
+    present = _trials_field(trials, 'present') == 1
+    detect_pressed = _trials_field(trials, 'response_vis_responsed') == 1
+    orientation = _trials_field(trials, 'orientation')
+    tilt = _trials_field(trials, 'tilt')
+    keys = _trials_field(trials, 'response_keyPressed', dtype=str)
+    columns = list()
+    columns.append(('target_present', present))
+    columns.append(('discrim_pressed',
+                    _trials_field(trials, 'response_responsed') == 1))
+    columns.append(('detect_pressed', detect_pressed))
+    # Target
+    contrast = _trials_field(trials, 'contrast', dtype=int)
+    columns.append(('target_contrast',
+                    np.array([0, .5, .75, 1])[contrast - 1]))
+    columns.append(('target_spatialFreq', np.where(
+        present, _trials_field(trials, 'lambda') == 1, nan)))
+    target_angle = np.where(present, orientation * 30 - 15, nan)
+    columns.append(('target_angle', target_angle))
+    columns.append(('target_circAngle', angle2circle(target_angle)))
+    # Probe
+    probe_angle = (orientation * 30 - 15 + tilt * 30) % 180
+    columns.append(('probe_angle', probe_angle))
+    columns.append(('probe_circAngle', angle2circle(probe_angle)))
+    columns.append(('probe_tilt', np.where(present, tilt, nan)))
+    # Response 1: forced choice discrimination
+    columns.append(('discrim_button', np.where(
+        (keys == 'left_green') | (keys == 'left_yellow'),
+        1. * (keys == 'left_green'), nan)))
+    columns.append(('discrim_correct', np.where(
+        present, _trials_field(trials, 'correct') == 1, nan)))
+    # Response 2: detection/visibility
+    detect_button = np.where(
+        detect_pressed,
+        _trials_field(trials, 'response_visibilityCode') - 1, nan)
+    columns.append(('detect_button', detect_button))
+    columns.append(('detect_seen', detect_button > 0))
+    names = [name for name, _ in columns]
+    events = pd.DataFrame(dict(columns), columns=names)
+
+    # Lagged events are shifted copies of the columns
+    shifter = events if groups is None else events.groupby(np.asarray(groups))
+    lagged = list()
+    for lag in lags:
+        prefix = 'previous_' if lag == 1 else 'previous%i_' % lag
+        previous = shifter.shift(lag)
+        previous.columns = [prefix + name for name in names]
+        lagged.append(previous)
+    events = pd.concat([events] + lagged, axis=1)
     return events
 
 
+def test_trials2events():
+    import shutil
+    import tempfile
+    from nose.tools import assert_equal, assert_true
+    # the behavioral file, with the empty responses of MATLAB
+    nan, empty = np.nan, np.zeros(0)
+    fields = ['present', 'response_responsed', 'response_vis_responsed',
+              'orientation', 'tilt', 'contrast', 'lambda', 'correct',
+              'response_keyPressed', 'response_visibilityCode']
+    values = [[1, 1, 1, 1, -1, 1, 2, 1, 'left_green', 3],
+              [0, 1, 0, 2, 1, 2, 1, 0, 'left_yellow', empty],
+              [1, 0, 1, 3, -1, 3, 1, 1, empty, 1],
+              [1, 1, 1, 4, 1, 4, 2, 0, 'right_red', 4],
+              [0, 0, 0, 5, -1, 1, 1, 0, empty, empty],
+              [1, 1, 1, 6, 1, 2, 2, 1, 'left_yellow', 2]]
+    trials = np.zeros(len(values), dtype=[(f, object) for f in fields])
+    for ii, value in enumerate(values):
+        for field, item in zip(fields, value):
+            trials[field][ii] = item
+    tmp_dir = tempfile.mkdtemp()
+    bhv_fname = op.join(tmp_dir, 'behavior.mat')
+    sio.savemat(bhv_fname, dict(trials=trials))
+    events = get_events(bhv_fname)
+
+    # the per-trial definition of the events
+    def _event(v):
+        present = v[0] == 1
+        key = v[8] if len(v[8]) else ''
+        detect_button = v[9] - 1 if v[2] == 1 else nan
+        return dict(
+            target_present=present, discrim_pressed=v[1] == 1,
+            detect_pressed=v[2] == 1,
+            target_contrast=[0, .5, .75, 1][v[5] - 1],
+            target_spatialFreq=v[6] == 1 if present else nan,
+            target_angle=v[3] * 30 - 15 if present else nan,
+            target_circAngle=angle2circle(v[3] * 30 - 15 if present
+                                          else nan),
+            probe_angle=(v[3] * 30 - 15 + v[4] * 30) % 180,
+            probe_circAngle=angle2circle((v[3] * 30 - 15 + v[4] * 30) % 180),
+            probe_tilt=v[4] if present else nan,
+            discrim_button=(1. * (key == 'left_green') if key in
+                            ('left_green', 'left_yellow') else nan),
+            discrim_correct=v[7] == 1 if present else nan,
+            detect_button=detect_button, detect_seen=detect_button > 0)
+
+    expected = [_event(value) for value in values]
+    names = sorted(expected[0].keys())
+    assert_equal(sorted(events.columns),
+                 sorted(names + ['previous_' + name for name in names]))
+    for name in names:
+        column = np.array([event[name] for event in expected], dtype=float)
+        np.testing.assert_array_equal(events[name].astype(float), column)
+        # the previous trial, from the second trial on
+        np.testing.assert_array_equal(events['previous_' + name].astype(float),
+                                      np.r_[nan, column[:-1]])
+    # several lags
+    events = trials2events(sio.loadmat(bhv_fname, squeeze_me=True)['trials'],
+                           lags=(1, 2))
+    assert_equal(len(events.columns), 3 * len(names))
+    np.testing.assert_array_equal(events['previous2_target_angle'],
+                                  np.r_[nan, nan, events['target_angle'][:-2]])
+    # lagged values never cross groups
+    groups = [0, 0, 0, 1, 1, 1]
+    events = trials2events(sio.loadmat(bhv_fname, squeeze_me=True)['trials'],
+                           lags=(1, 2), groups=groups)
+    probe = events['probe_angle'].values
+    np.testing.assert_array_equal(
+        events['previous_probe_angle'],
+        [nan, probe[0], probe[1], nan, probe[3], probe[4]])
+    np.testing.assert_array_equal(
+        events['previous2_probe_angle'],
+        [nan, nan, probe[0], nan, nan, probe[3]])
+    assert_true(np.isnan(events['previous_detect_button'][3]))
+    shutil.rmtree(tmp_dir)
+
+
 class clf_2class_proba(LogisticRegression):  # XXX not used?
     """Probabilistic SVC for 2 classes only"""
     def predict(self, x):
@@ -134,46 +1075,109 @@ class SVC_2class_proba(SVC):
 
 
 class SVR_angle(LinearSVR):
+    """Regress the cos and the sin of angles, as a single multi-output
+    problem
 
-    def __init__(self):
-        from sklearn.svm import LinearSVR
-        from sklearn.preprocessing import StandardScaler
-        from sklearn.pipeline import Pipeline
-        scaler_cos = StandardScaler()
-        scaler_sin = StandardScaler()
-        svr_cos = LinearSVR(C=1)
-        svr_sin = LinearSVR(C=1)
-        self.clf_cos = Pipeline([('scaler', scaler_cos), ('svr', svr_cos)])
-        self.clf_sin = Pipeline([('scaler', scaler_sin), ('svr', svr_sin)])
+    Parameters
+    ----------
+    scaler : bool
+        Standardize the features, once for both components. Set to False for
+        whitened data. Defaults to True.
+    solver : 'svr' | 'ridge'
+        Fit both components with a shared L1-loss LinearSVR solver, or with
+        a single closed-form ridge regression (see decoding.fit_linear).
+        Defaults to 'svr'.
+    C : float
+        Inverse penalty of the SVR. Defaults to 1.
+    epsilon : float
+        Insensitivity of the SVR. Defaults to 0.
+    alpha : float
+        Penalty of the ridge regression. Defaults to 1.
+    tol : float
+        Tolerance of the SVR solver. Defaults to 1e-4.
+    components : bool
+        Predict the cos and the sin components (see predict_components)
+        instead of the angles. Defaults to False.
+
+    Attributes
+    ----------
+    scaler_ : None | StandardScaler
+    coef_ : np.array, shape (2, n_features)
+    intercept_ : np.array, shape (2,)
+        The weights of the cos and of the sin components.
+    n_iter_ : int
+        Number of iterations of the solver.
+    """
+    def __init__(self, scaler=True, solver='svr', C=1., epsilon=0.,
+                 alpha=1., tol=1e-4, components=False):
+        self.scaler = scaler
+        self.solver = solver
+        self.C = C
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.tol = tol
+        self.components = components
 
     def fit(self, X, y):
         """
-        Fit 2 regressors cos and sin of angles y
+        Fit the cos and the sin of angles y
         Parameters
         ----------
-        X : np.array, shape(n_trials, n_chans, n_time)
+        X : np.array, shape(n_trials, n_features)
             MEG data
         y : list | np.array (n_trials)
-            angles in degree
+            angles in radians
         """
+        from sklearn.preprocessing import StandardScaler
+        from decoding import fit_linear
+        if self.solver not in ('svr', 'ridge'):
+            raise ValueError('Unknown solver %s' % self.solver)
+        self.scaler_ = None
+        if self.scaler:
+            self.scaler_ = StandardScaler()
+            X = self.scaler_.fit_transform(X)
         # Go from orientation space (0-180 degrees) to complex space
         # (0 - 2 pi radians)
-        self.clf_cos.fit(X, np.cos(y))
-        self.clf_sin.fit(X, np.sin(y))
+        y = np.asarray(y, dtype=float)
+        Y = np.c_[np.cos(y), np.sin(y)]
+        coef, intercept, n_iter = fit_linear(
+            np.asarray(X)[:, :, None], Y, loss=self.solver, alpha=self.alpha,
+            C=self.C, epsilon=self.epsilon, tol=self.tol)
+        self.coef_, self.intercept_ = coef[0].T, intercept[0]
+        self.n_iter_ = n_iter[0]
+        return self
+
+    def predict_components(self, X):
+        """
+        Predict the cos and the sin of the angles from MEG data
+        Parameters
+        ----------
+        X : np.array, shape(n_trials, n_features)
+            MEG data
+        Returns
+        -------
+        components : np.array, shape(n_trials, 2)
+            cos and sin predictions, whose norm is the confidence of the
+            predicted angle
+        """
+        if self.scaler_ is not None:
+            X = self.scaler_.transform(X)
+        return np.dot(X, self.coef_.T) + self.intercept_
 
     def predict(self, X):
         """
         Predict orientation from MEG data in radians
         Parameters
         ----------
-        X : np.array, shape(n_trials, n_chans, n_time)
+        X : np.array, shape(n_trials, n_features)
             MEG data
         Returns
         -------
-        predict_angle : list | np.array, shape(n_trials)
-            angle predictions in radian
+        predict_angle : np.array, shape(n_trials) | (n_trials, 2)
+            angle predictions in radian, or their components
         """
-        predict_cos = self.clf_cos.predict(X)
-        predict_sin = self.clf_sin.predict(X)
-        predict_angle = np.arctan2(predict_sin, predict_cos)
+        components = self.predict_components(X)
+        if self.components:
+            return components
+        predict_angle = np.arctan2(components[:, 1], components[:, 0])
         return predict_angle
@@ -0,0 +1,59 @@
+"""Benchmark base.resample_epochs: polyphase by chunks of trials vs the
+former FFT resampling of the whole array, on the shapes of our epochs
+(~400 trials x 306 channels x 1.4 s at 1 kHz).
+
+Each run is forked, so that the peak resident memory of the process
+(resource.getrusage, in kB on Linux) is measured for that run only."""
+import sys
+sys.path.insert(0, './')
+import time
+import resource
+import multiprocessing
+import numpy as np
+
+from base import resample_epochs
+
+
+class _Epochs(object):
+    """Minimal stand-in for mne.Epochs: resample_epochs only needs the
+    data, the sampling frequency and the times"""
+    def __init__(self, data, sfreq, tmin):
+        self._data = data
+        self.info = dict(sfreq=sfreq)
+        self.times = tmin + np.arange(data.shape[2]) / sfreq
+
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1e3
+
+
+def _run(queue, method, chunk_size, new_sfreq):
+    epochs = _Epochs(data.copy(), sfreq, tmin)
+    baseline = _max_rss()
+    start = time.time()
+    epochs = resample_epochs(epochs, new_sfreq, method=method,
+                             chunk_size=chunk_size)
+    duration = time.time() - start
+    queue.put((duration, _max_rss() - baseline, epochs._data.shape,
+               epochs._data.dtype))
+
+
+n_trials, n_chans, sfreq, tmin, tmax = 400, 306, 1000., -.200, 1.200
+n_times = int(round((tmax - tmin) * sfreq)) + 1
+data = np.random.randn(n_trials, n_chans, n_times).astype(np.float32)
+# load the lazily imported modules before forking
+for method in ('fft', 'poly'):
+    resample_epochs(_Epochs(data[:1].copy(), sfreq, tmin), 250.,
+                    method=method)
+
+for new_sfreq in (250., 128.):
+    for method, chunk_size in (('fft', None), ('poly', 8), ('poly', 32)):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_run, args=(queue, method, chunk_size, new_sfreq))
+        process.start()
+        duration, peak, shape, dtype = queue.get()
+        process.join()
+        print('%5.0f Hz  %-4s chunk=%-4s %6.2f s  peak %6.0f MB  %s %s' % (
+            new_sfreq, method, chunk_size, duration, peak / 1e6, shape,
+            dtype))
@@ -9,15 +9,24 @@ import matplotlib.pyplot as plt
 from mne.stats import spatio_temporal_cluster_1samp_test
 from toolbox.utils import (plot_eb, fill_betweenx_discontinuous)
 
-def recombine_svr_prediction(gatx, gaty):
+def recombine_svr_prediction(gatx, gaty=None):
     """
     This function takes two classifiers SVR predictions, typically
     sine and cosine of an angle, and combine them into a predicted angle in
-    radians
+    radians. If gaty is None, gatx is a single GAT of
+    SVR_angle(components=True), which predicts both components, and whose
+    y_train_ are the angles.
     """
 
     pi = np.pi
 
+    if gaty is None:
+        true_angles = np.squeeze(gatx.y_train_)
+        predict_x = np.array(gatx.y_pred_)[..., 0]
+        predict_y = np.array(gatx.y_pred_)[..., 1]
+        predict_angles, _ = cart2pol(predict_x, predict_y)
+        return predict_angles, true_angles
+
     # get true angle
     true_x = gatx.y_train_
     true_y = gaty.y_train_
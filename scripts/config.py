@@ -28,6 +28,7 @@ def paths(typ, subject='fsaverage', data_type='erf', lock='target',
 
         behavior=op.join(this_path, '%s_fixed.mat' % subject),
         epoch=op.join(this_path, '%s_%s_%s.mat' % (subject, lock, data_type)),
+        store=op.join(this_path, '%s_%s_%s' % (subject, lock, data_type)),
         evoked=op.join(this_path, '%s_%s_%s_%s.pickle' % (
             subject, lock, data_type, analysis)),
         decod=op.join(this_path, '%s_%s_%s_%s.pickle' % (
@@ -62,9 +63,56 @@ subjects = [
 # meg_connectivity, _ = read_ch_connectivity('neuromag306meg')
 chan_types = [dict(name='meg')]
 
-# Decoding preprocessing steps
+# Decoding preprocessing steps: 'resample', 'decim' and 'crop' are cropped
+# and fused into a single pass (see base.plan_preprocessing). 'whiten', e.g.
+# dict(tmin=None, tmax=0.), whitens the sensors with the noise covariance of
+# the baseline, and replaces the StandardScaler of the decoders.
 preproc = dict()
 
+# Numerical precision of the data and of the stored predictions. The MEG
+# files are in single precision: set to 'float64' for double precision.
+dtype = 'float32'
+
+# Cache of preprocessed epochs, and its maximum size in bytes
+cache_dir = op.join(data_path, 'cache')
+cache_size = 50e9
+
+# Memory budget of the preprocessing, in bytes. If not None, the trials are
+# preprocessed by chunks streamed from the memory-mapped data to the cache.
+max_memory = None
+
+# Number of (subject, data_type) loaded in the background ahead of the one
+# being decoded
+n_prefetch = 1
+
+# Reduction of the sensors to their principal components, fitted once per
+# fold on the training trials and shared across times and analyses, e.g.
+# dict(n_components=40, whiten=True). None decodes all sensors.
+reduction = None
+
+# Fit all train times of a fold as one batched problem when the decoder is a
+# Ridge, a LogisticRegression or a LinearSVR (see decoding.linear_spec).
+# Other decoders are fitted per time sample.
+batch = True
+
+# Fit the train times of each fold in order, each starting from the solution
+# of the previous one. This saves iterations to the logistic regressions, but
+# gives up the batching of the SVRs across times.
+warm_start = False
+
+# Fit the batched ridge and SVR decoders in the dual, from the Gram matrices
+# of the trials at each time, shared in memory by the analyses of the same
+# trials (see decoding.fit_kernel). Cheaper than the sensors when there are
+# fewer trials than sensors.
+kernel = True
+
+# Test times of each train time: None for the full generalization matrix,
+# 'diagonal' for the time-resolved decoding only, or e.g. dict(band=.2) for
+# the test times within 200 ms of each train time, or dict(step=.02) for a
+# strided grid. The prediction cost is linear in time for the diagonal and
+# the bands.
+test_times = None
+
 # ###################### Define contrasts #####################
 from orientations.conditions import analyses
 
@@ -106,3 +154,5 @@ data_types = [data_types[0]]
 analyses = [ana for ana in analyses if ana['name'] == 'target_present']
 preproc = dict(decim=4, crop=dict(tmin=-.1, tmax=.300))
 # preproc = dict(decim=2, crop=dict(tmin=-.1, tmax=1.100))
+# preproc = dict(decim=2, crop=dict(tmin=-.1, tmax=1.100),
+#                window=dict(length=.020, stride=2, method='average'))
@@ -0,0 +1,29 @@
+import sys
+sys.path.insert(0, './')
+import matplotlib
+matplotlib.use('Agg')
+
+import os.path as op
+from itertools import product
+
+from orientations.utils import load_FieldTrip_data, save_epochs_store
+
+from scripts.config import (
+    paths,
+    subjects,
+    data_types,
+    overwrite
+)
+
+# Convert each FieldTrip epoch file once into the native chunked store read
+# by load_epochs_events, restricted to the 306 MEG channels and cropped.
+for subject, data_type in product(subjects, data_types):
+    store = paths('store', subject=subject, data_type=data_type)
+    if op.exists(op.join(store, 'info.json')) and not overwrite:
+        print('%s already converted' % store)
+        continue
+    print('convert %s %s' % (subject, data_type))
+    meg_fname = paths('epoch', subject=subject, data_type=data_type)
+    epochs = load_FieldTrip_data(meg_fname, mmap=True, picks=range(306),
+                                 tmin=-.200, tmax=1.200)
+    save_epochs_store(epochs, store)
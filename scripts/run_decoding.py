@@ -5,12 +5,14 @@ matplotlib.use('Agg')
 
 import numpy as np
 import pickle
-from mne.decoding import GeneralizationAcrossTime
+from itertools import product
 
 from meeg_preprocessing.utils import setup_provenance
 
-from orientations.utils import load_epochs_events
-from base import resample_epochs, decim
+from orientations.utils import load_preprocessed, preprocessed_key
+from base import prefetch, code_signature
+from decoding import (GeneralizationAcrossTime, FoldCache, without_scaler,
+                      fit_targets, fit_reduction, apply_reduction)
 
 from scripts.config import (
     open_browser,
@@ -18,6 +20,16 @@ from scripts.config import (
     subjects,
     data_types,
     preproc,
+    n_prefetch,
+    dtype,
+    cache_dir,
+    cache_size,
+    max_memory,
+    reduction,
+    batch,
+    warm_start,
+    kernel,
+    test_times,
     analyses
 )
 
@@ -26,63 +38,89 @@ from scripts.transfer_data import upload_report
 report, run_id, _, logger = setup_provenance(
     script=__file__, results_dir=paths('report'))
 
-for s, subject in enumerate(subjects):  # Loop across each subject
-    print(subject)
-    for data_type in data_types:  # Input type ERFs or frequency power
-        epochs, events = load_epochs_events(subject, paths,
-                                            data_type=data_type)
-
-        # preprocess data for memory issue
-        if 'resample' in preproc.keys():
-            epochs = resample_epochs(epochs, preproc['resample'])
-        if 'decim' in preproc.keys():
-            epochs = decim(epochs, preproc['decim'])
-        if 'crop' in preproc.keys():
-            epochs.crop(preproc['crop']['tmin'],
-                        preproc['crop']['tmax'])
-
-        # Apply to each analysis
-        for analysis in analyses:
-            query, condition = analysis['query'], analysis['condition']
-            sel = range(len(events)) if query is None \
-                else events.query(query).index
-            sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
-            y = np.array(events[condition], dtype=np.float32)
-
-            print analysis['name'], np.unique(y[sel]), len(sel)
-
-            if len(sel) == 0:
-                logger.warning('%s: no epoch in %s for %s.' % (
-                    subject, data_type, analysis['name']))
-                continue
-
-            # Apply analysis
-            gat = GeneralizationAcrossTime(clf=analysis['clf'],
-                                           cv=analysis['cv'],
-                                           scorer=analysis['scorer'],
-                                           n_jobs=-1)
-            gat.fit(epochs[sel], y=y[sel])
-            gat.score(epochs[sel], y=y[sel])
-
-            # Save analysis
-            pkl_fname = paths('decod', subject=subject, data_type=data_type,
-                              analysis=analysis['name'], log=True)
-
-            # Save classifier results
-            with open(pkl_fname, 'wb') as f:
-                pickle.dump([gat, analysis, sel, events], f)
-
-            # Plot
-            fig = gat.plot_diagonal(show=False)
-            report.add_figs_to_section(fig, ('%s %s %s: (diagonal)' %
-                                       (subject, data_type, analysis['name'])),
-                                       analysis['name'])
-
-            fig = gat.plot(vmin=np.min(gat.scores_),
-                           vmax=np.max(gat.scores_), show=False)
-            report.add_figs_to_section(fig, ('%s %s %s: GAT' % (
-                                       subject, data_type, analysis['name'])),
-                                       analysis['name'])
+
+def load_preprocess(subject, data_type):
+    return load_preprocessed(subject, paths, preproc, data_type=data_type,
+                             dtype=dtype, cache_dir=cache_dir,
+                             max_bytes=cache_size, max_memory=max_memory,
+                             verbose=True)
+
+# Load the next subject and data type in the background while decoding the
+# current one
+for (subject, data_type), (epochs, events) in prefetch(
+        load_preprocess, product(subjects, data_types), n_prefetch=n_prefetch):
+    print('%s %s' % (subject, data_type))
+    # Fold-level reductions are shared by the analyses fitted on the same
+    # training trials. They are identified by the preprocessed epochs, which
+    # include the source files and code, and by the code of the reduction.
+    fold_cache = FoldCache((preprocessed_key(subject, paths, preproc,
+                                             data_type=data_type, dtype=dtype),
+                            preproc.get('window', None),
+                            code_signature(fit_reduction, apply_reduction)),
+                           cache_dir=cache_dir, max_bytes=cache_size)
+
+    # Targets of all analyses, NaN for the trials they exclude
+    Y = np.nan * np.zeros((len(events), len(analyses)))
+    gats = list()
+    for column, analysis in enumerate(analyses):
+        query, condition = analysis['query'], analysis['condition']
+        sel = range(len(events)) if query is None \
+            else events.query(query).index
+        sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
+        Y[sel, column] = np.asarray(events[condition][sel])
+
+        print analysis['name'], np.unique(Y[sel, column]), len(sel)
+
+        if len(sel) == 0:
+            logger.warning('%s: no epoch in %s for %s.' % (
+                subject, data_type, analysis['name']))
+
+        # Whitened sensors need no per-time standardization
+        clf = analysis['clf']
+        if 'whiten' in preproc.keys():
+            clf = without_scaler(clf)
+
+        gats.append(GeneralizationAcrossTime(clf=clf, cv=analysis['cv'],
+                                             scorer=analysis['scorer'],
+                                             test_times=test_times,
+                                             reduce=reduction,
+                                             fold_cache=fold_cache,
+                                             batch=batch,
+                                             warm_start=warm_start,
+                                             kernel=kernel, n_jobs=-1))
+
+    # Fit all analyses in one pass: those of the same trials share their
+    # folds and fold-level precomputations, and the linear models that only
+    # differ by their targets are solved together
+    sels = fit_targets(gats, epochs, Y)
+
+    # Apply to each analysis
+    for analysis, gat, sel, y in zip(analyses, gats, sels, Y.T):
+        if len(sel) == 0:
+            continue
+        sel = sel.tolist()
+        gat.score(epochs[sel], y=y[sel])
+
+        # Save analysis
+        pkl_fname = paths('decod', subject=subject, data_type=data_type,
+                          analysis=analysis['name'], log=True)
+
+        # Save classifier results
+        with open(pkl_fname, 'wb') as f:
+            pickle.dump([gat, analysis, sel, events], f)
+
+        # Plot
+        fig = gat.plot_diagonal(show=False)
+        report.add_figs_to_section(fig, ('%s %s %s: (diagonal)' %
+                                   (subject, data_type, analysis['name'])),
+                                   analysis['name'])
+
+        # NaN where not tested (see decoding.SparseScores)
+        fig = gat.plot(vmin=np.nanmin(gat.scores_),
+                       vmax=np.nanmax(gat.scores_), show=False)
+        report.add_figs_to_section(fig, ('%s %s %s: GAT' % (
+                                   subject, data_type, analysis['name'])),
+                                   analysis['name'])
 
 report.save(open_browser=open_browser)
 upload_report(report)
@@ -21,6 +21,7 @@ from scripts.config import (
     analyses,
     chan_types,
     open_browser,
+    dtype
 )
 
 from scripts.transfer_data import upload_report
@@ -33,7 +34,8 @@ mne.set_log_level('INFO')
 for subject, data_type in product(subjects, data_types):
     print('load %s %s' % (subject, data_type))
 
-    epochs, events = load_epochs_events(subject, paths, data_type=data_type)
+    epochs, events = load_epochs_events(subject, paths, data_type=data_type,
+                                        dtype=dtype)
 
     # Apply each analysis
     for analysis in analyses:
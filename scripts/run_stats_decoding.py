@@ -15,6 +15,8 @@ from mne.stats import spatio_temporal_cluster_1samp_test
 
 import pickle
 
+from decoding import SparseScores
+
 ###############################################################################
 
 from scripts.config import (
@@ -86,7 +88,8 @@ for data_type in data_types:
                 gat_.score(y=y[subsel],
                            scorer=contrast['scorer'])
 
-                # concatenate scores in a gat * subject array
+                # concatenate scores in a gat * subject array, NaN where a
+                # sparse GAT is not tested
                 if s == 0:
                     scores = np.array(gat_.scores_)[:, :, None]
                 else:
@@ -101,7 +104,24 @@ for data_type in data_types:
             n_permutations = 2 ** 11
             threshold = dict(start=.2, step=.2)
 
-            X = scores.transpose((2, 0, 1)) - contrast['chance']
+            # The diagonal pairs each train time with the same test sample:
+            # its column among all samples for sparse GATs, and among the
+            # test grid otherwise. NaN where the train time is not tested.
+            sparse = isinstance(gat.scores_, SparseScores)
+            grid = np.arange(scores.shape[1]) if sparse else \
+                np.asarray(gat.test_times_['slices'][0])
+            columns = np.array([np.where(grid == t)[0][0] if t in grid
+                                else -1 for t in gat.train_times['slices']])
+            tested = np.where(columns >= 0)[0]
+            scores_diag = np.nan * np.zeros((scores.shape[2], len(columns)))
+            scores_diag[:, tested] = scores[tested, columns[tested]].T
+
+            # Sparse GATs are only tested around the diagonal: the stats are
+            # run along it
+            if sparse:
+                X = scores_diag[:, tested, None] - contrast['chance']
+            else:
+                X = scores.transpose((2, 0, 1)) - contrast['chance']
 
             # ------ Run stats
             T_obs_, clusters, p_values, _ = spatio_temporal_cluster_1samp_test(
@@ -115,17 +135,28 @@ for data_type in data_types:
             # ------ combine clusters & retrieve min p_values for each feature
             cluster_p = [clusters[c] * p for c, p in enumerate(p_values)]
             p_values = np.min(np.logical_not(clusters) + cluster_p, axis=0)
-            x, y = np.meshgrid(gat.train_times['times_'],
-                               gat.test_times_['times_'][0],
-                               copy=False, indexing='xy')
+            p_diag = np.nan * np.zeros(len(columns))
+            p_diag[tested] = p_values[:, 0] if sparse else \
+                p_values[tested, columns[tested]]
 
             # PLOT
             # ------ Plot GAT
             gat.scores_ = np.mean(scores, axis=2)
-            fig = gat.plot(vmin=np.min(gat.scores_), vmax=np.max(gat.scores_),
-                           show=False)
-            ax = fig.axes[0]
-            ax.contour(x, y, p_values < alpha, colors='black', levels=[0])
+            if sparse:
+                gat.scores_ = SparseScores(
+                    [row[t] for row, t in zip(gat.scores_,
+                                              gat.test_times_['slices'])],
+                    gat.train_times['slices'], gat.test_times_['slices'],
+                    scores.shape[1])
+            fig = gat.plot(vmin=np.nanmin(gat.scores_),
+                           vmax=np.nanmax(gat.scores_), show=False)
+            if not sparse:
+                # test times along x and train times along y, as the scores
+                x, y = np.meshgrid(gat.test_times_['times_'][0],
+                                   gat.train_times['times_'],
+                                   copy=False, indexing='xy')
+                ax = fig.axes[0]
+                ax.contour(x, y, p_values < alpha, colors='black', levels=[0])
             # plt.show()
             report.add_figs_to_section(
                 fig, '%s (%s) - %s: Decoding GAT' %
@@ -137,11 +168,9 @@ for data_type in data_types:
             ax = fig.axes[0]
             ymin, ymax = ax.get_ylim()
 
-            scores_diag = np.array([np.diag(s) for s in
-                                    scores.transpose((2, 0, 1))])
             times = gat.train_times['times_']
 
-            sig_times = times[np.where(np.diag(p_values) < alpha)[0]]
+            sig_times = times[np.where(p_diag < alpha)[0]]
             sfreq = (times[1] - times[0]) / 1000
             fill_betweenx_discontinuous(ax, ymin, ymax, sig_times, freq=sfreq,
                                         color='orange')